@@ -1,8 +1,35 @@
-from flask import Flask, request, render_template, flash, redirect, url_for, send_from_directory
+from flask import (
+    Flask,
+    request,
+    render_template,
+    flash,
+    redirect,
+    url_for,
+    send_from_directory,
+    send_file,
+    jsonify,
+    g,
+    Response,
+    after_this_request,
+)
 import os
+import json
+import time
+import tempfile
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-from utils import ocr, excel
-from config import UPLOAD_FOLDER, EXCEL_FOLDER, ALLOWED_EXTENSIONS, MAX_CONTENT_LENGTH
+from utils import jobs, bulk, cache, excel, ledger, log, metrics
+from config import (
+    UPLOAD_FOLDER,
+    UPLOAD_ARCHIVE_ENABLED,
+    EXCEL_FOLDER,
+    ALLOWED_EXTENSIONS,
+    MAX_CONTENT_LENGTH,
+    BULK_MAX_CONTENT_LENGTH,
+    BULK_RETRY_AFTER,
+    JOB_EVENT_POLL_INTERVAL,
+    JOB_EVENT_KEEPALIVE,
+)
 from datetime import datetime
 
 app = Flask(__name__)
@@ -10,6 +37,42 @@ app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 app.secret_key = "your_secret_key"  # セッションやflash用のキー（適宜変更してください）
 
+logger = log.get_logger(__name__)
+
+
+
+def start_background():
+    """
+    サーバーの起動時の処理（台帳への取り込み・バックグラウンドワーカー・受信フォルダの監視）
+    OCRのプロセスプール（spawn）の子プロセスは app.py を読み込み直すため、インポート時には実行しない
+    python app.py では __main__ から、gunicornでは gunicorn.conf.py のフックから各ワーカープロセスで呼び出す
+    """
+    # 台帳の導入前に作成されたExcelファイルを台帳に取り込む
+    ledger.import_workbooks(EXCEL_FOLDER)
+    # バックグラウンドワーカーの起動
+    jobs.start_workers()
+    # 受信フォルダの監視（INBOX_FOLDERを指定した場合のみ）
+    bulk.start_inbox_watcher()
+
+
+# リクエストごとに相関IDを付与（X-Request-IDヘッダーがあればその値を使用）
+@app.before_request
+def bind_correlation_id():
+    g.correlation_token = log.correlation_id.set(request.headers.get("X-Request-ID") or log.new_correlation_id())
+
+
+@app.after_request
+def add_correlation_header(response):
+    response.headers["X-Request-ID"] = log.correlation_id.get()
+    return response
+
+
+@app.teardown_request
+def reset_correlation_id(exc=None):
+    token = g.pop("correlation_token", None)
+    if token is not None:
+        log.correlation_id.reset(token)
+
 
 # アップロード可能なファイル形式をチェック
 def allowed_file(filename):
@@ -23,104 +86,332 @@ def generate_filename(original_filename):
     return f"{timestamp}_{secure_filename(original_filename)}"
 
 
+# JSONでの応答が要求されているか
+def wants_json():
+    return request.accept_mimetypes.best == "application/json"
+
+
 # トップページを表示
 @app.route("/")
 def index():
-    # アップロードディレクトリ内のExcelファイルを取得
-    excel_files = []
-    if os.path.exists(EXCEL_FOLDER):
-        excel_files = [f for f in os.listdir(EXCEL_FOLDER) if f.endswith(".xlsx")]
-    return render_template("index.html", excel_files=excel_files)
+    # 台帳に行があるExcelファイルを取得
+    return render_template("index.html", excel_files=ledger.list_workbooks())
 
 
 # ファイルアップロード処理
 @app.route("/upload", methods=["POST"])
 def upload_file():
     """
-    1. 複数ファイルの受信・検証
-    2. OCR処理
-    3. データ抽出
-    4. Excel生成
-    5. 結果表示（ダウンロードボタン付き）
+    1. 複数ファイルの受信・検証（内容はメモリ上に読み込み、保管が有効な場合のみ保存する）
+    2. ジョブの登録（OCR処理・データ抽出・Excel生成はバックグラウンドワーカーで実行）
+    3. ジョブIDを返す（進捗は /jobs/<job_id> で確認）
     """
     try:
         # アップロードフォルダが存在しない場合は作成
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        if UPLOAD_ARCHIVE_ENABLED:
+            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
         os.makedirs(EXCEL_FOLDER, exist_ok=True)
 
         # 1. ファイルの受信・検証
         if "receipts" not in request.files:
-            flash("ファイルが選択されていません")
-            return redirect(url_for("index"))
+            return upload_error("ファイルが選択されていません")
 
         files = request.files.getlist("receipts")
         if not files or files[0].filename == "":
-            flash("ファイルが選択されていません")
-            return redirect(url_for("index"))
+            return upload_error("ファイルが選択されていません")
 
         # 既存のExcelファイルの選択を確認
-        excel_file = request.form.get("excel_file", "")
-        if not excel_file:
-            # 新規Excelファイルの場合、既存のファイルを全て削除
-            for f in os.listdir(EXCEL_FOLDER):
-                if f.endswith(".xlsx"):
-                    os.remove(os.path.join(EXCEL_FOLDER, f))
-            # 新しいファイル名を生成
-            excel_file = f"領収書データ_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-
-        excel_path = os.path.join(EXCEL_FOLDER, excel_file)
-
-        # 処理結果を格納するリスト
-        all_results = []
+        excel_file = selected_excel_file()
+        if excel_file is None:
+            return upload_error("Excelファイル名が正しくありません")
 
-        # 各ファイルを処理
+        # 各ファイルの内容を読み込む（ワーカーはこのバイト列を直接デコードする）
+        saved_files = []
         for file in files:
             if not allowed_file(file.filename):
                 flash(f"許可されていないファイル形式です: {file.filename}")
                 continue
 
-            # ファイルの保存
-            filename = generate_filename(file.filename)
-            filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-            print(f"ファイルを保存しました: {filepath}")
-            file.save(filepath)
-
-            # OCR処理とデータ抽出
-            result = ocr.main(filepath)
-            if result:
-                if isinstance(result, list):
-                    all_results.extend(result)  # PDFの場合は複数ページの結果
-                else:
-                    all_results.append(result)
-
-        if not all_results:
-            flash("処理可能な結果がありませんでした")
-            return redirect(url_for("index"))
+            content = file.read()
+            filepath = None
+            if UPLOAD_ARCHIVE_ENABLED:
+                filepath = os.path.join(app.config["UPLOAD_FOLDER"], generate_filename(file.filename))
+                with open(filepath, "wb") as f:
+                    f.write(content)
+                logger.info(f"ファイルを保存しました: {filepath}")
+            saved_files.append((file.filename, filepath, content))
+
+        if not saved_files:
+            return upload_error("処理可能なファイルがありませんでした")
 
-        # Excel生成
-        if excel.create_excel_receipt(all_results, excel_path):
-            flash(f"OCR処理が完了しました。Excelファイルをダウンロードできます。")
+        # 2. ジョブの登録
+        job_id = jobs.enqueue_job(excel_file, saved_files, job_options())
 
+        # 3. ジョブIDを返す
+        if wants_json():
+            return jsonify({"job_id": job_id, "status_url": url_for("job_status", job_id=job_id)}), 202
+        flash(f"{len(saved_files)}件のファイルを受け付けました。ジョブID: {job_id}")
         return redirect(url_for("index"))
 
+    except RequestEntityTooLarge:
+        # 上限を超えたアップロードはフォームの読み込み時に例外になる
+        return upload_error("ファイルサイズが上限を超えています", 413)
+    except TimeoutError:
+        # ワーカーの処理が進まず、ファイルの登録を待ちきれなかった
+        return backlog_error()
     except Exception as e:
-        print(f"エラーが発生しました: {str(e)}")
-        flash("処理中にエラーが発生しました")
+        logger.exception(f"エラーが発生しました: {str(e)}")
+        return upload_error("処理中にエラーが発生しました", 500)
+
+
+# 一括取り込み（ZIPファイル）
+@app.route("/bulk", methods=["POST"])
+def bulk_upload():
+    """
+    ZIPファイル内の画像・PDFを1つのジョブとして登録する
+    ZIPファイルは展開せずに1ファイルずつ読み込んでジョブキューに登録し、処理できないファイルは読み飛ばす
+    （読み飛ばしたファイルと理由は応答の skipped に入る。進捗は /jobs/<job_id> の progress で確認）
+    """
+    # 通常のアップロードより大きいサイズを許容する
+    request.max_content_length = BULK_MAX_CONTENT_LENGTH
+    try:
+        archive = request.files.get("archive")
+        if archive is None or archive.filename == "":
+            return upload_error("ZIPファイルが選択されていません")
+        if not archive.filename.lower().endswith(".zip"):
+            return upload_error("ZIPファイルを選択してください")
+
+        excel_file = selected_excel_file()
+        if excel_file is None:
+            return upload_error("Excelファイル名が正しくありません")
+
+        # 未処理のファイルが多い場合は受け付けずに再送を促す
+        if jobs.is_backlogged():
+            return backlog_error()
+
+        try:
+            job_id, count, skipped = bulk.enqueue_archive(archive.stream, excel_file, job_options())
+        except ValueError as e:
+            return upload_error(str(e))
+
+        skipped = [{"filename": name, "error": reason} for name, reason in skipped]
+        if job_id is None:
+            if wants_json():
+                return jsonify({"error": "処理可能なファイルがありませんでした", "skipped": skipped}), 400
+            flash("処理可能なファイルがありませんでした")
+            return redirect(url_for("index"))
+
+        if wants_json():
+            return (
+                jsonify(
+                    {
+                        "job_id": job_id,
+                        "status_url": url_for("job_status", job_id=job_id),
+                        "accepted": count,
+                        "skipped": skipped,
+                    }
+                ),
+                202,
+            )
+        flash(f"{count}件のファイルを受け付けました（読み飛ばし: {len(skipped)}件）。ジョブID: {job_id}")
         return redirect(url_for("index"))
 
+    except RequestEntityTooLarge:
+        # 上限を超えたアップロードはフォームの読み込み時に例外になる
+        return upload_error("ファイルサイズが上限を超えています", 413)
+    except TimeoutError:
+        # ワーカーの処理が進まず、ファイルの登録を待ちきれなかった
+        return backlog_error()
+    except Exception as e:
+        logger.exception(f"エラーが発生しました: {str(e)}")
+        return upload_error("処理中にエラーが発生しました", 500)
 
-# Excelファイルのダウンロード
+
+def selected_excel_file():
+    """フォームで選択されたExcelファイル名（未選択の場合は新しいファイル名、不正な場合はNone）"""
+    excel_file = request.form.get("excel_file", "")
+    if not excel_file:
+        # 新しいファイル名を生成（既存のファイルの行は台帳に残る）
+        return f"領収書データ_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    if os.path.basename(excel_file) != excel_file or not excel_file.endswith(".xlsx"):
+        return None
+    return excel_file
+
+
+def job_options():
+    """
+    フォームで指定された処理オプション
+    bypass_cache: キャッシュを使わずに再抽出する / debug: 前処理の途中画像を保存する
+    """
+    return {
+        "bypass_cache": bool(request.form.get("bypass_cache")),
+        "debug": bool(request.form.get("debug")),
+    }
+
+
+def backlog_error():
+    """処理待ちのファイルが多い場合の応答（JSONの場合は503とRetry-After）"""
+    message = "処理待ちのファイルが多いため、しばらくしてから再度お試しください"
+    if wants_json():
+        return jsonify({"error": message}), 503, {"Retry-After": str(BULK_RETRY_AFTER)}
+    flash(message)
+    return redirect(url_for("index"))
+
+
+def upload_error(message, status=400):
+    """アップロードエラーの応答（JSONまたはflash+リダイレクト）"""
+    if wants_json():
+        return jsonify({"error": message}), status
+    flash(message)
+    return redirect(url_for("index"))
+
+
+# ジョブの状態を取得
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+    return jsonify(job)
+
+
+# ジョブの進捗（Server-Sent Events）
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """
+    ジョブの進捗をServer-Sent Eventsで配信する
+    接続時に現在の状態（snapshot）を送り、その後はファイル・ページの段階（file）とジョブの状態（job）を
+    記録順に送る。ジョブが終了したイベントを送った時点で end を送って終了する
+    再接続時は Last-Event-ID（または after パラメータ）より後のイベントから送る（snapshotは送らない）
+    """
+    try:
+        after_id = int(request.headers.get("Last-Event-ID") or request.args.get("after") or 0)
+    except ValueError:
+        after_id = 0
+    # 新規の接続では、現在の状態より前のイベントは送らない（状態を取得する前に位置を決める）
+    last_id = after_id or jobs.last_event_id(job_id)
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません"}), 404
+
+    def stream():
+        nonlocal last_id
+        if not after_id:
+            yield sse_message("snapshot", job, last_id or None)
+        # 終了済みのジョブは、残りのイベントを送った時点で終了する
+        finished = job["status"] in (jobs.STATUS_DONE, jobs.STATUS_FAILED)
+        last_sent = time.monotonic()
+        while True:
+            events = jobs.get_events(job_id, last_id)
+            for event in events:
+                last_id = event["id"]
+                yield sse_message(event["type"], event["data"], event["id"])
+                if event["type"] == "job" and event["data"].get("status") in (jobs.STATUS_DONE, jobs.STATUS_FAILED):
+                    finished = True
+            if events:
+                last_sent = time.monotonic()
+                continue
+            if finished:
+                yield sse_message("end", {"status": jobs.get_job(job_id)["status"]})
+                return
+            # プロキシ等に接続を切られないよう、イベントがない間も定期的にコメントを送る
+            if time.monotonic() - last_sent >= JOB_EVENT_KEEPALIVE:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(JOB_EVENT_POLL_INTERVAL)
+
+    return Response(
+        stream(),
+        content_type="text/event-stream; charset=utf-8",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def sse_message(event, data, event_id=None):
+    """Server-Sent Eventsの1件分のメッセージ"""
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+# 抽出結果キャッシュの統計
+@app.route("/cache/stats")
+def cache_stats():
+    return jsonify(cache.get_stats())
+
+
+# 処理時間・件数の計測値（Prometheusのテキスト形式）
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# Excelファイルのダウンロード（台帳に追加された行を反映してから送信する）
 @app.route("/download/<filename>")
 def download_file(filename):
     try:
+        if filename not in ledger.list_workbooks():
+            raise ValueError(f"台帳にないファイルです: {filename}")
+        os.makedirs(EXCEL_FOLDER, exist_ok=True)
+        with metrics.stage("excel"):
+            excel.sync_workbook(
+                os.path.join(EXCEL_FOLDER, filename), lambda after_id: ledger.fetch_rows(filename, after_id)
+            )
         return send_from_directory(EXCEL_FOLDER, filename, as_attachment=True)
     except Exception as e:
         flash(f"ダウンロードエラー: {str(e)}")
         return redirect(url_for("index"))
 
 
+# 重複として記録された行の一覧（workbookで絞り込み可能）
+@app.route("/duplicates")
+def duplicates():
+    return jsonify(ledger.find_duplicates(request.args.get("workbook") or None))
+
+
+# 条件を指定して台帳の行をExcelファイルに書き出す
+@app.route("/export")
+def export_file():
+    """
+    クエリパラメータ（いずれも省略可能）
+    workbook: Excelファイル名 / date_from, date_to: 発行日の範囲 / vendor: 支払先名（部分一致）
+    """
+    try:
+        rows = ledger.query(
+            workbook=request.args.get("workbook") or None,
+            date_from=request.args.get("date_from") or None,
+            date_to=request.args.get("date_to") or None,
+            vendor=request.args.get("vendor") or None,
+        )
+    except ValueError as e:
+        if wants_json():
+            return jsonify({"error": str(e)}), 400
+        flash(str(e))
+        return redirect(url_for("index"))
+
+    fd, export_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+
+    @after_this_request
+    def remove_export(response):
+        try:
+            os.remove(export_path)
+        except OSError:
+            pass
+        return response
+
+    with metrics.stage("excel"):
+        excel.write_workbook(rows, export_path)
+    download_name = f"領収書データ_抽出_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    return send_file(export_path, as_attachment=True, download_name=download_name)
+
+
 if __name__ == "__main__":
     # アップロードディレクトリの作成
     if not os.path.exists(UPLOAD_FOLDER):
         os.makedirs(UPLOAD_FOLDER)
+    # デバッグモードの自動再読み込みでは、ファイルを監視する親プロセスではなくサーバーのプロセスで起動する
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background()
     app.run(debug=True)
@@ -0,0 +1,78 @@
+"""
+前処理の傾き推定方式ごとの処理時間・ピークメモリ・推定誤差を比較する
+
+合成した領収書画像（白地に文字、既知の角度で回転）を解像度を変えて生成し、
+ocr.SKEW_ESTIMATORS の各方式で傾きを推定する。時間とピークメモリは1メガピクセルあたりで報告する。
+
+使用方法:
+    python -m benchmarks.bench_deskew --megapixels 2 6 12 --angle 4
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from utils import ocr
+
+
+def synthetic_receipt(megapixels, angle):
+    """指定した画素数の領収書画像を合成し、angle度回転させる"""
+    width = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    height = int(width * 4 / 3)
+    image = np.full((height, width), 250, np.uint8)
+    scale = width / 1000
+    for i in range(int(height / (60 * scale)) - 2):
+        cv2.putText(
+            image,
+            f"ITEM {i:03d}  TOTAL 1,280  2024/04/01",
+            (int(60 * scale), int((80 + i * 60) * scale)),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            scale,
+            30,
+            max(1, int(2 * scale)),
+        )
+    rot_mat = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(image, rot_mat, (width, height), borderValue=250)
+
+
+def measure(estimator, gray):
+    tracemalloc.start()
+    started = time.perf_counter()
+    angle = estimator(gray)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return angle, elapsed, peak
+
+
+def run(megapixels_list, angle, methods):
+    rows = []
+    for megapixels in megapixels_list:
+        gray = cv2.medianBlur(synthetic_receipt(megapixels, angle), 3)
+        actual_mp = gray.size / 1e6
+        for method in methods:
+            estimated, elapsed, peak = measure(ocr.SKEW_ESTIMATORS[method], gray)
+            rows.append(
+                {
+                    "method": method,
+                    "megapixels": round(actual_mp, 2),
+                    "sec_per_mp": round(elapsed / actual_mp, 5),
+                    "peak_mb_per_mp": round(peak / 1e6 / actual_mp, 3),
+                    # 補正角度は回転角の符号を反転したものが正解
+                    "estimated_angle": round(float(estimated), 2),
+                    "error_deg": round(abs(float(estimated) + angle), 2),
+                }
+            )
+    return {"angle": angle, "results": rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="傾き推定方式の比較")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[2, 6, 12])
+    parser.add_argument("--angle", type=float, default=4.0, help="合成画像の回転角度（度）")
+    parser.add_argument("--methods", nargs="+", default=list(ocr.SKEW_ESTIMATORS))
+    args = parser.parse_args()
+    print(json.dumps(run(args.megapixels, args.angle, args.methods), ensure_ascii=False, indent=2))
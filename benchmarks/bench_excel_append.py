@@ -0,0 +1,105 @@
+"""
+既存のブックへの行の追加にかかる時間を、既存の行数ごとに比較する
+
+- legacy: ブック全体を読み込み（load_workbook）、行を追加して全セルから列幅を再計算して保存（従来の方式）
+- incremental: excel.sync_workbook（台帳に追加された行だけを、追記用の情報を使ってワークシートのXMLの末尾に書き足す）
+
+既存の行数ごとに、追加1回あたりの時間（batch件をまとめて追加）を報告する。
+
+使用方法:
+    python -m benchmarks.bench_excel_append --rows 1000 10000 100000 --batch 10 --repeat 3
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from openpyxl import load_workbook
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+
+from utils import excel
+
+
+def receipts(count, offset=0):
+    return [
+        {
+            "発行日": f"2024/{(i % 12) + 1:02d}/{(i % 28) + 1:02d}",
+            "支払先名": f"株式会社サンプル{(offset + i) % 500}",
+            "金額": str(100 + (offset + i) * 7 % 100000),
+            "インボイス番号": f"T{1000000000000 + offset + i}",
+        }
+        for i in range(count)
+    ]
+
+
+def legacy_append(data, output_path):
+    """従来の Excel への追加と同じ処理（既存のブックを読み込み、行を追加して保存）"""
+    wb = load_workbook(output_path)
+    ws = wb.active
+    last_row = ws.max_row
+    start_id = ws.cell(row=last_row, column=1).value + 1 if last_row > 1 else 1
+    alignment = Alignment(horizontal="left")
+    current_row = ws.max_row + 1
+    for item in data:
+        ws.cell(row=current_row, column=1, value=start_id).alignment = alignment
+        for col, field in enumerate(excel.FIELDS, 2):
+            ws.cell(row=current_row, column=col, value=item.get(field, "")).alignment = alignment
+        start_id += 1
+        current_row += 1
+    for col in range(1, 6):
+        column = get_column_letter(col)
+        max_length = max(len(str(cell.value)) for cell in ws[column])
+        ws.column_dimensions[column].width = max_length + 2
+    wb.save(output_path)
+
+
+def sync_append(data, output_path):
+    """台帳に data の行が追加された状態でブックに反映する（ダウンロード時の処理）"""
+    excel.sync_workbook(output_path, lambda position: (data, position + len(data)))
+
+
+def measure(append, base_path, folder, batch, repeat):
+    path = os.path.join(folder, "target.xlsx")
+    shutil.copy(base_path, path)
+    if os.path.exists(excel.meta_path(base_path)):
+        shutil.copy(excel.meta_path(base_path), excel.meta_path(path))
+        # コピーで更新日時が変わるため、追記用の情報をコピー後のファイルに合わせる
+        excel.save_meta(path, excel.load_meta(base_path) or {})
+    elapsed = []
+    for i in range(repeat):
+        data = receipts(batch, offset=i * batch)
+        started = time.perf_counter()
+        append(data, path)
+        elapsed.append(time.perf_counter() - started)
+    return sum(elapsed) / len(elapsed)
+
+
+def run(row_counts, batch, repeat, skip_legacy_above):
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in row_counts:
+            base_path = os.path.join(folder, f"base_{rows}.xlsx")
+            excel.sync_workbook(base_path, lambda position: (receipts(rows), rows))
+            entry = {"existing_rows": rows, "batch": batch, "file_mb": round(os.path.getsize(base_path) / 1e6, 2)}
+            entry["incremental_sec"] = round(measure(sync_append, base_path, folder, batch, repeat), 4)
+            if skip_legacy_above is None or rows <= skip_legacy_above:
+                entry["legacy_sec"] = round(measure(legacy_append, base_path, folder, batch, repeat), 4)
+                entry["speedup"] = round(entry["legacy_sec"] / entry["incremental_sec"], 1)
+            results.append(entry)
+    return {"results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Excelへの追記の比較")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000], help="既存の行数")
+    parser.add_argument("--batch", type=int, default=10, help="1回に追加する行数")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-legacy-above", type=int, help="この行数を超える場合は従来の方式を計測しない")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    print(json.dumps(run(args.rows, args.batch, args.repeat, args.skip_legacy_above), ensure_ascii=False, indent=2))
@@ -0,0 +1,133 @@
+"""
+GeminiDispatcherの持続スループットをスタブサーバーに対して計測する
+
+--processes を指定すると、複数のプロセスがそれぞれのディスパッチャーから同じスタブサーバーへ送信する。
+レート制限のトークンは一時的なDBで共有するため（--per-process の場合はプロセスごと）、
+全プロセスの合計のスループットが --rate-per-minute に収まるかを確認できる。
+
+使用方法:
+    python -m benchmarks.bench_gemini_dispatcher --requests 200 --rate-per-minute 1200 --quota 20
+    python -m benchmarks.bench_gemini_dispatcher --requests 200 --rate-per-minute 600 --processes 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from benchmarks.gemini_stub_server import start_server
+from utils.gemini import GeminiDispatcher, GeminiUnavailableError
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_sender(url):
+    """スタブサーバーへPOSTする send 関数を作成"""
+
+    def send(timeout):
+        request = urllib.request.Request(url, data=b"{}", headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+
+    return send
+
+
+def dispatch_requests(url, args, count, rate_db_path):
+    """1つのディスパッチャーから count 件送信し、(経過秒数, レイテンシ, 失敗数, 統計) を返す"""
+    dispatcher = GeminiDispatcher(
+        rate_per_minute=args.rate_per_minute,
+        burst=args.burst,
+        max_concurrency=args.concurrency,
+        max_retries=args.max_retries,
+        backoff_base=args.backoff_base,
+        deadline=args.deadline,
+        rate_db_path=rate_db_path,
+    )
+    send = make_sender(url)
+
+    latencies = []
+    failures = 0
+    started = time.perf_counter()
+
+    def timed_submit():
+        submitted = time.perf_counter()
+        future = dispatcher.submit(send)
+        future.add_done_callback(lambda f: latencies.append(time.perf_counter() - submitted))
+        return future
+
+    futures = [timed_submit() for _ in range(count)]
+    wait(futures)
+    elapsed = time.perf_counter() - started
+    for future in futures:
+        if isinstance(future.exception(), GeminiUnavailableError):
+            failures += 1
+
+    dispatcher.close()
+    return elapsed, latencies, failures, dispatcher.stats
+
+
+def run(args):
+    server, state = start_server(quota=args.quota, latency=args.latency, error_rate=args.error_rate)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    counts = [args.requests // args.processes + (1 if i < args.requests % args.processes else 0) for i in range(args.processes)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        rate_db_path = "" if args.per_process else os.path.join(folder, "rate.sqlite3")
+        if args.processes == 1:
+            outcomes = [dispatch_requests(url, args, counts[0], rate_db_path)]
+        else:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=args.processes, mp_context=context) as pool:
+                futures = [pool.submit(dispatch_requests, url, args, count, rate_db_path) for count in counts]
+                outcomes = [future.result() for future in futures]
+    server.shutdown()
+
+    # プロセスの起動時間を含めないよう、送信にかかった時間が最も長いプロセスの時間を使う
+    elapsed = max(process_elapsed for process_elapsed, _, _, _ in outcomes)
+
+    latencies = [latency for _, process_latencies, _, _ in outcomes for latency in process_latencies]
+    failures = sum(process_failures for _, _, process_failures, _ in outcomes)
+    stats = {}
+    for _, _, _, process_stats in outcomes:
+        for name, value in process_stats.items():
+            stats[name] = stats.get(name, 0) + value
+
+    return {
+        "requests": args.requests,
+        "processes": args.processes,
+        "shared_rate_limit": not args.per_process,
+        "elapsed_sec": round(elapsed, 3),
+        "throughput_rps": round((args.requests - failures) / elapsed, 2),
+        # 初回のバースト分を除いた、全プロセス合計の送信レート（1分あたり）
+        "sent_per_minute": round(max(0, stats.get("requests", 0) + stats.get("retries", 0) - args.burst) / elapsed * 60, 1),
+        "latency_p50_sec": round(percentile(latencies, 50), 3),
+        "latency_p95_sec": round(percentile(latencies, 95), 3),
+        "failures": failures,
+        "dispatcher": stats,
+        "server": state.counts,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GeminiDispatcherのスループット計測")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rate-per-minute", type=float, default=1200)
+    parser.add_argument("--burst", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--backoff-base", type=float, default=0.2)
+    parser.add_argument("--deadline", type=float, default=60)
+    parser.add_argument("--quota", type=int, default=20, help="スタブサーバーの1秒あたりのクォータ")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--processes", type=int, default=1, help="送信するプロセス数")
+    parser.add_argument("--per-process", action="store_true", help="レート制限をプロセス間で共有しない")
+    print(json.dumps(run(parser.parse_args()), ensure_ascii=False, indent=2))
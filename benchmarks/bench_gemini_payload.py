@@ -0,0 +1,106 @@
+"""
+Geminiへ送信する画像ペイロードのサイズと送信レイテンシを比較する
+
+- original: 元の画像ファイルをそのまま送信（従来の Image.open 相当）
+- prepared: gemini.prepare_image_payload で縮小・グレースケール化・切り出し・JPEG化
+
+GEMINI_API_KEY が設定されている場合は実際のAPIで、未設定の場合はローカルのスタブサーバーへの
+送信でレイテンシを計測する。画像を指定しない場合は合成したスマートフォン写真相当の画像を使用する。
+
+使用方法:
+    python -m benchmarks.bench_gemini_payload [画像ファイル ...] [--repeat 3]
+"""
+import argparse
+import json
+import os
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+
+from benchmarks.gemini_stub_server import start_server
+from utils import gemini
+
+
+def synthetic_photo(width=4032, height=3024):
+    """机の上に置いた領収書を撮影したような12メガピクセルの画像を合成"""
+    rng = np.random.default_rng(0)
+    image = rng.integers(60, 110, size=(height, width, 3), dtype=np.uint8)
+    image = cv2.GaussianBlur(image, (31, 31), 0)
+    x0, y0, x1, y1 = width // 3, height // 8, width * 2 // 3, height * 7 // 8
+    cv2.rectangle(image, (x0, y0), (x1, y1), (245, 245, 240), -1)
+    for i, line in enumerate(["RECEIPT", "2024/04/01", "SAMPLE STORE", "TOTAL 1,280", "T1234567890123"]):
+        cv2.putText(image, line, (x0 + 80, y0 + 250 + i * 220), cv2.FONT_HERSHEY_SIMPLEX, 4, (20, 20, 20), 8)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return encoded.tobytes()
+
+
+def measure_send(send, payload, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        send(payload)
+        latencies.append(time.perf_counter() - started)
+    return sum(latencies) / len(latencies)
+
+
+def make_sender():
+    """実際のAPI（キーがある場合）またはスタブサーバーへ送信する関数を作成"""
+    if os.getenv("GEMINI_API_KEY"):
+        def send(payload):
+            gemini.generate_content(["この領収書の合計金額を数値のみで返してください。", payload])
+
+        return send, "gemini"
+
+    server, _ = start_server(quota=10000, latency=0.0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    def send(payload):
+        request = urllib.request.Request(url, data=payload["data"], headers={"Content-Type": payload["mime_type"]})
+        with urllib.request.urlopen(request) as response:
+            response.read()
+
+    return send, "stub"
+
+
+def run(paths, repeat):
+    if paths:
+        sources = [(path, open(path, "rb").read()) for path in paths]
+    else:
+        sources = [("synthetic_12mp.jpg", synthetic_photo())]
+
+    send, target = make_sender()
+    report = {"target": target, "images": []}
+    for name, data in sources:
+        original = {"mime_type": "image/jpeg" if name.lower().endswith((".jpg", ".jpeg")) else "image/png", "data": data}
+
+        started = time.perf_counter()
+        prepared = gemini.prepare_image_payload(data)
+        prepare_sec = time.perf_counter() - started
+
+        started = time.perf_counter()
+        gemini.prepare_image_payload(data)
+        cached_sec = time.perf_counter() - started
+
+        report["images"].append(
+            {
+                "image": name,
+                "original_bytes": len(original["data"]),
+                "prepared_bytes": len(prepared["data"]),
+                "reduction": round(1 - len(prepared["data"]) / len(original["data"]), 3),
+                "prepare_sec": round(prepare_sec, 4),
+                "prepare_cached_sec": round(cached_sec, 6),
+                "send_original_sec": round(measure_send(send, original, repeat), 4),
+                "send_prepared_sec": round(measure_send(send, prepared, repeat), 4),
+            }
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gemini送信画像のペイロード比較")
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(run(args.images, args.repeat), ensure_ascii=False, indent=2))
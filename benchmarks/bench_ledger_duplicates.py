@@ -0,0 +1,123 @@
+"""
+台帳への追加時の重複判定を、台帳の既存の行数ごとに計測する
+
+- bulk_load: 既存の行をまとめて追加した際のスループット（重複判定を含む）
+- insert: batch件の追加1回あたりの時間（半数は表記を変えた既存の領収書の重複）と重複の検出率
+- lookup_indexed / lookup_scan: 重複キー1件の検索時間（索引あり / 索引を使わず全件走査した場合）
+- rebuild: ledger.rebuild_duplicates で台帳全体の重複の索引を作り直す時間
+
+使用方法:
+    python -m benchmarks.bench_ledger_duplicates --rows 10000 100000 300000 --batch 20
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from benchmarks.bench_excel_append import receipts
+from utils import ledger
+
+# 同じ領収書を別の表記で読み取った場合（全角数字・桁区切り・会社形態の略記など）
+_FULLWIDTH = str.maketrans("0123456789", "０１２３４５６７８９")
+
+
+def variant(result, rng):
+    """表記だけが異なる同じ領収書の抽出結果"""
+    date = result["発行日"]
+    amount = int(result["金額"])
+    vendor = result["支払先名"]
+    choice = rng.randrange(4)
+    if choice == 0:
+        date = date.translate(_FULLWIDTH)
+    elif choice == 1:
+        amount = f"¥{amount:,}"
+    elif choice == 2:
+        vendor = vendor.replace("株式会社", "(株)")
+    else:
+        year, month, day = date.split("/")
+        date = f"{year}-{int(month)}-{int(day)}"
+    return {"発行日": date, "支払先名": vendor, "金額": str(amount), "インボイス番号": result["インボイス番号"]}
+
+
+def entries(data, prefix):
+    return [{"key": f"{prefix}:{i}", "result": result} for i, result in enumerate(data)]
+
+
+def use_database(path):
+    """台帳の保存先を切り替える"""
+    ledger.LEDGER_DB_PATH = path
+    ledger._initialized_pid = None
+
+
+def measure_lookup(path, keys, scan):
+    conn = sqlite3.connect(path)
+    try:
+        sql = "SELECT id FROM receipts {} WHERE dup_key = ? ORDER BY id LIMIT 1".format("NOT INDEXED" if scan else "")
+        started = time.perf_counter()
+        for key in keys:
+            conn.execute(sql, (key,)).fetchone()
+        return (time.perf_counter() - started) / len(keys)
+    finally:
+        conn.close()
+
+
+def run(row_counts, batch, repeat, chunk, seed):
+    rng = random.Random(seed)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in row_counts:
+            path = os.path.join(folder, f"ledger_{rows}.sqlite3")
+            use_database(path)
+            history = receipts(rows)
+
+            started = time.perf_counter()
+            for start in range(0, rows, chunk):
+                ledger.add_receipts("history.xlsx", entries(history[start : start + chunk], f"history:{start}"))
+            load_sec = time.perf_counter() - started
+
+            elapsed, detected, expected = [], 0, 0
+            for i in range(repeat):
+                fresh = receipts(batch - batch // 2, offset=rows + i * batch)
+                repeated = [variant(rng.choice(history), rng) for _ in range(batch // 2)]
+                started = time.perf_counter()
+                _, duplicates = ledger.add_receipts("new.xlsx", entries(fresh + repeated, f"new:{i}"))
+                elapsed.append(time.perf_counter() - started)
+                detected += len(duplicates)
+                expected += len(repeated)
+
+            keys = [ledger.duplicate_key(rng.choice(history)) for _ in range(200)]
+            started = time.perf_counter()
+            flagged = ledger.rebuild_duplicates()
+            rebuild_sec = time.perf_counter() - started
+
+            results.append(
+                {
+                    "existing_rows": rows,
+                    "bulk_load_rows_per_sec": round(rows / load_sec),
+                    "insert_batch": batch,
+                    "insert_ms": round(sum(elapsed) / len(elapsed) * 1000, 3),
+                    "duplicates_detected": f"{detected}/{expected}",
+                    "lookup_indexed_us": round(measure_lookup(path, keys, False) * 1e6, 2),
+                    "lookup_scan_us": round(measure_lookup(path, keys[:20], True) * 1e6, 2),
+                    "rebuild_sec": round(rebuild_sec, 3),
+                    "rebuild_flagged": flagged,
+                }
+            )
+    return {"results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="台帳の重複判定の計測")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 300000], help="台帳の既存の行数")
+    parser.add_argument("--batch", type=int, default=20, help="1回に追加する行数（半数は重複）")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--chunk", type=int, default=10000, help="既存の行を追加する際の1回の行数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    print(json.dumps(run(args.rows, args.batch, args.repeat, args.chunk, args.seed), ensure_ascii=False, indent=2))
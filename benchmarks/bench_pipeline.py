@@ -0,0 +1,291 @@
+"""
+合成した領収書でOCRパイプラインの各段階を計測する
+
+- preprocess: ocr.preprocess_image
+- extract: extract.extract_fields（OCR結果相当のテキストから抽出。項目ごとの正解率も計測）
+- process_image: ocr.process_image（GeminiはAPIを呼ばずに正解を返すスタブに置き換える。
+  Geminiで再抽出した項目の範囲も記録する）
+- process_pdf: ocr.process_pdf（複数ページのPDF。popplerがない場合は省略）
+- excel: excel.sync_workbook（台帳の行からブックを作成）
+
+段階ごとに処理件数・スループット・レイテンシ（p50/p90/p99）・ピークメモリ・項目ごとの正解率を
+JSONで出力する。コミット間で結果を比較できるよう、実行したコミットと条件も含める。
+
+Tesseractがインストールされていない場合（または --tesseract simulated の場合）は、
+Tesseractの代わりに誤認識を加えた正解のテキストを返す（結果の "tesseract" に記録される）。
+
+使用方法:
+    python -m benchmarks.bench_pipeline --count 50 --output bench_results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import random
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+from benchmarks import synthetic
+from utils import excel, extract, gemini, metrics, ocr, tesseract
+
+FIELDS = extract.FIELDS
+# 支払先名の比較で無視する会社形態など
+COMPANY_AFFIXES = ("株式会社", "有限会社", "合同会社", "事務所", "御中", "様")
+
+
+def normalize(field, value):
+    """項目の値を比較用に正規化"""
+    value = str(value or "").replace(" ", "").replace("　", "")
+    if field == "支払先名":
+        for affix in COMPANY_AFFIXES:
+            value = value.replace(affix, "")
+    if field == "金額":
+        value = value.replace(",", "").replace("¥", "").replace("円", "")
+    return value
+
+
+def accuracy(pairs):
+    """(正解, 結果) のリストから項目ごとの正解率を計算"""
+    if not pairs:
+        return None
+    scores = {}
+    for field in FIELDS:
+        correct = sum(
+            1 for truth, result in pairs if result and normalize(field, truth[field]) == normalize(field, result.get(field))
+        )
+        scores[field] = round(correct / len(pairs), 4)
+    return scores
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(latencies, items=None, peak=None, pairs=None):
+    """レイテンシのリストなどから段階ごとの結果を作成"""
+    total = sum(latencies)
+    items = items or len(latencies)
+    summary = {
+        "count": len(latencies),
+        "items": items,
+        "throughput_per_sec": round(items / total, 3) if total else None,
+        "latency_ms": {
+            "mean": round(total / len(latencies) * 1000, 3),
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p90": round(percentile(latencies, 90) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+        },
+        "peak_memory_mb": round(peak / 1e6, 3) if peak is not None else None,
+    }
+    if pairs is not None:
+        summary["accuracy"] = accuracy(pairs)
+    return summary
+
+
+def run_timed(func, inputs):
+    """各入力に対してfuncを実行し、(結果のリスト, レイテンシのリスト) を返す"""
+    results, latencies = [], []
+    for item in inputs:
+        started = time.perf_counter()
+        results.append(func(item))
+        latencies.append(time.perf_counter() - started)
+    return results, latencies
+
+
+def peak_memory(func, inputs):
+    """funcを実行した際のPythonのピークメモリ（バイト）。計測の影響を避けるため少数の入力で別に計測する"""
+    tracemalloc.start()
+    try:
+        for item in inputs:
+            func(item)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+@contextmanager
+def stubbed_pipeline(receipts, simulate_tesseract, gemini_latency, error_rate, seed):
+    """
+    Gemini（および必要に応じてTesseract）をスタブに置き換える
+    処理中の領収書は current["index"] で指定する
+    """
+    current = {"index": 0}
+    rng = random.Random(seed)
+    originals = (gemini.get_model, gemini.generate_content, tesseract.image_to_data)
+
+    def generate_content(contents, model_name=None, deadline=None):
+        if gemini_latency:
+            time.sleep(gemini_latency)
+        truth = receipts[current["index"]]["truth"]
+        return StubResponse("```json\n" + json.dumps(truth, ensure_ascii=False) + "\n```")
+
+    def image_to_data(image, lang="jpn"):
+        return synthetic.ocr_data(receipts[current["index"]]["lines"], rng, error_rate)
+
+    gemini.get_model = lambda model_name=None: object()
+    gemini.generate_content = generate_content
+    if simulate_tesseract:
+        tesseract.image_to_data = image_to_data
+    try:
+        yield current
+    finally:
+        gemini.get_model, gemini.generate_content, tesseract.image_to_data = originals
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(count, width, pdf_pages, tesseract_mode, gemini_latency, error_rate, memory_samples, seed):
+    receipts = synthetic.generate(count, seed, width=width)
+    images = [receipt["image"] for receipt in receipts]
+    samples = range(min(memory_samples, count))
+    results = {}
+
+    # 前処理
+    _, latencies = run_timed(ocr.preprocess_image, images)
+    peak = peak_memory(ocr.preprocess_image, [images[i] for i in samples])
+    results["preprocess"] = summarize(latencies, peak=peak)
+
+    # テキストからの項目抽出
+    rng = random.Random(seed)
+    texts = [synthetic.ocr_text(receipt["lines"], rng, error_rate) for receipt in receipts]
+    extracted, latencies = run_timed(extract.extract_fields, texts)
+    peak = peak_memory(extract.extract_fields, [texts[i] for i in samples])
+    pairs = [(receipt["truth"], result) for receipt, result in zip(receipts, extracted)]
+    results["extract"] = summarize(latencies, peak=peak, pairs=pairs)
+
+    simulate = tesseract_mode == "simulated" or (tesseract_mode == "auto" and not shutil.which("tesseract"))
+    with stubbed_pipeline(receipts, simulate, gemini_latency, error_rate, seed) as current:
+        # 画像1枚ずつの処理（前処理・Tesseract・項目抽出・必要に応じてGemini）
+        def process(i):
+            current["index"] = i
+            return ocr.process_image(images[i])
+
+        before = dict(metrics.RESOLUTIONS.values)
+        before_escalations = dict(metrics.ESCALATIONS.values)
+        processed, latencies = run_timed(process, range(count))
+        resolutions = {
+            source[0]: total - before.get(source, 0)
+            for source, total in metrics.RESOLUTIONS.values.items()
+            if total - before.get(source, 0)
+        }
+        escalations = {
+            scope[0]: total - before_escalations.get(scope, 0)
+            for scope, total in metrics.ESCALATIONS.values.items()
+            if total - before_escalations.get(scope, 0)
+        }
+        peak = peak_memory(process, samples)
+        pairs = [(receipt["truth"], result) for receipt, result in zip(receipts, processed)]
+        results["process_image"] = summarize(latencies, peak=peak, pairs=pairs)
+        # Tesseract・Geminiのどちらで結果を確定したか
+        results["process_image"]["resolutions"] = resolutions
+        # Geminiで再抽出した項目の範囲（none / partial / full）
+        results["process_image"]["escalations"] = escalations
+
+        # 複数ページのPDF（ページの変換にはpopplerが必要）
+        if pdf_pages and shutil.which("pdftoppm") and shutil.which("pdfinfo"):
+            with tempfile.TemporaryDirectory() as folder:
+                pdf_path = synthetic.write_pdf(os.path.join(folder, "receipts.pdf"), images[:pdf_pages])
+                # スタブは処理中のページの正解を返すため、ページの結果を確定するごとに位置を進める
+                # （合成したPDFはテキストレイヤーがないため、全ページを画像に変換して処理する）
+                original_resolve_result = ocr.resolve_result
+
+                def resolve_page(*args, **kwargs):
+                    try:
+                        return original_resolve_result(*args, **kwargs)
+                    finally:
+                        current["index"] += 1
+
+                ocr.resolve_result = resolve_page
+                try:
+                    current["index"] = 0
+                    started = time.perf_counter()
+                    pages = ocr.process_pdf(pdf_path) or []
+                    elapsed = time.perf_counter() - started
+                finally:
+                    ocr.resolve_result = original_resolve_result
+            pairs = list(zip([receipt["truth"] for receipt in receipts[:pdf_pages]], pages))
+            results["process_pdf"] = summarize([elapsed], items=pdf_pages, pairs=pairs)
+        else:
+            results["process_pdf"] = {"skipped": "popplerがインストールされていないか、--pdf-pages 0 が指定されました"}
+
+    # Excel出力（処理結果をまとめて1回で書き込む）
+    rows = [result for result in processed if result] or [receipt["truth"] for receipt in receipts]
+    with tempfile.TemporaryDirectory() as folder:
+        def write(i):
+            return excel.sync_workbook(os.path.join(folder, f"receipts_{i}.xlsx"), lambda position: (rows, len(rows)))
+
+        _, latencies = run_timed(write, range(3))
+        peak = peak_memory(write, [3])
+    results["excel"] = summarize(latencies, items=len(rows) * 3, peak=peak)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "count": count,
+            "width": width,
+            "pdf_pages": pdf_pages,
+            "gemini_latency": gemini_latency,
+            "ocr_error_rate": error_rate,
+            "seed": seed,
+        },
+        "tesseract": "simulated" if simulate else "real",
+        "japanese_font": synthetic.japanese_font_available(),
+        "stages": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCRパイプラインのベンチマーク（合成領収書）")
+    parser.add_argument("--count", type=int, default=20, help="生成する領収書の数")
+    parser.add_argument("--width", type=int, default=1000, help="領収書画像の幅（ピクセル）")
+    parser.add_argument("--pdf-pages", type=int, default=3, help="PDFのページ数（0で省略）")
+    parser.add_argument("--tesseract", choices=["auto", "real", "simulated"], default="auto")
+    parser.add_argument("--gemini-latency", type=float, default=0.0, help="Geminiスタブの応答時間（秒）")
+    parser.add_argument("--ocr-error-rate", type=float, default=0.02, help="OCR結果相当のテキストの誤認識率")
+    parser.add_argument("--memory-samples", type=int, default=3, help="ピークメモリの計測に使う件数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果のJSONを保存するファイル（省略時は標準出力）")
+    args = parser.parse_args()
+
+    # 計測中のログ出力を抑える
+    logging.getLogger().setLevel(logging.ERROR)
+    report = run(
+        args.count,
+        args.width,
+        args.pdf_pages,
+        args.tesseract,
+        args.gemini_latency,
+        args.ocr_error_rate,
+        args.memory_samples,
+        args.seed,
+    )
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
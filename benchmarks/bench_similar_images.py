@@ -0,0 +1,196 @@
+"""
+知覚ハッシュによる近似画像の検出の再利用率と検索時間を計測する
+
+合成した領収書を索引に登録し、同じ領収書の
+- JPEGで再圧縮した画像（品質60）
+- 撮り直した画像（回転・ノイズが異なり、解像度が0.9倍）
+で検索して、登録した結果を再利用できた割合（hit_rate）を計測する。索引にない領収書で検索して
+別の領収書の結果を返した割合（false_positive_rate）も計測する。索引にない領収書は
+- 内容の異なる領収書（unseen）
+- 同じ支払先・発行日・書式で金額だけが異なる領収書（same_template。ハッシュの距離が近くなりやすい）
+の2種類で、ハッシュの距離だけで判定した場合（hash_only）と、Tesseractで読み取った金額・発行日との照合
+（ocr.is_same_receipt）を加えた場合（confirmed）の両方を記録する。Tesseractの読み取り結果は
+誤認識を加えた正解のテキスト（--ocr-error-rate）で代用する。
+
+索引の件数は --entries まで埋める。合成画像の前処理には時間がかかるため、埋める分のハッシュは
+登録した領収書のハッシュの一部のビット（--filler-bits の範囲でランダム）を反転して作成する
+（同じ書式の別の領収書に相当し、区間の一致による候補の数も実際に近くなる）。
+
+使用方法:
+    python -m benchmarks.bench_similar_images --images 100 --entries 100000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+import cv2
+
+from benchmarks import synthetic
+from utils import cache, ocr, phash
+
+
+def ocr_result(receipt, rng, error_rate):
+    """Tesseractで読み取った結果に相当する抽出結果（誤認識を加えた正解のテキストから抽出）"""
+    text, confidences = synthetic.ocr_data(receipt["lines"], rng, error_rate)
+    return ocr.assess_fields(text, confidences)[0]
+
+
+def image_hash(image):
+    stages = {}
+    ocr.preprocess_image(image, stages=stages)
+    return phash.compute(stages["deskewed"])
+
+
+def jpeg(image, quality=60):
+    _, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def perturb(value, rng, low, high):
+    """ハッシュのランダムなビットを反転する"""
+    number = int(value, 16)
+    for bit in rng.sample(range(phash.HASH_SIZE * phash.HASH_SIZE), rng.randint(low, high)):
+        number ^= 1 << bit
+    return f"{number:0{len(value)}x}"
+
+
+def use_database(path):
+    """キャッシュの保存先を切り替える"""
+    cache.CACHE_DB_PATH = path
+    cache._initialized_pid = None
+
+
+def fill(hashes, count, rng, low, high):
+    """索引の件数を埋めるハッシュをまとめて登録する（put_similar と同じ列）"""
+    columns = ", ".join(f"b{i}" for i in range(phash.BANDS))
+    placeholders = ", ".join("?" * (phash.BANDS + 4))
+    rows = []
+    for _ in range(count):
+        value = perturb(rng.choice(hashes), rng, low, high)
+        rows.append([cache.PIPELINE_VERSION, value, json.dumps({"filler": True}), time.time()] + phash.bands(value))
+    conn = cache._connect()
+    try:
+        conn.execute("BEGIN")
+        conn.executemany(
+            f"INSERT INTO image_hashes (version, hash, result, created_at, {columns}) VALUES ({placeholders})", rows
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def lookup(value, latencies):
+    started = time.perf_counter()
+    result, _ = cache.find_similar(value)
+    latencies.append(time.perf_counter() - started)
+    return result
+
+
+def run(images, unseen, entries, filler_bits, seed, error_rate=0.02):
+    rng = random.Random(seed)
+    receipts = [synthetic.make_receipt(rng) for _ in range(images + unseen)]
+    variants = [synthetic.same_template(receipt, rng) for receipt in receipts[:images]]
+
+    # 索引に登録する画像と、同じ領収書の再圧縮・撮り直しの画像のハッシュ
+    started = time.perf_counter()
+    originals, recompressed, rephotographed = [], [], []
+    for receipt in receipts[:images]:
+        image = synthetic.render_image(receipt["lines"], rng)
+        originals.append(image_hash(image))
+        recompressed.append(image_hash(jpeg(image)))
+        rephotographed.append(image_hash(synthetic.render_image(receipt["lines"], rng, width=900)))
+    others = [image_hash(synthetic.render_image(receipt["lines"], rng)) for receipt in receipts[images:]]
+    templated = [image_hash(synthetic.render_image(variant["lines"], rng)) for variant in variants]
+    hash_ms = (time.perf_counter() - started) / (images * 4 + unseen) * 1000
+
+    # 距離の分布（同じ領収書 / 別の領収書）
+    same = [phash.distance(a, b) for a, b in zip(originals, recompressed)]
+    same += [phash.distance(a, b) for a, b in zip(originals, rephotographed)]
+    different = [phash.distance(a, b) for i, a in enumerate(originals) for b in originals[i + 1 :]]
+    same_template = [phash.distance(a, b) for a, b in zip(originals, templated)]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        use_database(os.path.join(folder, "cache.sqlite3"))
+        started = time.perf_counter()
+        for i, value in enumerate(originals):
+            cache.put_similar(value, dict(receipts[i]["truth"], index=i))
+        put_ms = (time.perf_counter() - started) / images * 1000
+        fill(originals, max(0, entries - images), rng, *filler_bits)
+
+        latencies = []
+        for name, queries in (("recompressed", recompressed), ("rephotographed", rephotographed)):
+            hits = confirmed = 0
+            for i, value in enumerate(queries):
+                found = lookup(value, latencies) or {}
+                if found.get("index") == i:
+                    hits += 1
+                    confirmed += ocr.is_same_receipt(found, ocr_result(receipts[i], rng, error_rate))
+            results[name] = {"hit_rate": {"hash_only": round(hits / images, 4), "confirmed": round(confirmed / images, 4)}}
+
+        negatives = (
+            ("unseen", others, receipts[images:]),
+            ("same_template", templated, variants),
+        )
+        for name, queries, truths in negatives:
+            false_positives = confirmed = 0
+            for value, receipt in zip(queries, truths):
+                found = lookup(value, latencies)
+                if found and not found.get("filler"):
+                    false_positives += 1
+                    confirmed += ocr.is_same_receipt(found, ocr_result(receipt, rng, error_rate))
+            results[name] = {
+                "false_positive_rate": {
+                    "hash_only": round(false_positives / max(1, len(queries)), 4),
+                    "confirmed": round(confirmed / max(1, len(queries)), 4),
+                }
+            }
+
+    return {
+        "parameters": {
+            "images": images,
+            "unseen": unseen,
+            "entries": max(entries, images),
+            "max_distance": cache.PHASH_MAX_DISTANCE,
+            "filler_bits": filler_bits,
+            "ocr_error_rate": error_rate,
+            "seed": seed,
+        },
+        "japanese_font": synthetic.japanese_font_available(),
+        "distance": {
+            "same_receipt": {"p50": percentile(same, 50), "p90": percentile(same, 90), "max": max(same)},
+            "different_receipts": {"min": min(different), "p1": percentile(different, 1)},
+            "same_template": {"min": min(same_template), "p50": percentile(same_template, 50)},
+        },
+        "results": results,
+        "hash_ms": round(hash_ms, 2),
+        "put_ms": round(put_ms, 3),
+        "lookup_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="知覚ハッシュによる近似画像の検出の計測")
+    parser.add_argument("--images", type=int, default=100, help="索引に登録する領収書の数")
+    parser.add_argument("--unseen", type=int, default=50, help="索引にない領収書の数（誤検出の計測用）")
+    parser.add_argument("--entries", type=int, default=100000, help="索引のハッシュの件数")
+    parser.add_argument("--filler-bits", type=int, nargs=2, default=[32, 96], help="埋める分のハッシュで反転するビット数の範囲")
+    parser.add_argument("--ocr-error-rate", type=float, default=0.02, help="照合に使う読み取り結果の誤認識率")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    report = run(args.images, args.unseen, args.entries, tuple(args.filler_bits), args.seed, args.ocr_error_rate)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,111 @@
+"""
+Gemini APIの代わりに使用するローカルのスタブサーバー
+
+- 1秒あたりのリクエスト数が quota を超えると 429 を返す
+- error_rate の確率で 503 を返す
+- latency 秒（±ジッター）待ってから固定の抽出結果（JSON）を返す
+
+使用方法:
+    python -m benchmarks.gemini_stub_server --port 8089 --quota 20 --latency 0.3
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESPONSE = {
+    "発行日": "2024/04/01",
+    "支払先名": "株式会社サンプル商店",
+    "金額": "1280",
+    "インボイス番号": "T1234567890123",
+}
+
+
+class StubState:
+    """スタブサーバーの設定と集計"""
+
+    def __init__(self, quota, latency, error_rate):
+        self.quota = quota
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.counts = {"ok": 0, "429": 0, "503": 0}
+
+    def admit(self):
+        """1秒単位のウィンドウでクォータを判定"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            return self.window_count <= self.quota
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(length)
+
+            if not state.admit():
+                state.count("429")
+                return self._reply(429, {"error": "RESOURCE_EXHAUSTED"})
+            if random.random() < state.error_rate:
+                state.count("503")
+                return self._reply(503, {"error": "UNAVAILABLE"})
+
+            time.sleep(max(0.0, random.gauss(state.latency, state.latency * 0.2)))
+            state.count("ok")
+            self._reply(200, {"text": json.dumps(RESPONSE, ensure_ascii=False)})
+
+        def do_GET(self):
+            # 集計結果の確認用
+            self._reply(200, dict(state.counts))
+
+        def _reply(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(port=0, quota=20, latency=0.3, error_rate=0.0):
+    """スタブサーバーを別スレッドで起動し、(server, state) を返す"""
+    state = StubState(quota, latency, error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gemini APIのスタブサーバー")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--quota", type=int, default=20, help="1秒あたりに受け付けるリクエスト数")
+    parser.add_argument("--latency", type=float, default=0.3, help="応答までの平均秒数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503を返す確率")
+    args = parser.parse_args()
+
+    server, _ = start_server(args.port, args.quota, args.latency, args.error_rate)
+    print(f"スタブサーバーを起動しました: http://127.0.0.1:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,210 @@
+"""
+ベンチマーク用の合成領収書の生成
+
+発行日・支払先名・金額・インボイス番号が既知の領収書を、画像（ノイズ・回転・ぼかし付き）、
+複数ページのPDF、OCR結果相当のテキスト（文字の誤認識付き）として生成する。
+
+日本語の描画には日本語フォントが必要。BENCH_FONT で指定するか、一般的な場所にある
+Noto Sans CJK / IPAフォント等を使用する。見つからない場合は欧文フォントで描画する
+（日本語は正しく描画されないため、画像からの抽出精度は参考値となる）。
+
+使用方法:
+    python -m benchmarks.synthetic --count 5 --output synthetic_receipts
+"""
+import argparse
+import json
+import os
+import random
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf",
+    "/usr/share/fonts/truetype/takao-gothic/TakaoGothic.ttf",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+    "C:/Windows/Fonts/msgothic.ttc",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+]
+
+COMPANY_NAMES = ["サンプル商事", "テスト食堂", "みどり文具", "東京トレーディング", "さくら薬局", "ひかり電機"]
+COMPANY_FORMS = ["株式会社{}", "{}株式会社", "有限会社{}", "合同会社{}"]
+ITEMS = ["コーヒー", "サンドイッチ", "ボールペン", "コピー用紙", "乾電池", "ノート", "お弁当", "緑茶"]
+
+# OCRで誤認識されやすい文字の組み合わせ
+CONFUSIONS = {"0": "O", "1": "l", "5": "S", "8": "B", ",": ".", "年": "牢", "日": "目", "合": "会"}
+
+
+def find_font(size):
+    """日本語を描画できるフォントを探す（見つからない場合は欧文フォント・既定のフォント）"""
+    candidates = [os.getenv("BENCH_FONT")] + FONT_CANDIDATES
+    for path in candidates:
+        if path and os.path.exists(path):
+            return ImageFont.truetype(path, size), path
+    return ImageFont.load_default(), None
+
+
+def japanese_font_available():
+    _, path = find_font(10)
+    return path is not None and "DejaVu" not in path
+
+
+def _date_text(rng, year, month, day):
+    style = rng.randrange(3)
+    if style == 0:
+        return f"{year}年{month}月{day}日"
+    if style == 1:
+        return f"{year}/{month:02d}/{day:02d}"
+    return f"令和{year - 2018}年{month}月{day}日"
+
+
+def make_receipt(rng):
+    """
+    1件分の領収書の内容を生成
+
+    Returns:
+    {"truth": 正解の各項目, "lines": 印字される行のリスト}
+    """
+    year, month, day = rng.randint(2019, 2025), rng.randint(1, 12), rng.randint(1, 28)
+    name = rng.choice(COMPANY_NAMES)
+    company = rng.choice(COMPANY_FORMS).format(name)
+    invoice = "T" + "".join(str(rng.randint(0, 9)) for _ in range(13))
+
+    items = [(rng.choice(ITEMS), rng.randint(1, 200) * 10) for _ in range(rng.randint(1, 6))]
+    subtotal = sum(price for _, price in items)
+    total = subtotal + subtotal // 10
+
+    lines = ["領収書", company, _date_text(rng, year, month, day), ""]
+    lines += [f"{item}  {price}" for item, price in items]
+    lines += [
+        f"消費税等(10%)  {subtotal // 10}",
+        f"合計  ¥{total:,}",
+        "",
+        f"登録番号 {invoice}",
+        f"TEL 03-{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}",
+    ]
+    truth = {
+        "発行日": f"{year:04d}/{month:02d}/{day:02d}",
+        "支払先名": name,
+        "金額": str(total),
+        "インボイス番号": invoice,
+    }
+    return {"truth": truth, "lines": lines}
+
+
+def same_template(receipt, rng):
+    """
+    同じ支払先・発行日・書式で、品目の金額（と合計）だけが異なる別の領収書を生成
+    （知覚ハッシュでは近似した画像になりやすい）
+    """
+    lines = list(receipt["lines"])
+    prices = []
+    for i, line in enumerate(lines):
+        item, sep, price = line.rpartition("  ")
+        if sep and item in ITEMS:
+            new_price = int(price) + rng.randint(1, 50) * 10
+            lines[i] = f"{item}  {new_price}"
+            prices.append(new_price)
+    subtotal = sum(prices)
+    total = subtotal + subtotal // 10
+    for i, line in enumerate(lines):
+        if line.startswith("消費税等"):
+            lines[i] = f"消費税等(10%)  {subtotal // 10}"
+        elif line.startswith("合計"):
+            lines[i] = f"合計  ¥{total:,}"
+    return {"truth": dict(receipt["truth"], 金額=str(total)), "lines": lines}
+
+
+def render_image(lines, rng, width=1000, rotation=3.0, noise=8.0, blur=True):
+    """
+    領収書の行を画像（NumPy配列, BGR）に描画し、回転・ノイズ・ぼかしを加える
+
+    rotation: 回転角度の最大値（度）。-rotation〜rotation の範囲でランダムに回転する
+    noise: ガウスノイズの標準偏差
+    """
+    font_size = max(12, width // 28)
+    font, _ = find_font(font_size)
+    line_height = int(font_size * 1.6)
+    height = max(int(width * 1.3), line_height * (len(lines) + 4))
+
+    canvas = Image.new("L", (width, height), 250)
+    draw = ImageDraw.Draw(canvas)
+    for i, line in enumerate(lines):
+        draw.text((width // 12, line_height * (i + 2)), line, fill=20, font=font)
+    image = np.asarray(canvas)
+
+    if rotation:
+        angle = rng.uniform(-rotation, rotation)
+        rot_mat = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        image = cv2.warpAffine(image, rot_mat, (width, height), borderValue=250)
+    if noise:
+        noisy = image.astype(np.float32) + np.random.default_rng(rng.randrange(2**32)).normal(0, noise, image.shape)
+        image = np.clip(noisy, 0, 255).astype(np.uint8)
+    if blur:
+        image = cv2.GaussianBlur(image, (3, 3), 0)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+def ocr_data(lines, rng, error_rate=0.02):
+    """
+    OCR結果に相当するテキストと行ごとの信頼度（tesseract.image_to_data の戻り値に相当）
+    一定の確率で文字を誤認識させ、誤認識した文字を含む行は信頼度を低くする
+    """
+    noisy, confidences = [], []
+    for line in lines:
+        chars = [CONFUSIONS[c] if c in CONFUSIONS and rng.random() < error_rate else c for c in line]
+        noisy.append("".join(chars))
+        misread = sum(a != b for a, b in zip(chars, line))
+        confidences.append(max(0.0, 95.0 - 30.0 * misread - rng.uniform(0, 10)))
+    return "\n".join(noisy), confidences
+
+
+def ocr_text(lines, rng, error_rate=0.02):
+    """OCR結果に相当するテキスト（一定の確率で文字を誤認識させる）"""
+    return ocr_data(lines, rng, error_rate)[0]
+
+
+def write_pdf(path, images):
+    """複数の画像（BGR）を1ページずつのPDFとして保存"""
+    pages = [Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)) for image in images]
+    pages[0].save(path, "PDF", resolution=150, save_all=True, append_images=pages[1:])
+    return path
+
+
+def generate(count, seed=0, **render_options):
+    """count件の領収書（内容・画像）を生成"""
+    rng = random.Random(seed)
+    receipts = []
+    for _ in range(count):
+        receipt = make_receipt(rng)
+        receipt["image"] = render_image(receipt["lines"], rng, **render_options)
+        receipts.append(receipt)
+    return receipts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="合成領収書の生成")
+    parser.add_argument("--count", type=int, default=5)
+    parser.add_argument("--pdf-pages", type=int, default=3, help="PDFのページ数（0で生成しない）")
+    parser.add_argument("--output", default="synthetic_receipts")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    receipts = generate(args.count, args.seed)
+    truths = {}
+    for i, receipt in enumerate(receipts):
+        filename = f"receipt_{i:03d}.png"
+        cv2.imwrite(os.path.join(args.output, filename), receipt["image"])
+        truths[filename] = receipt["truth"]
+    if args.pdf_pages:
+        pages = receipts[: args.pdf_pages]
+        write_pdf(os.path.join(args.output, "receipts.pdf"), [receipt["image"] for receipt in pages])
+        truths["receipts.pdf"] = [receipt["truth"] for receipt in pages]
+    with open(os.path.join(args.output, "truth.json"), "w", encoding="utf-8") as f:
+        json.dump(truths, f, ensure_ascii=False, indent=2)
+    print(f"{args.output} に保存しました（日本語フォント: {'あり' if japanese_font_available() else 'なし'}）")
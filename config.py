@@ -6,9 +6,150 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # アップロードされたファイルの保存先
 UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
 EXCEL_FOLDER = os.path.join(BASE_DIR, "excel_files")
+# アップロードされたファイルをUPLOAD_FOLDERに保存（保管）するか
+# 保存しない場合もジョブの処理には影響しない（内容はジョブキューに保持し、メモリ上で読み込む）
+UPLOAD_ARCHIVE_ENABLED = os.getenv("UPLOAD_ARCHIVE_ENABLED", "0") == "1"
 
 # アップロードを許可する拡張子
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "pdf"}
 
 # アップロードファイルの最大サイズ（16MB）
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MBまで許容
+
+# ジョブキュー（SQLite）の保存先
+DATA_FOLDER = os.path.join(BASE_DIR, "data")
+JOB_DB_PATH = os.path.join(DATA_FOLDER, "jobs.sqlite3")
+# 抽出結果の台帳（SQLite）。Excelファイルは台帳から出力する
+LEDGER_DB_PATH = os.path.join(DATA_FOLDER, "ledger.sqlite3")
+# 重複した領収書（インボイス番号・発行日・金額・支払先名が同じ）の扱い
+# "flag": 台帳に追加し、重複元の行を記録する / "skip": 台帳に追加しない
+DUPLICATE_POLICY = os.getenv("DUPLICATE_POLICY", "flag")
+
+# 一括取り込み（ZIPファイルのアップロード・受信フォルダ）
+# ZIPファイルのアップロードの最大サイズ（通常のアップロードのMAX_CONTENT_LENGTHとは別に適用する）
+BULK_MAX_CONTENT_LENGTH = int(os.getenv("BULK_MAX_CONTENT_LENGTH", str(1024 * 1024 * 1024)))
+# 1つのジョブに登録するファイル数の上限と、1ファイルの最大サイズ（ZIPファイル内のファイルは展開後のサイズ）
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "2000"))
+BULK_MAX_FILE_BYTES = MAX_CONTENT_LENGTH
+# 未処理（待機中・実行中）のファイル数がこの件数以上の場合は一括取り込みを受け付けない
+JOB_MAX_PENDING_FILES = int(os.getenv("JOB_MAX_PENDING_FILES", "5000"))
+# 1つのジョブで内容をジョブキューに保持する未処理のファイル数の上限。ZIPファイルなどの登録は、
+# ワーカーが登録済みのファイルを処理して上限を下回るまで待つ（展開した内容を全てディスクに書き出さない）
+JOB_MAX_BUFFERED_FILES = int(os.getenv("JOB_MAX_BUFFERED_FILES", "100"))
+# 上限に達した登録を待つ間、ファイルの処理がこの秒数進まない場合は登録を中断する
+JOB_BUFFER_TIMEOUT = float(os.getenv("JOB_BUFFER_TIMEOUT", "600"))
+# 受け付けなかった場合に再送までの待ち時間として返す秒数（Retry-Afterヘッダー）
+BULK_RETRY_AFTER = 60
+# 受信フォルダ（指定した場合のみ監視する）と確認間隔（秒）
+INBOX_FOLDER = os.getenv("INBOX_FOLDER", "")
+INBOX_POLL_INTERVAL = float(os.getenv("INBOX_POLL_INTERVAL", "5"))
+# 書き込み中のファイルを取り込まないよう、最終更新からこの秒数が経過したファイルのみ取り込む
+INBOX_SETTLE_SECONDS = float(os.getenv("INBOX_SETTLE_SECONDS", "2"))
+# 受信フォルダから取り込んだ行を追加するExcelファイル（省略時は日付ごとのファイル）
+INBOX_EXCEL_FILE = os.getenv("INBOX_EXCEL_FILE", "")
+
+# バックグラウンドワーカー数
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# キューが空の場合のポーリング間隔（秒）
+JOB_POLL_INTERVAL = 1.0
+# ハートビートがこの秒数途絶えた実行中ジョブは再取得される
+JOB_LEASE_SECONDS = 600
+# 実行中のジョブのハートビートを更新する間隔（秒）。1ファイルの処理が長引いてもリースが切れないよう、
+# JOB_LEASE_SECONDS より十分短くする
+JOB_HEARTBEAT_INTERVAL = 60
+
+# 進捗のイベント（/jobs/<job_id>/events）の確認間隔（秒）、接続を維持するための送信間隔（秒）、保持期間（秒）
+JOB_EVENT_POLL_INTERVAL = 0.5
+JOB_EVENT_KEEPALIVE = 15.0
+JOB_EVENT_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Tesseractの抽出結果を信頼する行の信頼度（0〜100）の下限。下回る項目だけをGeminiで再抽出する
+OCR_FIELD_CONFIDENCE = float(os.getenv("OCR_FIELD_CONFIDENCE", "70"))
+
+# 複数ファイルの実行モード（"process": CPU処理をプロセスプールで並列実行 / "sequential": 逐次実行）
+OCR_PARALLEL_MODE = os.getenv("OCR_PARALLEL_MODE", "process")
+# CPU処理（前処理・Tesseract）のプロセスごとの並列数（各プロセスはさらに TESSERACT_POOL_SIZE 個までのエンジンを持つ）
+# 0の場合はCPU数。gunicornの各ワーカープロセスではCPU数をワーカー数で割った数（gunicorn.conf.py）とする。
+# コマンドラインの一括処理を同時に実行する場合は、全てのプロセスの合計がCPU数を超えないよう指定する
+OCR_MAX_WORKERS = int(os.getenv("OCR_MAX_WORKERS", "0"))
+# Gemini APIの同時呼び出し数の上限
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+
+# PDFを画像に変換する際の解像度と、並列に変換（先読み）するページ数
+PDF_DPI = 200
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "2"))
+# テキストレイヤーのあるページ（ソフトウェアで作成したPDF）は画像に変換せずにテキストから抽出する（pdftotextを使用）
+PDF_TEXT_LAYER_ENABLED = os.getenv("PDF_TEXT_LAYER_ENABLED", "1") == "1"
+# テキストレイヤーがあるとみなすページの文字数（空白を除く）の下限
+PDF_TEXT_MIN_CHARS = int(os.getenv("PDF_TEXT_MIN_CHARS", "20"))
+# pdftotextの実行時間の上限（秒）
+PDF_TEXT_TIMEOUT = 60
+
+# 抽出結果キャッシュ（ファイル内容のSHA-256をキーとする）
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_DB_PATH = os.path.join(DATA_FOLDER, "cache.sqlite3")
+# キャッシュの最大サイズ（バイト）。超えた場合は参照が古いものから削除
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# 抽出処理のバージョン（処理内容を変更した場合は上げてキャッシュを無効化する）
+PIPELINE_VERSION = "5"
+# 知覚ハッシュによる近似画像の検出（同じ領収書の撮り直し・再エクスポートは、Tesseractで読み取った金額・発行日が
+# 一致する場合にGeminiを呼び出さずに以前の結果を再利用する。同じ書式の別の領収書もハッシュの距離は近くなるため、
+# 距離だけでは再利用しない）
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "1") == "1"
+# 同じ画像とみなすハッシュのハミング距離の上限（256ビット中。索引の構成上15以下）
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "12"))
+# 保存するハッシュの最大件数（超えた場合は古いものから削除）
+PHASH_MAX_ENTRIES = int(os.getenv("PHASH_MAX_ENTRIES", "200000"))
+
+# Gemini APIの設定
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
+# 1回の呼び出しのタイムアウト（秒）
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+# 呼び出しがタイムアウトで打ち切られない場合に、呼び出し元が結果を待つのをやめるまでの猶予（秒）。
+# 打ち切られなかった呼び出しのスレッドは終わるまで同時実行数の枠を使い続ける
+GEMINI_TIMEOUT_GRACE = float(os.getenv("GEMINI_TIMEOUT_GRACE", "10"))
+# 通信方式（"grpc" または "rest"）。いずれもプロセス内で接続を再利用する
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "grpc")
+
+# Gemini APIのレート制限（1分あたりのリクエスト数）と瞬間的に許容するリクエスト数
+# プロセスごとではなく、GEMINI_RATE_DB_PATH を共有する全てのプロセス（gunicornの各ワーカー・
+# utils.batch の実行など）の合計に対する上限。APIキーのクォータに合わせて設定する
+GEMINI_RATE_PER_MINUTE = float(os.getenv("GEMINI_RATE_PER_MINUTE", "60"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+# レート制限のトークンの残量を共有するDB（空の場合はプロセスごとに制限するため、合計はプロセス数倍になる）
+GEMINI_RATE_DB_PATH = os.getenv("GEMINI_RATE_DB_PATH", os.path.join(DATA_FOLDER, "gemini_rate.sqlite3"))
+# 429/5xxに対するリトライ回数と指数バックオフの基準・上限（秒）
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "5"))
+GEMINI_BACKOFF_BASE = 1.0
+GEMINI_BACKOFF_MAX = 30.0
+# リトライを含めた1リクエストの期限（秒）
+GEMINI_DEADLINE = float(os.getenv("GEMINI_DEADLINE", "180"))
+
+# Geminiへ送信する画像の変換設定（長辺の最大ピクセル数・JPEG品質・グレースケール化・領収書部分の切り出し）
+GEMINI_IMAGE_MAX_DIM = int(os.getenv("GEMINI_IMAGE_MAX_DIM", "1600"))
+GEMINI_IMAGE_QUALITY = int(os.getenv("GEMINI_IMAGE_QUALITY", "80"))
+GEMINI_IMAGE_GRAYSCALE = os.getenv("GEMINI_IMAGE_GRAYSCALE", "1") == "1"
+GEMINI_IMAGE_CROP = os.getenv("GEMINI_IMAGE_CROP", "1") == "1"
+# エンコード済み画像をプロセス内に保持する件数
+GEMINI_PAYLOAD_CACHE_SIZE = 32
+
+# 前処理の傾き補正の方式
+# "fast": 縮小画像の文字画素から推定 / "projection": 射影の分散が最大になる角度を探索
+# "legacy": 全画素の座標から推定（従来方式） / "none": 補正しない
+DESKEW_METHOD = os.getenv("DESKEW_METHOD", "fast")
+# 傾きの推定に使う縮小画像の長辺（ピクセル）と、補正する最大角度（度）
+DESKEW_MAX_DIM = 1000
+DESKEW_MAX_ANGLE = 15.0
+
+# 前処理の途中画像（デバッグ用）の出力。アップロード時の指定でも有効にできる
+DEBUG_IMAGES_ENABLED = os.getenv("DEBUG_IMAGES_ENABLED", "0") == "1"
+DEBUG_IMAGE_FOLDER = os.path.join(BASE_DIR, "debug_images")
+
+# Tesseractの実行方式（"auto": tesserocrがあれば初期化済みエンジンを使い回す / "pytesseract": 毎回プロセスを起動）
+TESSERACT_ENGINE = os.getenv("TESSERACT_ENGINE", "auto")
+# プロセスごとに保持する初期化済みエンジンの数（言語ごと）
+TESSERACT_POOL_SIZE = int(os.getenv("TESSERACT_POOL_SIZE", "2"))
+
+# ログ出力（"json": 1行1件のJSON / "text": 人が読みやすい形式）とログレベル
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -0,0 +1,17 @@
+# gunicornの設定（gunicorn -c gunicorn.conf.py app:app で起動する）
+# 進捗の配信（Server-Sent Events）は接続ごとに1つのスレッドを使うため、スレッドワーカーを使う
+worker_class = "gthread"
+threads = 8
+
+
+def post_worker_init(worker):
+    """
+    各ワーカープロセスでアプリケーションを読み込んだ後に、バックグラウンドワーカー・受信フォルダの監視を開始する
+    （--preload の場合もfork後の各ワーカープロセスで起動される）
+    OCRのプロセスプールの並列数は、OCR_MAX_WORKERS を指定しない場合はCPU数をワーカー数で分け合う
+    """
+    import app
+    from utils import ocr
+
+    ocr.share_cpus(worker.cfg.workers)
+    app.start_background()
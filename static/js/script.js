@@ -0,0 +1,217 @@
+// アップロード後の処理状況の表示
+// フォームをJSONで送信してジョブIDを受け取り、/jobs/<job_id>/events（Server-Sent Events）の進捗を表示する
+// 処理中はフォームを送信できないようにし、ページを再読み込みしても処理中のジョブの表示を再開する
+(function () {
+    "use strict";
+
+    var STORAGE_KEY = "receipt-ocr-active-job";
+
+    // ファイル・ページの段階の表示名
+    var FILE_STAGES = {
+        queued: "待機中",
+        running: "処理待ち",
+        cached: "キャッシュの結果を使用",
+        preprocess: "前処理",
+        near_duplicate: "近似した画像の結果を再利用",
+        tesseract: "文字認識（Tesseract）",
+        text_layer: "PDFのテキストから抽出",
+        gemini: "Geminiで再抽出",
+        done: "完了",
+        failed: "失敗"
+    };
+    // ジョブの状態・段階の表示名
+    var JOB_STAGES = {
+        receiving: "ファイルを登録中",
+        queued: "処理の開始を待っています",
+        running: "処理中",
+        ledger: "台帳に登録中",
+        done: "完了しました",
+        failed: "失敗しました"
+    };
+
+    var panel = document.getElementById("job-progress");
+    if (!panel) {
+        return;
+    }
+    var forms = document.querySelectorAll("form[data-job-form]");
+    var statusText = panel.querySelector(".job-status");
+    var countsText = panel.querySelector(".job-counts");
+    var barFill = panel.querySelector(".progress-bar-fill");
+    var fileList = panel.querySelector(".job-files");
+
+    var source = null;
+    var state = null;
+
+    function setFormsDisabled(disabled) {
+        forms.forEach(function (form) {
+            form.querySelectorAll("button, input, select").forEach(function (element) {
+                element.disabled = disabled;
+            });
+        });
+    }
+
+    function isFinished(status) {
+        return status === "done" || status === "failed";
+    }
+
+    function render() {
+        var files = Object.keys(state.files).map(function (index) {
+            return state.files[index];
+        });
+        var done = files.filter(function (file) { return file.status === "done"; }).length;
+        var failed = files.filter(function (file) { return file.status === "failed"; }).length;
+        var total = files.length;
+
+        var label = JOB_STAGES[state.stage || state.status] || state.status;
+        statusText.textContent = "ジョブ " + state.id + ": " + label + (state.error ? "（" + state.error + "）" : "");
+        if (state.status === "done" && state.excelFile) {
+            var link = document.createElement("a");
+            link.href = panel.dataset.downloadUrl.replace("__FILE__", encodeURIComponent(state.excelFile));
+            link.className = "download-btn";
+            link.textContent = state.excelFile + " をダウンロード";
+            statusText.appendChild(document.createTextNode(" "));
+            statusText.appendChild(link);
+        }
+        countsText.textContent = "完了 " + done + " / 失敗 " + failed + " / 全 " + total + " 件" +
+            (state.summary ? "（台帳に追加: " + state.summary.added + "件、重複: " + state.summary.duplicates + "件）" : "");
+        barFill.style.width = (total ? Math.round((done + failed) * 100 / total) : 0) + "%";
+        barFill.classList.toggle("failed", state.status === "failed");
+
+        fileList.textContent = "";
+        files.forEach(function (file) {
+            var item = document.createElement("li");
+            item.className = "job-file job-file-" + file.status;
+            var name = document.createElement("span");
+            name.className = "job-file-name";
+            name.textContent = file.filename;
+            var stage = document.createElement("span");
+            stage.className = "job-file-stage";
+            stage.textContent = (FILE_STAGES[file.stage] || file.stage) +
+                (file.fields ? "（" + file.fields.join("・") + "）" : "") +
+                (file.page ? "（" + file.page + "ページ）" : "") + (file.error ? ": " + file.error : "");
+            item.appendChild(name);
+            item.appendChild(stage);
+            fileList.appendChild(item);
+        });
+    }
+
+    function applySnapshot(job) {
+        state = { id: job.id, status: job.status, stage: null, error: job.error, excelFile: job.excel_file, summary: null, files: {} };
+        job.files.forEach(function (file) {
+            state.files[file.index] = { filename: file.filename, status: file.status, stage: file.status, page: null, error: file.error };
+        });
+    }
+
+    function applyFileEvent(data) {
+        var file = state.files[data.index];
+        if (!file) {
+            return;
+        }
+        file.stage = data.stage;
+        file.page = data.page || null;
+        file.fields = data.fields || null;
+        if (data.stage === "done" || data.stage === "failed" || data.stage === "running") {
+            file.status = data.stage;
+            file.error = data.error || null;
+        }
+    }
+
+    function applyJobEvent(data) {
+        state.status = data.status;
+        state.stage = data.stage || null;
+        state.error = data.error || null;
+        if (data.added !== undefined) {
+            state.summary = { added: data.added, duplicates: data.duplicates };
+        }
+    }
+
+    function finish() {
+        if (source) {
+            source.close();
+            source = null;
+        }
+        localStorage.removeItem(STORAGE_KEY);
+        setFormsDisabled(false);
+    }
+
+    function watch(jobId) {
+        localStorage.setItem(STORAGE_KEY, jobId);
+        setFormsDisabled(true);
+        panel.hidden = false;
+        statusText.textContent = "ジョブ " + jobId + ": 接続中";
+
+        source = new EventSource(panel.dataset.eventsUrl.replace("__JOB__", encodeURIComponent(jobId)));
+        source.addEventListener("snapshot", function (event) {
+            applySnapshot(JSON.parse(event.data));
+            render();
+        });
+        source.addEventListener("file", function (event) {
+            if (state) {
+                applyFileEvent(JSON.parse(event.data));
+                render();
+            }
+        });
+        source.addEventListener("job", function (event) {
+            if (state) {
+                applyJobEvent(JSON.parse(event.data));
+                render();
+            }
+        });
+        source.addEventListener("end", function () {
+            finish();
+        });
+        source.onerror = function () {
+            // ジョブが見つからない（削除済み）場合は再接続しない。それ以外はEventSourceが自動で再接続する
+            if (source && source.readyState === EventSource.CLOSED) {
+                finish();
+            }
+        };
+    }
+
+    function showError(form, message) {
+        var alert = document.createElement("div");
+        alert.className = "alert alert-error";
+        alert.textContent = message;
+        form.parentNode.insertBefore(alert, form);
+    }
+
+    forms.forEach(function (form) {
+        form.addEventListener("submit", function (event) {
+            event.preventDefault();
+            if (source) {
+                return;
+            }
+            // 無効化した入力は送信されないため、無効化する前にフォームの内容を取得する
+            var body = new FormData(form);
+            setFormsDisabled(true);
+            fetch(form.action, { method: "POST", body: body, headers: { Accept: "application/json" } })
+                .then(function (response) {
+                    return response.json().then(function (data) {
+                        if (!response.ok) {
+                            throw new Error(data.error || "アップロードに失敗しました");
+                        }
+                        return data;
+                    });
+                })
+                .then(function (data) {
+                    form.reset();
+                    watch(data.job_id);
+                    if (data.skipped && data.skipped.length) {
+                        showError(form, "読み飛ばしたファイル: " + data.skipped.map(function (file) {
+                            return file.filename + "（" + file.error + "）";
+                        }).join("、"));
+                    }
+                })
+                .catch(function (error) {
+                    setFormsDisabled(false);
+                    showError(form, error.message);
+                });
+        });
+    });
+
+    // 処理中のジョブがあれば表示を再開する
+    var activeJob = localStorage.getItem(STORAGE_KEY);
+    if (activeJob) {
+        watch(activeJob);
+    }
+})();
@@ -0,0 +1,390 @@
+"""
+大量の領収書ファイルを一括でOCR処理するコマンドラインツール
+
+ディレクトリ（再帰的に探索）・globパターン・ファイルを指定し、--jobs 個のワーカーで並列に処理する。
+結果は1ファイル処理するごとにJSONL/CSVへ追記する（XLSXは --flush-every ファイルごとに追記する）。
+処理したファイルはマニフェスト（JSONL）に記録し、中断した場合も再実行すると処理済みのファイルを省略して続きから処理する。
+
+使用方法:
+    python -m utils.batch 領収書/ "scans/**/*.pdf" --output results.jsonl --jobs 8
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+from utils import excel, extract, ocr
+
+# 出力する列（1行 = 領収書1件。PDFはページごとに1行）
+FILE_COLUMN = "ファイル"
+COLUMNS = [FILE_COLUMN, extract.PAGE_KEY] + extract.FIELDS + [extract.METHOD_KEY]
+# 出力ファイルの拡張子と形式
+FORMATS = {".jsonl": "jsonl", ".ndjson": "jsonl", ".csv": "csv", ".xlsx": "xlsx"}
+MANIFEST_SUFFIX = ".manifest.jsonl"
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def _has_magic(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+def discover(inputs):
+    """
+    入力（ディレクトリ・globパターン・ファイル）から処理対象のファイルの絶対パスを重複なく列挙する
+    ディレクトリは再帰的に探索し、処理できない拡張子・隠しファイルは除外する
+    """
+    found = set()
+    for item in inputs:
+        if _has_magic(item):
+            candidates = glob.glob(item, recursive=True)
+        elif os.path.isdir(item):
+            candidates = []
+            for root, dirs, files in os.walk(item):
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
+                candidates.extend(os.path.join(root, name) for name in files)
+        else:
+            candidates = [item]
+        for path in candidates:
+            name = os.path.basename(path)
+            if name.startswith(".") or os.path.splitext(name)[1].lower() not in ocr.SUPPORTED_EXTENSIONS:
+                continue
+            if os.path.isfile(path):
+                found.add(os.path.abspath(path))
+    return sorted(found)
+
+
+def to_rows(path, result):
+    """ファイル1件分の結果（PDFの場合はページごとの結果のリスト）を出力する行に変換"""
+    pages = result if isinstance(result, list) else [result] if result else []
+    return [{FILE_COLUMN: path, **{column: page.get(column, "") for column in COLUMNS[1:]}} for page in pages]
+
+
+class Manifest:
+    """
+    処理したファイルの記録（チェックポイント）。1ファイルにつき1行のJSONを追記する
+    ファイルのサイズ・更新日時が変わっていない処理済みのファイルは、再実行時に省略する
+    途中で中断して最後の行が壊れている場合は、その行を無視する
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.seq = 0
+        # JSONL/CSVの出力に反映済みの位置（バイト数）
+        self.output_offset = None
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if "output_offset" in record:
+                    self.output_offset = record["output_offset"]
+                if "path" in record:
+                    self.entries[record["path"]] = record
+                    self.seq = max(self.seq, record["seq"])
+
+    def is_finished(self, path, retry_failed=False):
+        """処理済み（失敗を再試行しない場合は失敗したものを含む）で、内容が変わっていないか"""
+        entry = self.entries.get(path)
+        if entry is None or (retry_failed and entry["status"] == STATUS_FAILED):
+            return False
+        stat = os.stat(path)
+        return entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns
+
+    def record(self, path, status, rows=None, error=None, output_offset=None):
+        try:
+            stat = os.stat(path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            # 処理中に削除された場合は、次回の実行で対象にならないため記録だけ残す
+            size, mtime_ns = None, None
+        self.seq += 1
+        entry = {
+            "seq": self.seq,
+            "path": path,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "status": status,
+            "rows": rows or [],
+            "error": error,
+        }
+        if output_offset is not None:
+            entry["output_offset"] = output_offset
+            self.output_offset = output_offset
+        self.entries[path] = entry
+        self._append(entry)
+
+    def checkpoint(self, output_offset):
+        """出力を作り直した場合に、反映済みの位置を記録する"""
+        self.output_offset = output_offset
+        self._append({"output_offset": output_offset})
+
+    def _append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def rows_after(self, seq):
+        """
+        記録順が seq より後の処理済みのファイルの行を返す（excel.sync_workbook に渡す fetch_rows）
+
+        Returns:
+        (行のリスト, 最後の記録順)
+        """
+        entries = sorted((e for e in self.entries.values() if e["seq"] > seq), key=lambda e: e["seq"])
+        rows = [row for entry in entries if entry["status"] == STATUS_DONE for row in entry["rows"]]
+        return rows, entries[-1]["seq"] if entries else seq
+
+    def close(self):
+        self.file.close()
+
+
+class StreamOutput:
+    """
+    JSONL/CSVの出力。1ファイル分の行を追記するごとにフラッシュし、反映済みの位置をマニフェストに記録する
+    再実行時は、マニフェストに記録した位置より後ろ（記録前に中断した分）を切り詰めてから追記する
+    出力先がパイプ（/dev/stdout など）の場合は位置を記録せず、再実行時は全ての行を出力し直す
+    """
+
+    def __init__(self, path, fmt, manifest):
+        self.fmt = fmt
+        offset = manifest.output_offset
+        if offset is not None and os.path.isfile(path) and os.path.getsize(path) >= offset:
+            self.file = open(path, "r+", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+            self.file.seek(offset)
+            self.file.truncate()
+        else:
+            # 新規の実行、または出力ファイルが削除・変更された場合はマニフェストの結果から作り直す
+            self.file = open(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="")
+            if fmt == "csv":
+                self._csv().writeheader()
+            rows, _ = manifest.rows_after(0)
+            if rows:
+                self.write(rows)
+            manifest.checkpoint(self._position())
+
+    def _position(self):
+        return self.file.tell() if self.file.seekable() else None
+
+    def _csv(self):
+        return csv.DictWriter(self.file, fieldnames=COLUMNS)
+
+    def write(self, rows):
+        """行を追記し、反映済みの位置を返す"""
+        if self.fmt == "csv":
+            self._csv().writerows(rows)
+        else:
+            for row in rows:
+                self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.file.flush()
+        return self._position()
+
+    def checkpoint(self, manifest):
+        pass
+
+    def close(self, manifest):
+        self.file.close()
+
+
+class XlsxOutput:
+    """
+    XLSXの出力。マニフェストに記録した行を flush_every ファイルごとに追記する（ブック全体を読み直さない）
+    反映済みの位置は excel の追記用の情報（source_position）に保存される
+    """
+
+    def __init__(self, path, manifest, flush_every):
+        self.path = path
+        self.flush_every = flush_every
+        self.pending = 0
+        # ブックがマニフェストより先の位置まで反映されている（マニフェストを編集・差し替えた）場合は作り直す
+        meta = excel.load_meta(path) if os.path.exists(path) else None
+        if meta and (meta.get("source_position") or 0) > manifest.seq:
+            os.remove(excel.meta_path(path))
+        # 前回の実行で記録済みで、反映されていない行を追記する
+        self._sync(manifest)
+
+    def _sync(self, manifest):
+        excel.sync_workbook(self.path, manifest.rows_after)
+        self.pending = 0
+
+    def write(self, rows):
+        return None
+
+    def checkpoint(self, manifest):
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self._sync(manifest)
+
+    def close(self, manifest):
+        self._sync(manifest)
+
+
+def open_output(path, fmt, manifest, flush_every):
+    if fmt == "xlsx":
+        return XlsxOutput(path, manifest, flush_every)
+    return StreamOutput(path, fmt, manifest)
+
+
+def output_format(path, fmt=None):
+    """出力形式（指定がなければ拡張子から判定する）"""
+    fmt = fmt or FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt not in FORMATS.values():
+        raise ValueError(f"出力形式を判定できません（.jsonl / .csv / .xlsx のいずれかを指定してください）: {path}")
+    return fmt
+
+
+def run(inputs, output, fmt=None, jobs=None, manifest_path=None, retry_failed=False, restart=False,
+        use_cache=None, flush_every=50, quiet=False):
+    """
+    一括処理を実行し、集計結果（辞書）を返す
+
+    Parameters:
+    inputs: ディレクトリ・globパターン・ファイルのリスト
+    output: 出力ファイルのパス（.jsonl / .csv / .xlsx）
+    fmt: 出力形式（"jsonl" / "csv" / "xlsx"。省略時は拡張子から判定）
+    jobs: CPU処理の並列数（1の場合は逐次実行。省略時は設定値）
+    manifest_path: マニフェストのパス（省略時は <出力ファイル>.manifest.jsonl）
+    retry_failed: 前回失敗したファイルを再試行するか
+    restart: マニフェスト・出力ファイルを削除して最初から処理するか
+    use_cache: 抽出結果キャッシュを使用するか（省略時は設定値）
+    flush_every: XLSXに追記するファイル数の間隔
+    quiet: ファイルごとの進捗を表示しない
+    """
+    fmt = output_format(output, fmt)
+    manifest_path = manifest_path or output + MANIFEST_SUFFIX
+    if restart:
+        # 出力先が標準出力（/dev/stdout）などの通常のファイルでない場合は削除しない
+        for path in (manifest_path, output, excel.meta_path(output)):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    started = time.perf_counter()
+    files = discover(inputs)
+    manifest = Manifest(manifest_path)
+    pending = [path for path in files if not manifest.is_finished(path, retry_failed)]
+    writer = open_output(output, fmt, manifest, flush_every)
+
+    stats = {
+        "files": len(files),
+        "skipped": len(files) - len(pending),
+        "processed": 0,
+        "succeeded": 0,
+        "failed": 0,
+        "receipts": 0,
+        "methods": Counter(),
+        "errors": Counter(),
+        "interrupted": False,
+    }
+    mode = "sequential" if jobs == 1 else "process"
+    try:
+        for i, result, error in ocr.iter_process_files(pending, mode=mode, max_workers=jobs, use_cache=use_cache):
+            path = pending[i]
+            stats["processed"] += 1
+            rows = to_rows(path, result)
+            if rows:
+                offset = writer.write(rows)
+                manifest.record(path, STATUS_DONE, rows=rows, output_offset=offset)
+                stats["succeeded"] += 1
+                stats["receipts"] += len(rows)
+                stats["methods"].update(row[extract.METHOD_KEY] or "unknown" for row in rows)
+            else:
+                error = error or "データを抽出できませんでした"
+                manifest.record(path, STATUS_FAILED, error=error)
+                stats["failed"] += 1
+                stats["errors"][error] += 1
+            writer.checkpoint(manifest)
+            if not quiet:
+                status = "OK  " if rows else "NG  "
+                print(f"[{stats['skipped'] + stats['processed']}/{len(files)}] {status}{path}", file=sys.stderr)
+    except KeyboardInterrupt:
+        stats["interrupted"] = True
+        ocr.shutdown_pools(cancel=True)
+    finally:
+        writer.close(manifest)
+        manifest.close()
+
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    stats["output"] = output
+    stats["manifest"] = manifest_path
+    return stats
+
+
+def print_summary(stats, top=5, file=None):
+    """処理結果の要約を file（省略時は標準エラー出力）に表示する（標準出力は出力ファイルに使えるよう空けておく）"""
+    file = file or sys.stderr
+    seconds = max(stats["seconds"], 1e-9)
+    print("=== 処理結果 ===" + ("（中断しました。再実行すると続きから処理します）" if stats["interrupted"] else ""), file=file)
+    print(f"対象ファイル: {stats['files']}件（処理済みのため省略: {stats['skipped']}件）", file=file)
+    print(
+        f"処理: {stats['processed']}件（成功: {stats['succeeded']}件 / 失敗: {stats['failed']}件）"
+        f" 領収書: {stats['receipts']}件",
+        file=file,
+    )
+    print(
+        f"処理時間: {stats['seconds']}秒"
+        f"（{stats['processed'] / seconds:.2f}ファイル/秒、{stats['receipts'] / seconds:.2f}件/秒）",
+        file=file,
+    )
+    if stats["methods"]:
+        print("抽出方法: " + " / ".join(f"{method} {count}件" for method, count in stats["methods"].most_common()), file=file)
+    if stats["errors"]:
+        print(f"失敗の理由（上位{top}件）:", file=file)
+        for error, count in stats["errors"].most_common(top):
+            print(f"  {count}件: {error}", file=file)
+    print(f"出力: {stats['output']} / マニフェスト: {stats['manifest']}", file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="領収書ファイルの一括OCR処理")
+    parser.add_argument("inputs", nargs="+", help="ディレクトリ・globパターン（例: 'scans/**/*.pdf'）・ファイル")
+    parser.add_argument("-o", "--output", default="receipt_results.jsonl", help="出力ファイル（.jsonl / .csv / .xlsx）")
+    parser.add_argument("--format", choices=sorted(set(FORMATS.values())), help="出力形式（省略時は拡張子から判定）")
+    parser.add_argument("-j", "--jobs", type=int, help="CPU処理の並列数（1の場合は逐次実行。省略時は OCR_MAX_WORKERS、未指定の場合はCPU数）")
+    parser.add_argument("--manifest", help="マニフェストのパス（省略時は <出力ファイル>.manifest.jsonl）")
+    parser.add_argument("--retry-failed", action="store_true", help="前回失敗したファイルを再試行する")
+    parser.add_argument("--restart", action="store_true", help="マニフェストと出力ファイルを削除して最初から処理する")
+    parser.add_argument("--no-cache", action="store_true", help="抽出結果キャッシュを使用しない")
+    parser.add_argument("--flush-every", type=int, default=50, help="XLSXに追記するファイル数の間隔")
+    parser.add_argument("--log-level", default="WARNING", help="ログレベル（既定: WARNING）")
+    parser.add_argument("-q", "--quiet", action="store_true", help="ファイルごとの進捗を表示しない")
+    args = parser.parse_args(argv)
+
+    # プロセスプールのワーカー（spawnで起動）にもログレベルを引き継ぐ
+    os.environ["LOG_LEVEL"] = args.log_level
+    logging.getLogger().setLevel(args.log_level)
+
+    try:
+        stats = run(
+            args.inputs,
+            args.output,
+            fmt=args.format,
+            jobs=args.jobs,
+            manifest_path=args.manifest,
+            retry_failed=args.retry_failed,
+            restart=args.restart,
+            use_cache=False if args.no_cache else None,
+            flush_every=args.flush_every,
+            quiet=args.quiet,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    print_summary(stats)
+    if stats["interrupted"]:
+        return 130
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+import os
+import shutil
+import threading
+import time
+import zipfile
+import zlib
+from datetime import datetime
+
+from utils import jobs, log, metrics
+from config import (
+    ALLOWED_EXTENSIONS,
+    BULK_MAX_FILES,
+    BULK_MAX_FILE_BYTES,
+    INBOX_FOLDER,
+    INBOX_POLL_INTERVAL,
+    INBOX_SETTLE_SECONDS,
+    INBOX_EXCEL_FILE,
+)
+
+logger = log.get_logger(__name__)
+
+# 受信フォルダ内のサブフォルダ（取り込み中・取り込み済み・取り込めなかったファイル）
+_PROCESSING = ".processing"
+_PROCESSED = "processed"
+_FAILED = "failed"
+
+_watcher_lock = threading.Lock()
+_watcher_pid = None
+
+# ZIPファイル内のファイル名がUTF-8でない場合の文字コード（Windowsの標準機能で作成したZIPファイル）
+_LEGACY_ENCODING = "cp932"
+_UTF8_FLAG = 0x800
+
+
+def is_allowed(filename):
+    """取り込み可能なファイル形式か"""
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def _is_hidden(name):
+    """OSが作成する管理用のファイル（__MACOSX/・.DS_Storeなど）か"""
+    parts = name.replace("\\", "/").split("/")
+    return parts[0] == "__MACOSX" or any(part.startswith(".") for part in parts if part)
+
+
+def _member_name(info):
+    """ZIPファイル内のファイル名（UTF-8のフラグがない場合はShift_JISとして読み直す）"""
+    if info.flag_bits & _UTF8_FLAG:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode(_LEGACY_ENCODING)
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+
+def iter_archive(archive, skipped, source="zip"):
+    """
+    ZIPファイル内のファイルを1件ずつ読み込み、(ファイル名, None, 内容のバイト列) を返す
+    （jobs.enqueue_job にそのまま渡せる形式）
+    展開したファイルはディスクに書き出さず、読み込み中の1件だけをメモリに保持する
+    取り込めないファイルは (ファイル名, 理由) を skipped に追加して読み飛ばす（他のファイルの取り込みは続ける）
+
+    Parameters:
+    archive: zipfile.ZipFile
+    skipped: 読み飛ばしたファイルを追加するリスト
+    source: 計測値のラベル（"zip" / "inbox"）
+    """
+    count = 0
+    for info in archive.infolist():
+        name = _member_name(info)
+        if info.is_dir() or _is_hidden(name):
+            continue
+        reason = None
+        if not is_allowed(name):
+            reason = "許可されていないファイル形式です"
+        elif count >= BULK_MAX_FILES:
+            reason = f"ファイル数の上限（{BULK_MAX_FILES}件）を超えています"
+        elif info.file_size > BULK_MAX_FILE_BYTES:
+            reason = "ファイルサイズが上限を超えています"
+        else:
+            try:
+                with archive.open(info) as member:
+                    # 展開後のサイズの記録が正しくない場合に備え、上限を超えた時点で読み込みをやめる
+                    content = member.read(BULK_MAX_FILE_BYTES + 1)
+                if len(content) > BULK_MAX_FILE_BYTES:
+                    reason = "ファイルサイズが上限を超えています"
+            except (zipfile.BadZipFile, zlib.error, RuntimeError, NotImplementedError, OSError) as e:
+                # CRCの不一致・暗号化・未対応の圧縮形式など
+                reason = f"ファイルを読み込めませんでした: {str(e)}"
+
+        if reason:
+            logger.warning(f"一括取り込みでファイルを読み飛ばしました: {name} ({reason})")
+            metrics.inc(metrics.BULK_FILES, source, "skipped")
+            skipped.append((name, reason))
+            continue
+        count += 1
+        metrics.inc(metrics.BULK_FILES, source, "accepted")
+        yield name, None, content
+
+
+def enqueue_archive(fileobj, excel_file, options=None, source="zip"):
+    """
+    ZIPファイルの中のファイルを1つのジョブとして登録する
+
+    Returns:
+    (ジョブID（取り込めるファイルがない場合はNone）, 登録したファイル数, 読み飛ばしたファイルのリスト)
+
+    Raises:
+    ValueError: ZIPファイルとして読み込めない場合
+    """
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"ZIPファイルを読み込めませんでした: {str(e)}")
+
+    skipped = []
+    counted = []
+
+    def members():
+        for member in iter_archive(archive, skipped, source):
+            counted.append(member[0])
+            yield member
+
+    with archive:
+        job_id = jobs.enqueue_job(excel_file, members(), options)
+    return job_id, len(counted), skipped
+
+
+def _inbox_excel_file():
+    return INBOX_EXCEL_FILE or f"領収書データ_受信_{datetime.now().strftime('%Y%m%d')}.xlsx"
+
+
+def _move(folder, name, path, subfolder):
+    """取り込み中のファイルを受信フォルダ内のサブフォルダへ元のファイル名（日時付き）で移動する"""
+    destination = os.path.join(folder, subfolder)
+    os.makedirs(destination, exist_ok=True)
+    shutil.move(path, os.path.join(destination, f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{name}"))
+
+
+def _claim_ready_files(folder):
+    """
+    取り込み可能になった（最終更新から INBOX_SETTLE_SECONDS が経過した）ファイルを取り込み中のフォルダへ移動して返す
+    複数のプロセスで監視している場合も、移動（rename）に成功したプロセスだけが取り込む
+    """
+    processing = os.path.join(folder, _PROCESSING)
+    os.makedirs(processing, exist_ok=True)
+    settled_before = time.time() - INBOX_SETTLE_SECONDS
+    claimed = []
+    with os.scandir(folder) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            try:
+                if entry.stat().st_mtime > settled_before:
+                    continue
+                path = os.path.join(processing, f"{os.getpid()}_{entry.name}")
+                os.rename(entry.path, path)
+            except FileNotFoundError:
+                # 他のプロセスが取り込んだ
+                continue
+            claimed.append((entry.name, path))
+    return claimed
+
+
+def _is_running(pid):
+    """プロセスが実行中か"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def recover_processing(folder):
+    """
+    取り込み中のフォルダに残ったファイル（取り込み中にプロセスが異常終了・再起動したもの）を受信フォルダに戻し、
+    戻したファイル数を返す。実行中の他のプロセスが取り込んでいるファイルは戻さない
+    """
+    processing = os.path.join(folder, _PROCESSING)
+    if not os.path.isdir(processing):
+        return 0
+    recovered = 0
+    for entry_name in sorted(os.listdir(processing)):
+        pid, _, name = entry_name.partition("_")
+        if not pid.isdigit() or not name:
+            continue
+        # 起動直後の自プロセスはまだ取り込んでいないため、同じPIDのファイルも前回の残りとして扱う
+        if int(pid) != os.getpid() and _is_running(int(pid)):
+            continue
+        destination = os.path.join(folder, name)
+        if os.path.exists(destination):
+            destination = os.path.join(folder, entry_name)
+        try:
+            os.rename(os.path.join(processing, entry_name), destination)
+        except FileNotFoundError:
+            # 他のプロセスが戻した
+            continue
+        recovered += 1
+    if recovered:
+        logger.info(f"取り込み中のまま残っていたファイルを受信フォルダに戻しました: {recovered}件")
+    return recovered
+
+
+def scan_inbox(folder=None):
+    """
+    受信フォルダのファイルを1回取り込み、登録したジョブIDのリストを返す
+    画像・PDFはまとめて1つのジョブ（BULK_MAX_FILES件ごと）に、ZIPファイルは1ファイルにつき1つのジョブに登録する
+    取り込んだファイルは processed/、取り込めなかったファイルは failed/ に移動する
+    未処理のファイルが上限に達している場合は取り込まずに次回の確認を待つ
+    """
+    folder = folder or INBOX_FOLDER
+    if jobs.is_backlogged():
+        logger.info("未処理のファイルが上限に達しているため、受信フォルダの取り込みを待機します")
+        return []
+
+    claimed = _claim_ready_files(folder)
+    job_ids = []
+    files = []
+    for name, path in claimed:
+        if name.lower().endswith(".zip"):
+            job_ids.extend(_enqueue_inbox_archive(folder, name, path))
+        elif is_allowed(name):
+            files.append((name, path))
+        else:
+            logger.warning(f"受信フォルダのファイルを取り込めませんでした: {name} (許可されていないファイル形式です)")
+            metrics.inc(metrics.BULK_FILES, "inbox", "skipped")
+            _move(folder, name, path, _FAILED)
+
+    for start in range(0, len(files), BULK_MAX_FILES):
+        job_ids.extend(_enqueue_inbox_files(folder, files[start : start + BULK_MAX_FILES]))
+    return job_ids
+
+
+def _enqueue_inbox_archive(folder, name, path):
+    try:
+        with open(path, "rb") as f:
+            job_id, count, skipped = enqueue_archive(f, _inbox_excel_file(), source="inbox")
+    except Exception as e:
+        logger.exception(f"受信フォルダのZIPファイルを取り込めませんでした: {name} ({str(e)})")
+        _move(folder, name, path, _FAILED)
+        return []
+    logger.info(
+        f"受信フォルダのZIPファイルを取り込みました: {name} ({count}件、読み飛ばし{len(skipped)}件)",
+        extra={"job_id": job_id, "skipped": skipped},
+    )
+    _move(folder, name, path, _PROCESSED if job_id else _FAILED)
+    return [job_id] if job_id else []
+
+
+def _enqueue_inbox_files(folder, files):
+    read, unreadable = [], []
+
+    def contents():
+        for name, path in files:
+            try:
+                with open(path, "rb") as f:
+                    content = f.read(BULK_MAX_FILE_BYTES + 1)
+            except OSError as e:
+                logger.warning(f"受信フォルダのファイルを読み込めませんでした: {name} ({str(e)})")
+                unreadable.append((name, path))
+                continue
+            if len(content) > BULK_MAX_FILE_BYTES:
+                logger.warning(f"受信フォルダのファイルを取り込めませんでした: {name} (ファイルサイズが上限を超えています)")
+                unreadable.append((name, path))
+                continue
+            read.append((name, path))
+            yield name, None, content
+
+    try:
+        job_id = jobs.enqueue_job(_inbox_excel_file(), contents())
+    except Exception as e:
+        # 登録できなかったファイルは受信フォルダに戻し、次回の確認で再度取り込む
+        logger.exception(f"受信フォルダのファイルを登録できませんでした: {str(e)}")
+        for name, path in files:
+            if os.path.exists(path):
+                os.rename(path, os.path.join(folder, name))
+        return []
+
+    metrics.inc(metrics.BULK_FILES, "inbox", "accepted", amount=len(read))
+    metrics.inc(metrics.BULK_FILES, "inbox", "skipped", amount=len(unreadable))
+    for name, path in read:
+        _move(folder, name, path, _PROCESSED)
+    for name, path in unreadable:
+        if os.path.exists(path):
+            _move(folder, name, path, _FAILED)
+    if job_id:
+        logger.info(f"受信フォルダのファイルを取り込みました: {len(read)}件", extra={"job_id": job_id})
+    return [job_id] if job_id else []
+
+
+def _watch_loop(folder):
+    while True:
+        try:
+            scan_inbox(folder)
+        except Exception as e:
+            logger.exception(f"受信フォルダの取り込み中にエラーが発生しました: {str(e)}")
+        time.sleep(INBOX_POLL_INTERVAL)
+
+
+def start_inbox_watcher(folder=None):
+    """
+    受信フォルダの監視を開始（INBOX_FOLDER を指定した場合のみ。プロセスごとに1回）
+    開始時に、前回の取り込み中に残ったファイルを受信フォルダに戻して再度取り込む
+    """
+    global _watcher_pid
+    folder = folder or INBOX_FOLDER
+    if not folder:
+        return
+    with _watcher_lock:
+        if _watcher_pid == os.getpid():
+            return
+        os.makedirs(folder, exist_ok=True)
+        try:
+            recover_processing(folder)
+        except OSError as e:
+            logger.exception(f"取り込み中のファイルを受信フォルダに戻せませんでした: {str(e)}")
+        threading.Thread(target=_watch_loop, args=(folder,), name="inbox-watcher", daemon=True).start()
+        _watcher_pid = os.getpid()
+    logger.info(f"受信フォルダの監視を開始しました: {folder}")
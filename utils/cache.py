@@ -0,0 +1,230 @@
+import os
+import json
+import hashlib
+import sqlite3
+import time
+
+from utils import phash
+from config import CACHE_DB_PATH, CACHE_ENABLED, CACHE_MAX_BYTES, PIPELINE_VERSION, PHASH_MAX_DISTANCE, PHASH_MAX_ENTRIES
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_results_last_access ON results (last_access);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS image_hashes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    version TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    {band_columns}
+);
+{band_indexes}
+""".format(
+    # 知覚ハッシュの区間ごとの列と索引（区間のいずれかが一致するものを候補とする）
+    band_columns=",\n    ".join(f"b{i} INTEGER NOT NULL" for i in range(phash.BANDS)),
+    band_indexes="\n".join(
+        f"CREATE INDEX IF NOT EXISTS idx_image_hashes_b{i} ON image_hashes (b{i});" for i in range(phash.BANDS)
+    ),
+)
+
+_initialized_pid = None
+
+
+def _connect():
+    """キャッシュDBへ接続（初回のみテーブルを作成）"""
+    global _initialized_pid
+    if _initialized_pid == os.getpid():
+        return sqlite3.connect(CACHE_DB_PATH, timeout=30, isolation_level=None)
+
+    os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    _initialized_pid = os.getpid()
+    return conn
+
+
+def hash_bytes(data):
+    """バイト列のSHA-256"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(file_path):
+    """ファイル内容のSHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _key(digest):
+    # 抽出処理の内容が変わった場合はPIPELINE_VERSIONを上げて過去の結果を無効にする
+    return f"{PIPELINE_VERSION}:{digest}"
+
+
+def _count(conn, name):
+    conn.execute(
+        "INSERT INTO stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+        (name,),
+    )
+
+
+def get(digest):
+    """キャッシュされた抽出結果を取得（存在しない場合はNone）"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT result FROM results WHERE key = ?", (_key(digest),)).fetchone()
+        if row is None:
+            _count(conn, "misses")
+            return None
+        conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), _key(digest)))
+        _count(conn, "hits")
+        return json.loads(row[0])
+    finally:
+        conn.close()
+
+
+def put(digest, result):
+    """抽出結果を保存し、上限を超えた場合は最も古く参照されたものから削除する"""
+    if not result:
+        return
+    data = json.dumps(result, ensure_ascii=False)
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT OR REPLACE INTO results (key, result, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (_key(digest), data, len(data.encode("utf-8")), now, now),
+        )
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total > CACHE_MAX_BYTES:
+            evicted = 0
+            while total > CACHE_MAX_BYTES:
+                rows = conn.execute("SELECT key, size FROM results ORDER BY last_access LIMIT 100").fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    if total <= CACHE_MAX_BYTES:
+                        break
+                    conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                    total -= size
+                    evicted += 1
+            conn.execute(
+                "INSERT INTO stats (name, value) VALUES ('evictions', ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (evicted,),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def find_similar(image_hash, max_distance=None):
+    """
+    知覚ハッシュが近い（ハミング距離がmax_distance以下の）画像の抽出結果を取得
+
+    区間のいずれかが一致するハッシュを索引で取得し、その中から距離が最も小さいものを選ぶ
+
+    Returns:
+    (抽出結果, 距離)。見つからない場合は (None, None)
+    """
+    max_distance = PHASH_MAX_DISTANCE if max_distance is None else max_distance
+    values = phash.bands(image_hash)
+    conditions = " OR ".join(f"b{i} = ?" for i in range(phash.BANDS))
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            f"SELECT id, hash FROM image_hashes WHERE version = ? AND ({conditions})",
+            [PIPELINE_VERSION] + values,
+        ).fetchall()
+        query = int(image_hash, 16)
+        best = None
+        for entry_id, stored_hash in rows:
+            d = bin(query ^ int(stored_hash, 16)).count("1")
+            if d <= max_distance and (best is None or d < best[1]):
+                best = (entry_id, d)
+        if best is None:
+            return None, None
+        result = conn.execute("SELECT result FROM image_hashes WHERE id = ?", (best[0],)).fetchone()[0]
+    finally:
+        conn.close()
+    return json.loads(result), best[1]
+
+
+def record_similar(outcome):
+    """近似画像の検索結果（"hit" / "miss" / "rejected": 見つかったが金額・発行日が一致しない）を記録する"""
+    conn = _connect()
+    try:
+        _count(conn, {"hit": "similar_hits", "miss": "similar_misses", "rejected": "similar_rejected"}[outcome])
+    finally:
+        conn.close()
+
+
+def put_similar(image_hash, result):
+    """知覚ハッシュと抽出結果を保存し、上限を超えた場合は古いものから削除する"""
+    if not result:
+        return
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            f"""
+            INSERT INTO image_hashes (version, hash, result, created_at, {", ".join(f"b{i}" for i in range(phash.BANDS))})
+            VALUES (?, ?, ?, ?, {", ".join("?" * phash.BANDS)})
+            """,
+            [PIPELINE_VERSION, image_hash, json.dumps(result, ensure_ascii=False), time.time()]
+            + phash.bands(image_hash),
+        )
+        conn.execute(
+            "DELETE FROM image_hashes WHERE id <= (SELECT MAX(id) FROM image_hashes) - ?", (PHASH_MAX_ENTRIES,)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def get_stats():
+    """キャッシュのヒット・ミス数などの統計を取得"""
+    conn = _connect()
+    try:
+        stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        image_hashes = conn.execute("SELECT COUNT(*) FROM image_hashes").fetchone()[0]
+    finally:
+        conn.close()
+
+    hits = stats.get("hits", 0)
+    misses = stats.get("misses", 0)
+    return {
+        "enabled": CACHE_ENABLED,
+        "pipeline_version": PIPELINE_VERSION,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "evictions": stats.get("evictions", 0),
+        "entries": entries,
+        "bytes": size,
+        "max_bytes": CACHE_MAX_BYTES,
+        "similar_hits": stats.get("similar_hits", 0),
+        "similar_misses": stats.get("similar_misses", 0),
+        "similar_rejected": stats.get("similar_rejected", 0),
+        "image_hashes": image_hashes,
+    }
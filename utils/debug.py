@@ -0,0 +1,52 @@
+import os
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+from utils import log
+
+from config import DEBUG_IMAGES_ENABLED, DEBUG_IMAGE_FOLDER
+
+logger = log.get_logger(__name__)
+
+# 書き込み用のスレッド（プロセスごとに1つ）
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+
+def is_enabled(debug=None):
+    """デバッグ画像を出力するか（引数の指定がなければ設定値）"""
+    return DEBUG_IMAGES_ENABLED if debug is None else bool(debug)
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="debug-writer")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _write(folder, stages):
+    try:
+        os.makedirs(folder, exist_ok=True)
+        for i, (stage, image) in enumerate(stages):
+            cv2.imwrite(os.path.join(folder, f"{i + 1:02d}_{stage}.png"), image)
+        logger.info(f"前処理の途中画像を保存: {folder}")
+    except Exception as e:
+        logger.exception(f"デバッグ画像の保存中にエラーが発生しました: {str(e)}")
+
+
+def save_stages(name, stages):
+    """
+    前処理の各段階の画像をバックグラウンドで保存
+
+    Parameters:
+    name: 元の画像の名前（保存先フォルダ名に使用）
+    stages: (段階名, 画像) のリスト
+    """
+    folder = os.path.join(DEBUG_IMAGE_FOLDER, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{name}")
+    return _get_executor().submit(_write, folder, list(stages))
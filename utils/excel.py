@@ -1,104 +1,399 @@
 import os
+import re
+import json
+import shutil
+import tempfile
+import uuid
+import zipfile
+import posixpath
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
 from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment
 from openpyxl.utils import get_column_letter
 
+from utils import ledger, log
 
-def format_excel_worksheet(worksheet):
+# ファイルロックはUnix系のみ（Windowsでは排他制御を行わない）
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = log.get_logger(__name__)
+
+HEADERS = ["ID", "発行日", "支払先名", "金額", "インボイス番号"]
+FIELDS = HEADERS[1:]
+
+# 追記用の情報（最後のID・行数・列幅）を保存するファイルの拡張子（ブックと同じ場所に保存）
+META_SUFFIX = ".meta.json"
+# プロセス間の排他ロック用のファイルの拡張子
+LOCK_SUFFIX = ".lock"
+
+_SHEET_DATA_END = b"</sheetData>"
+
+
+def meta_path(output_path):
+    return output_path + META_SUFFIX
+
+
+def _file_state(output_path):
+    stat = os.stat(output_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_meta(output_path):
     """
-    Excelワークシートのフォーマットを設定
+    追記用の情報を読み込む
+    ブックが別の方法で変更された（サイズ・更新日時が一致しない）場合はNoneを返す
     """
-    # ヘッダー行のスタイル
-    header_fill = PatternFill(start_color="CCE5FF", end_color="CCE5FF", fill_type="solid")
+    try:
+        with open(meta_path(output_path), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if {key: meta.get(key) for key in ("size", "mtime_ns")} != _file_state(output_path):
+        return None
+    return meta
+
+
+def save_meta(output_path, meta):
+    """追記用の情報をブックの現在の状態とともに保存する"""
+    meta = dict(meta, **_file_state(output_path))
+    path = meta_path(output_path)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def _cell_length(value):
+    return len(str(value)) if value is not None else 0
+
+
+def _to_rows(data, start_id):
+    """領収書データを (ID, 発行日, 支払先名, 金額, インボイス番号) の行に変換"""
+    return [[start_id + i] + [item.get(field, "") for field in FIELDS] for i, item in enumerate(data)]
+
+
+def _update_lengths(lengths, rows):
+    for row in rows:
+        for col, value in enumerate(row):
+            lengths[col] = max(lengths[col], _cell_length(value))
+    return lengths
+
+
+def _write_new(rows, output_path):
+    """新規のブックを書き込み専用モードで作成する（行をメモリ上に保持しない）"""
+    lengths = _update_lengths([len(header) for header in HEADERS], rows)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for col, length in enumerate(lengths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = length + 2
+
     header_font = Font(bold=True)
+    alignment = Alignment(horizontal="left")
+
+    def styled(value, font=None):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.alignment = alignment
+        if font:
+            cell.font = font
+        return cell
+
+    ws.append([styled(header, header_font) for header in HEADERS])
+    for row in rows:
+        ws.append([styled(value) for value in row])
+
+    _save_atomic(wb, output_path)
+    return {
+        "last_id": rows[-1][0] if rows else 0,
+        "rows": len(rows) + 1,
+        "lengths": lengths,
+        "style": _find_data_style(output_path),
+    }
+
+
+def _save_atomic(wb, output_path):
+    """一時ファイルに保存してから置き換える（保存中に読まれても壊れたファイルにならない）"""
+    folder = os.path.dirname(os.path.abspath(output_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=folder)
+    os.close(fd)
+    try:
+        wb.save(tmp_path)
+        os.replace(tmp_path, output_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _sheet_path(zin):
+    """ブック内の最初のワークシートのXMLのパス"""
+    workbook = zin.read("xl/workbook.xml").decode("utf-8")
+    match = re.search(r'<(?:\w+:)?sheet\b[^>]*\br:id="([^"]+)"', workbook)
+    rels = zin.read("xl/_rels/workbook.xml.rels").decode("utf-8")
+    if match:
+        for rel in re.finditer(r"<Relationship\b[^>]*>", rels):
+            if f'Id="{match.group(1)}"' in rel.group(0):
+                target = re.search(r'Target="([^"]+)"', rel.group(0)).group(1)
+                return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+    return "xl/worksheets/sheet1.xml"
+
+
+def _find_data_style(output_path):
+    """データ行（2行目）のセルのスタイル番号（左揃え）"""
+    with zipfile.ZipFile(output_path) as zin:
+        with zin.open(_sheet_path(zin)) as f:
+            head = f.read(256 * 1024).decode("utf-8", errors="ignore")
+    match = re.search(r'<c r="A2"[^>]*?\bs="(\d+)"', head)
+    return int(match.group(1)) if match else None
+
+
+def _scan_meta(output_path):
+    """ブック全体を読み取り専用で走査して追記用の情報を作成する（追記用の情報がない・古い場合のみ）"""
+    wb = load_workbook(output_path, read_only=True)
+    try:
+        ws = wb.active
+        lengths = [0] * len(HEADERS)
+        rows = 0
+        last_id = 0
+        for row in ws.iter_rows(min_col=1, max_col=len(HEADERS), values_only=True):
+            rows += 1
+            for col, value in enumerate(row):
+                lengths[col] = max(lengths[col], _cell_length(value))
+            if rows > 1 and isinstance(row[0], int):
+                last_id = row[0]
+    finally:
+        wb.close()
+    return {"last_id": last_id, "rows": rows, "lengths": lengths, "style": _find_data_style(output_path)}
+
+
+def _row_xml(row_no, values, style):
+    """1行分のXML（文字列はsharedStringsを変更しないようインライン文字列で書く）"""
+    style_attr = f' s="{style}"' if style is not None else ""
+    cells = []
+    for col, value in enumerate(values, 1):
+        ref = f"{get_column_letter(col)}{row_no}"
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"{style_attr} t="n"><v>{value}</v></c>')
+        elif value in (None, ""):
+            cells.append(f'<c r="{ref}"{style_attr}/>')
+        else:
+            text = escape(str(value))
+            cells.append(f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return f'<row r="{row_no}">{"".join(cells)}</row>'
+
+
+def _cols_xml(lengths):
+    cols = "".join(
+        f'<col min="{col}" max="{col}" width="{length + 2}" customWidth="1"/>' for col, length in enumerate(lengths, 1)
+    )
+    return f"<cols>{cols}</cols>"
 
-    for cell in worksheet[1]:
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal="left")
+
+def _splice_head(head, meta, last_row):
+    """ワークシートXMLの先頭部分（sheetDataより前）の列幅・範囲を更新する"""
+    start = head.index(b"<sheetData")
+    before, after = head[:start].decode("utf-8"), head[start:]
+    cols = _cols_xml(meta["lengths"])
+    if re.search(r"<cols\b", before):
+        before = re.sub(r"<cols\b.*?</cols>", cols, before, count=1, flags=re.S)
+    else:
+        before += cols
+    before = re.sub(
+        r'<dimension ref="[^"]*"\s*/>', f'<dimension ref="A1:{get_column_letter(len(HEADERS))}{last_row}"/>', before
+    )
+    return before.encode("utf-8") + after
+
+
+def _append_spliced(rows, output_path, meta):
+    """
+    既存のブックのワークシートXMLの末尾（</sheetData>の直前）に行を書き足す
+    ブックを読み込まずにXMLをストリームでコピーするため、既存の行数によらず処理量が小さい
+    """
+    first_row = meta["rows"] + 1
+    last_row = meta["rows"] + len(rows)
+    rows_xml = "".join(_row_xml(first_row + i, row, meta["style"]) for i, row in enumerate(rows)).encode("utf-8")
+
+    folder = os.path.dirname(os.path.abspath(output_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=folder)
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(output_path) as zin, zipfile.ZipFile(
+            tmp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1
+        ) as zout:
+            sheet_path = _sheet_path(zin)
+            for info in zin.infolist():
+                # 名前で開くとZipFileの圧縮レベル（再圧縮の時間を抑えるため低めにする）が使われる
+                with zin.open(info) as src, zout.open(info.filename, "w") as dst:
+                    if info.filename != sheet_path:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                        continue
+                    _copy_sheet(src, dst, meta, rows_xml, last_row)
+        os.replace(tmp_path, output_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _copy_sheet(src, dst, meta, rows_xml, last_row):
+    """ワークシートXMLをコピーしながら、先頭の列幅を更新し末尾に行を挿入する"""
+    # sheetDataの開始タグまでを読み込んで列幅・範囲を更新
+    head = b""
+    while b"<sheetData" not in head:
+        chunk = src.read(64 * 1024)
+        if not chunk:
+            raise ValueError("sheetDataが見つかりません")
+        head += chunk
+    head = _splice_head(head, meta, last_row)
+
+    # 空のシート（<sheetData/>）の場合
+    empty = re.search(rb"<sheetData\s*/>", head)
+    if empty:
+        dst.write(head[: empty.start()] + b"<sheetData>" + rows_xml + _SHEET_DATA_END + head[empty.end() :])
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+        return
+
+    # 終了タグが読み込みの区切りをまたぐ場合に備えて、末尾の数バイトを持ち越す
+    keep = len(_SHEET_DATA_END) - 1
+    buffer = head
+    inserted = False
+    while True:
+        index = -1 if inserted else buffer.find(_SHEET_DATA_END)
+        if index >= 0:
+            dst.write(buffer[:index] + rows_xml)
+            buffer = buffer[index:]
+            inserted = True
+        chunk = src.read(1024 * 1024)
+        if not chunk:
+            break
+        if inserted:
+            dst.write(buffer)
+            buffer = chunk
+        else:
+            dst.write(buffer[:-keep])
+            buffer = buffer[-keep:] + chunk
+    if not inserted:
+        raise ValueError("sheetDataの終了タグが見つかりません")
+    dst.write(buffer)
+
+
+def _append_with_openpyxl(rows, output_path):
+    """
+    ブックを全て読み込んで行を追加し、保存する（従来の方式）
+    ワークシートのXMLの構造が想定外で追記できない場合に使用する
+    """
+    wb = load_workbook(output_path)
+    ws = wb.active
+    alignment = Alignment(horizontal="left")
+    for row in rows:
+        ws.append(row)
+        for cell in ws[ws.max_row]:
+            cell.alignment = alignment
 
     # 列幅の自動調整
-    for column in worksheet.columns:
-        max_length = 0
-        column = list(column)
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = max_length + 2
-        worksheet.column_dimensions[get_column_letter(column[0].column)].width = adjusted_width
+    for col in range(1, len(HEADERS) + 1):
+        column = get_column_letter(col)
+        max_length = max(_cell_length(cell.value) for cell in ws[column])
+        ws.column_dimensions[column].width = max_length + 2
+
+    _save_atomic(wb, output_path)
+
+
+@contextmanager
+def _workbook_lock(output_path):
+    """
+    ブックへの書き込みの排他ロック（プロセス間）
+    gunicornの複数ワーカーなど、別プロセスから同じブックへ同時に書き込まれないようにする
+    """
+    with open(output_path + LOCK_SUFFIX, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _append_rows(data, output_path, meta):
+    """既存のブックへ行を追記し、更新した追記用の情報を返す（ロックは呼び出し元で取得する）"""
+    rows = _to_rows(data, meta["last_id"] + 1)
+    meta["lengths"] = _update_lengths(meta["lengths"], rows)
+    try:
+        _append_spliced(rows, output_path, meta)
+    except (ValueError, KeyError, zipfile.BadZipFile) as e:
+        logger.warning(f"追記できない形式のため、ブック全体を読み込んで追加します: {str(e)}")
+        _append_with_openpyxl(rows, output_path)
+    meta["rows"] += len(rows)
+    meta["last_id"] = rows[-1][0] if rows else meta["last_id"]
+    return meta
+
+
+def sync_workbook(output_path, fetch_rows):
+    """
+    台帳の行をブックに反映する（ダウンロード時に呼び出す）
+
+    ブックに反映済みの台帳の位置を追記用の情報（source_position）に保存し、
+    それ以降に追加された行だけを追記する。ブック・追記用の情報がない場合や、
+    ブックが別の方法で変更された場合は台帳の全ての行からブックを作り直す。
+
+    Parameters:
+    output_path: Excelファイルのパス
+    fetch_rows: fetch_rows(after_position) -> (行のリスト, 最後の位置) を返す関数
+
+    Returns:
+    追記（または作成）した行数
+    """
+    with _workbook_lock(output_path):
+        meta = load_meta(output_path) if os.path.exists(output_path) else None
+        position = meta.get("source_position") if meta else None
+        if position is None:
+            data, position = fetch_rows(0)
+            meta = _write_new(_to_rows(data, 1), output_path)
+        else:
+            data, position = fetch_rows(position)
+            if not data:
+                return 0
+            meta = _append_rows(data, output_path, meta)
+        meta["source_position"] = position
+        save_meta(output_path, meta)
+    logger.info(f"台帳の行をExcelファイルに反映しました: {output_path}（{len(data)}行）")
+    return len(data)
+
+
+def write_workbook(data, output_path):
+    """領収書データ全体から新しいブックを作成する（条件を指定した書き出し用。追記用の情報は保存しない）"""
+    _write_new(_to_rows(data, 1), output_path)
 
 
 def create_excel_receipt(data, output_path):
     """
-    領収書データをExcelファイルに出力
+    領収書データを台帳に追加し、Excelファイルに反映する（台帳の導入前の呼び出し元との互換用）
+
+    ブック名はファイル名で、台帳に取り込まれていない既存のブックは先に取り込む（ブックの行を失わないため）。
+    重複した領収書は DUPLICATE_POLICY に従って記録・除外する。
 
     Parameters:
     data: 領収書情報のリストまたは辞書
     output_path: 出力先のExcelファイルパス
+
+    Returns:
+    保存に成功した場合はTrue
     """
+    workbook = os.path.basename(output_path)
+    if isinstance(data, dict):
+        data = [data]
     try:
-        # データが辞書の場合はリストに変換
-        if isinstance(data, dict):
-            data = [data]
-
-        # 既存のExcelファイルがあれば読み込み、なければ新規作成
-        try:
-            wb = load_workbook(output_path)
-            ws = wb.active
-            # 既存のデータの最後のIDを取得
-            last_row = ws.max_row
-            start_id = ws.cell(row=last_row, column=1).value + 1 if last_row > 1 else 1
-        except FileNotFoundError:
-            wb = Workbook()
-            ws = wb.active
-            headers = ['ID', '発行日', '支払先名', '金額', 'インボイス番号']
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col)
-                cell.value = header
-                cell.font = Font(bold=True)
-                cell.alignment = Alignment(horizontal='left')
-            start_id = 1
-
-        # スタイルの設定
-        alignment = Alignment(horizontal='left')
-
-        # 新しいデータの追加
-        current_row = ws.max_row + 1 if os.path.exists(output_path) else 2
-
-        # 複数のデータを追加
-        for item in data:
-            ws.cell(row=current_row, column=1, value=start_id).alignment = alignment
-            ws.cell(row=current_row, column=2, value=item.get('発行日', '')).alignment = alignment
-            ws.cell(row=current_row, column=3, value=item.get('支払先名', '')).alignment = alignment
-            ws.cell(row=current_row, column=4, value=item.get('金額', '')).alignment = alignment
-            ws.cell(row=current_row, column=5, value=item.get('インボイス番号', '')).alignment = alignment
-
-            start_id += 1
-            current_row += 1
-
-        # 列幅の自動調整
-        for col in range(1, 6):
-            max_length = 0
-            column = get_column_letter(col)
-
-            for cell in ws[column]:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column].width = adjusted_width
-
-        # ファイルの保存
-        wb.save(output_path)
-        print(f"Excelファイルを保存しました: {output_path}")
+        if os.path.exists(output_path) and workbook not in ledger.list_workbooks():
+            ledger.import_workbooks(os.path.dirname(output_path) or ".")
+        call_id = uuid.uuid4().hex
+        ledger.add_receipts(workbook, [{"key": f"excel:{call_id}:{i}", "result": row} for i, row in enumerate(data)])
+        sync_workbook(output_path, lambda after_id: ledger.fetch_rows(workbook, after_id))
         return True
-
     except Exception as e:
-        print(f"Excelファイルの作成中にエラーが発生しました: {str(e)}")
+        logger.exception(f"Excelファイルの作成中にエラーが発生しました: {str(e)}")
         return False
@@ -0,0 +1,205 @@
+import re
+from datetime import date
+
+# OCRテキストから各項目を抽出するパターン（インポート時に1度だけコンパイルする）
+# テキストは1行ずつ1回だけ走査し、各行に全項目のパターンを適用して重み付きの候補を作る（iter_candidates）
+# 優先度の最も高い候補を選ぶ抽出（extract_fields）と重み付きの投票で選ぶ抽出（extract_scored）は、
+# 同じ候補から値を選ぶ方法だけが異なる
+
+# 金額の表記（"1,000"・カンマをドットと誤認識した "8.800"・"1000"）
+_AMOUNT = r"(\d[\d,]*(?:\.\d{3})*)"
+
+# (項目, パターン, 重み, 行に含まれている必要がある文字（いずれか。Noneは全ての行）)
+# 項目ごとに重みの大きい順に並べる（同じ重みの場合は先に並べたパターンを優先する）
+PATTERNS = [
+    # 発行日: 西暦・和暦の表記
+    ("発行日", re.compile(r"(?<!\d)(\d{4})\s*[-/年]\s*(\d{1,2})\s*[-/月]\s*(\d{1,2})"), 3, ("年", "/", "-")),
+    ("発行日", re.compile(r"(令和|R|㎶|H)\s*(\d{1,2}|元)年\s*(\d{1,2})月\s*(\d{1,2})日"), 2, ("年",)),
+    ("発行日", re.compile(r"(?<!\d)(\d{2})\s*[-/年]\s*(\d{1,2})\s*[-/月]\s*(\d{1,2})"), 1, ("年", "/", "-")),
+    # 支払先名: 会社形態や「様」「御中」の前後
+    ("支払先名", re.compile(r"(.+)(?:株式会社|有限会社|合同会社|事務所)"), 3, ("会社", "事務所")),  # 会社形態が後ろにある場合
+    ("支払先名", re.compile(r"(?:株式会社|有限会社|合同会社)(.+)"), 2, ("会社",)),  # 会社形態が前にある場合
+    ("支払先名", re.compile(r"(.+)(?:様|御中)"), 1, ("様", "御中")),  # 様や御中で終わる場合
+    # 金額: 合計金額の見出し → 金額・税込の見出し・通貨記号 → 数字のみ
+    (
+        "金額",
+        re.compile(r"(?:領収金額|お支払金額|ご利用金額|合計金額|利用金額|お会計|合計|小計)[\s:：]*[¥\\]?\s*" + _AMOUNT),
+        3,
+        ("金額", "お会計", "合計", "小計"),
+    ),
+    ("金額", re.compile(r"金額[\s:：]*[¥\\]?\s*" + _AMOUNT), 2, ("金額",)),
+    ("金額", re.compile(r"(?:税込金額|税込み|税込)[\s:：]*[¥\\]?\s*" + _AMOUNT), 2, ("税込",)),
+    ("金額", re.compile(r"[¥\\]\s*" + _AMOUNT), 2, ("¥", "\\")),  # ¥・\マークで始まる金額
+    ("金額", re.compile(r"(\d[\d,]*)円"), 1, ("円",)),  # 円で終わる金額
+    ("金額", re.compile(r"([0-9]+[\s\.]+[0-9]+)"), 1, None),  # 数字のみの場合（最も優先度低）
+    # インボイス番号
+    ("インボイス番号", re.compile(r"(?:登録番号|登録得号)[\s:：]*T?([0-9]{13})"), 3, ("登録",)),
+    ("インボイス番号", re.compile(r"T([0-9]{13})"), 2, ("T",)),
+]
+COMPANY_KEYWORD = re.compile(r"株式会社|有限会社|合同会社|事務所|様|御中")
+
+# 金額として妥当な範囲（100円未満は税額・数量などの誤検出、1000万円を超える金額は誤認識の可能性が高い）
+MIN_AMOUNT = 100
+MAX_AMOUNT = 10000000
+
+# 数字を含む行だけを調べる項目
+_NUMERIC_FIELDS = frozenset(["発行日", "金額", "インボイス番号"])
+_HAS_DIGIT = re.compile(r"\d")
+_NON_DIGIT = re.compile(r"[^\d]")
+
+FIELDS = ["発行日", "支払先名", "金額", "インボイス番号"]
+# 抽出結果に付与する付加情報（抽出方法・PDFのページ番号）
+METHOD_KEY = "抽出方法"
+PAGE_KEY = "ページ"
+
+
+def format_date(match):
+    """日付パターンのマッチ結果をYYYY/MM/DD形式に変換（和暦は西暦に変換）"""
+    groups = match.groups()
+    if len(groups) == 4:
+        era, year, month, day = groups
+        year = 1 if year == "元" else int(year)
+        # 令和は2019年、平成は1989年が元年
+        year += 1988 if era == "H" else 2018
+    else:
+        year, month, day = groups
+        year = int(year)
+        if year < 100:
+            year += 2000
+    return f"{year:04d}/{int(month):02d}/{int(day):02d}"
+
+
+def is_valid_date(value):
+    """YYYY/MM/DD形式の日付が存在する日付か"""
+    try:
+        date(*(int(part) for part in value.split("/")))
+    except ValueError:
+        return False
+    return True
+
+
+def is_valid_amount(amount):
+    """金額（数値）が妥当な範囲か。1の位は検証しない（消費税込みの合計金額は1の位が0とは限らない）"""
+    return MIN_AMOUNT <= amount <= MAX_AMOUNT
+
+
+def parse_amount(amount_str):
+    """
+    金額の文字列を数値に変換（"8.800" のようにカンマを誤認識したドット区切りは 8800 とする）
+    妥当な範囲（is_valid_amount）にない金額、金額として妥当でない値は0を返す
+    """
+    amount_str = amount_str.replace(" ", "").replace(",", "")
+    if "." in amount_str:
+        parts = amount_str.split(".")
+        if len(parts) == 2:
+            amount_str = parts[0] + parts[1].ljust(3, "0")
+    amount_str = _NON_DIGIT.sub("", amount_str)
+    if not amount_str:
+        return 0
+    amount = int(amount_str)
+    return amount if is_valid_amount(amount) else 0
+
+
+def _date_value(match):
+    value = format_date(match)
+    return value if is_valid_date(value) else None
+
+
+def _amount_value(match):
+    amount_str = match.group(1).replace(",", "")
+    # 数字とカンマだけの金額はそのまま変換する（ドット・空白を含む場合は parse_amount で補正する）
+    amount = int(amount_str) if amount_str.isdigit() else parse_amount(amount_str)
+    return str(amount) if is_valid_amount(amount) else None
+
+
+# マッチ結果を項目の値に変換する関数（値として妥当でない場合はNone）
+_VALUE_PARSERS = {
+    "発行日": _date_value,
+    "支払先名": lambda match: match.group(1).strip() or None,
+    "金額": _amount_value,
+    "インボイス番号": lambda match: "T" + match.group(1),
+}
+
+# 走査に使う表: (優先度, 項目, パターン, 重み, 値への変換)
+_SCAN_TABLE = [(priority, field, pattern, weight, _VALUE_PARSERS[field]) for priority, (field, pattern, weight, _) in enumerate(PATTERNS)]
+# 行に含まれる文字（PATTERNS の「行に含まれている必要がある文字」）ごとに、照合するパターンのビットマスク
+_TRIGGER_MASKS = {
+    trigger: sum(1 << priority for priority, (*_, triggers) in enumerate(PATTERNS) if trigger in (triggers or ()))
+    for trigger in {trigger for *_, triggers in PATTERNS for trigger in triggers or ()}
+}
+# 行に含まれる文字を1回の照合でまとめて探すパターン
+_TRIGGER_PATTERN = re.compile("|".join(re.escape(trigger) for trigger in sorted(_TRIGGER_MASKS, key=len, reverse=True)))
+# 全ての行で照合するパターン・数字を含まない行でも照合するパターンのビットマスク
+_ALWAYS_MASK = sum(1 << priority for priority, (_, _, _, triggers) in enumerate(PATTERNS) if not triggers)
+_NON_NUMERIC_MASK = sum(1 << priority for priority, (field, *_) in enumerate(PATTERNS) if field not in _NUMERIC_FIELDS)
+# ビットマスクごとの照合するパターンの表（優先度の順）
+_entries_by_mask = {}
+
+
+def _entries_for(mask):
+    entries = _entries_by_mask.get(mask)
+    if entries is None:
+        entries = _entries_by_mask[mask] = [entry for entry in _SCAN_TABLE if mask >> entry[0] & 1]
+    return entries
+
+
+def iter_candidates(text):
+    """
+    コンパイル済みのパターン（PATTERNS）でテキストを1行ずつ1回だけ走査し、全項目の候補を出現順に返す
+
+    各候補は (項目, {"value": 値, "weight": 重み, "rank": 優先度（小さいほど良い）, "line": 行番号})。
+    金額は妥当な範囲の全てのマッチ、その他の項目はパターンごとにテキスト内の最初の有効なマッチ
+    （発行日は存在する日付）のみを候補とする。
+    """
+    # 候補を見つけたパターンの優先度（金額のパターンは全てのマッチを候補とするため含めない）
+    found = set()
+
+    for line_no, line in enumerate(text.split("\n")):
+        mask = _ALWAYS_MASK
+        for trigger in _TRIGGER_PATTERN.findall(line):
+            mask |= _TRIGGER_MASKS[trigger]
+        if not _HAS_DIGIT.search(line):
+            mask &= _NON_NUMERIC_MASK
+        for priority, field, pattern, weight, parse in _entries_for(mask):
+            if priority in found:
+                continue
+            for match in pattern.finditer(line):
+                value = parse(match)
+                if value is None:
+                    continue
+                yield field, {"value": value, "weight": weight, "rank": (-weight, priority, line_no, match.start()), "line": line_no}
+                if field != "金額":
+                    found.add(priority)
+                    break
+
+
+def extract_candidates(text):
+    """テキストから全項目の候補を抽出し（iter_candidates）、項目ごとに優先度の高い順に並べて返す"""
+    candidates = {field: [] for field in FIELDS}
+    for field, candidate in iter_candidates(text):
+        candidates[field].append(candidate)
+    for field in FIELDS:
+        candidates[field].sort(key=lambda candidate: candidate["rank"])
+    return candidates
+
+
+def extract_fields(text):
+    """テキストから全項目を抽出し、各項目の最も優先度の高い候補を返す"""
+    candidates = extract_candidates(text)
+    return {field: candidates[field][0]["value"] if candidates[field] else "" for field in FIELDS}
+
+
+def extract_scored(text):
+    """
+    テキストから全項目を抽出し、重み付きの投票で値を選ぶ
+    金額は同じ金額の候補の重みを合計した得点が最も大きいもの（同じ得点の場合は優先度の高いもの）、
+    その他の項目は extract_fields と同じく最も優先度の高い候補を選ぶ
+    """
+    candidates = extract_candidates(text)
+    result = {field: candidates[field][0]["value"] if candidates[field] else "" for field in FIELDS}
+    amount_scores = {}
+    for candidate in candidates["金額"]:
+        amount_scores[candidate["value"]] = amount_scores.get(candidate["value"], 0) + candidate["weight"]
+    if amount_scores:
+        result["金額"] = max(amount_scores, key=amount_scores.get)
+    return result
@@ -0,0 +1,478 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from PIL import Image
+import google.generativeai as genai
+
+from utils import log, metrics
+
+from config import (
+    GEMINI_MODEL_NAME,
+    GEMINI_TIMEOUT,
+    GEMINI_TIMEOUT_GRACE,
+    GEMINI_TRANSPORT,
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_RATE_PER_MINUTE,
+    GEMINI_BURST,
+    GEMINI_RATE_DB_PATH,
+    GEMINI_MAX_RETRIES,
+    GEMINI_BACKOFF_BASE,
+    GEMINI_BACKOFF_MAX,
+    GEMINI_DEADLINE,
+    GEMINI_IMAGE_MAX_DIM,
+    GEMINI_IMAGE_QUALITY,
+    GEMINI_IMAGE_GRAYSCALE,
+    GEMINI_IMAGE_CROP,
+    GEMINI_PAYLOAD_CACHE_SIZE,
+)
+
+logger = log.get_logger(__name__)
+
+# リトライ対象のHTTPステータス（レート制限・サーバーエラー）
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# プロセス内で共有するGeminiのモデル（モデル名ごと）
+_lock = threading.Lock()
+_configured_pid = None
+_models = {}
+
+# プロセス内で共有するディスパッチャー
+_dispatcher_lock = threading.Lock()
+_dispatcher = None
+
+# エンコード済みの画像ペイロード（同じ画像の繰り返し送信で再利用する）
+_payload_lock = threading.Lock()
+_payload_cache = OrderedDict()
+
+
+class GeminiUnavailableError(RuntimeError):
+    """リトライ上限または期限までにGemini APIの呼び出しが成功しなかった"""
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限（asyncio用）"""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, deadline=None):
+        """トークンを1つ取得するまで待機（期限を過ぎる場合はTimeoutError）"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+                if deadline is not None and now + wait > deadline:
+                    raise TimeoutError("レート制限の待機中に期限を超えました")
+                await asyncio.sleep(wait)
+
+
+class SharedTokenBucket:
+    """
+    SQLiteにトークンの残量を保存し、複数のプロセスで共有するトークンバケット（asyncio用）
+    gunicornの各ワーカー・utils.batch のワーカーなど、同じDBを使う全てのプロセスの合計を rate に制限する
+    """
+
+    def __init__(self, rate_per_second, capacity, db_path, name="gemini"):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.db_path = db_path
+        self.name = name
+        self._lock = asyncio.Lock()
+        # 接続はスレッドごとに1つ作成して再利用する（トークンを取得するたびに接続しない）
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _take(self):
+        """トークンを1つ取得できれば0を、できなければ次のトークンまでの待ち時間（秒）を返す"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # プロセス間で比較するため、単調増加の時計ではなく時刻を使う
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens = self.capacity if row is None else row[0] + max(0.0, now - row[1]) * self.rate
+            tokens = min(self.capacity, tokens)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                (self.name, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    async def acquire(self, deadline=None):
+        """トークンを1つ取得するまで待機（期限を過ぎる場合はTimeoutError）"""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                # DBのロック待ちでイベントループを止めないよう、別スレッドで実行する
+                wait = await loop.run_in_executor(None, self._take)
+                if wait <= 0:
+                    return
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    raise TimeoutError("レート制限の待機中に期限を超えました")
+                await asyncio.sleep(wait)
+
+
+def is_retryable(error):
+    """リトライすべきエラーか（429/5xx・タイムアウト）"""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    # google.api_core の例外と urllib の HTTPError はいずれも code にHTTPステータスを持つ
+    status = getattr(error, "code", None)
+    return isinstance(status, int) and status in RETRYABLE_STATUS
+
+
+class GeminiDispatcher:
+    """
+    Gemini APIへのリクエストを1つのイベントループで管理する
+    - トークンバケットによるレート制限（rate_db_path を指定した場合は同じDBを使うプロセス間で共有する）
+    - 同時実行数の上限
+    - 429/5xxに対する指数バックオフ（ジッター付き）でのリトライ
+    - リクエストごとの期限
+
+    send には timeout（秒）を受け取ってリクエストを実行する同期関数を渡す。send は timeout をAPIのクライアントに渡し、
+    呼び出しを打ち切ってスレッドを解放すること（呼び出し元は timeout に猶予を加えた時間だけ待つが、
+    打ち切られなかった呼び出しのスレッドは終わるまで同時実行数の枠を使い続ける）。
+    実際のAPIの代わりにスタブサーバーへ送信する関数を渡して負荷試験に使用できる。
+    """
+
+    def __init__(
+        self,
+        rate_per_minute=None,
+        burst=None,
+        max_concurrency=None,
+        max_retries=None,
+        backoff_base=None,
+        backoff_max=None,
+        deadline=None,
+        timeout=None,
+        rate_db_path=None,
+        timeout_grace=None,
+    ):
+        self.rate_per_second = (rate_per_minute or GEMINI_RATE_PER_MINUTE) / 60.0
+        self.burst = burst or GEMINI_BURST
+        self.max_concurrency = max_concurrency or GEMINI_MAX_CONCURRENCY
+        self.max_retries = GEMINI_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = backoff_base or GEMINI_BACKOFF_BASE
+        self.backoff_max = backoff_max or GEMINI_BACKOFF_MAX
+        self.deadline = deadline or GEMINI_DEADLINE
+        self.timeout = timeout or GEMINI_TIMEOUT
+        self.timeout_grace = GEMINI_TIMEOUT_GRACE if timeout_grace is None else timeout_grace
+        # 空文字列の場合はプロセス内だけで制限する
+        self.rate_db_path = GEMINI_RATE_DB_PATH if rate_db_path is None else rate_db_path
+        self.stats = {"requests": 0, "succeeded": 0, "retries": 0, "failed": 0}
+
+        self._stats_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="gemini-send")
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, name="gemini-dispatcher", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        if self.rate_db_path:
+            self._bucket = SharedTokenBucket(self.rate_per_second, self.burst, self.rate_db_path)
+        else:
+            self._bucket = TokenBucket(self.rate_per_second, self.burst)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._loop.call_soon(self._ready.set)
+        self._loop.run_forever()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _backoff(self, attempt):
+        # 指数バックオフ（フルジッター）
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2**attempt)))
+
+    async def dispatch(self, send, deadline=None, correlation_id=None):
+        """レート制限・同時実行数の制御・リトライを行いながら send を実行"""
+        if correlation_id:
+            # リトライのログを呼び出し元のリクエスト・ジョブと結び付ける
+            log.correlation_id.set(correlation_id)
+        self._count("requests")
+        expires = time.monotonic() + (deadline or self.deadline)
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._bucket.acquire(expires)
+                future, timeout = await self._start(send, expires)
+                # 猶予を超えて待つのをやめても、スレッドの呼び出しは止まらないため future は取り消さない
+                result = await asyncio.wait_for(asyncio.shield(future), timeout + self.timeout_grace)
+                self._count("succeeded")
+                return result
+            except Exception as e:
+                last_error = e
+                if not is_retryable(e) or attempt == self.max_retries:
+                    break
+                delay = self._backoff(attempt)
+                if time.monotonic() + delay >= expires:
+                    break
+                self._count("retries")
+                logger.warning(f"Gemini APIの呼び出しに失敗しました。{delay:.1f}秒後に再試行します: {str(e)}")
+                await asyncio.sleep(delay)
+
+        self._count("failed")
+        raise GeminiUnavailableError(f"Gemini APIの呼び出しに失敗しました: {str(last_error)}") from last_error
+
+    async def _start(self, send, expires):
+        """
+        同時実行数の枠を取得して send をスレッドで開始し、(future, timeout) を返す
+        枠は send のスレッドが終わった時点で解放する（呼び出し元が待つのをやめた場合も、ハングした呼び出しが
+        終わるまでは新しい呼び出しを開始せず、スレッドを使い切らないようにする）
+        """
+        await self._semaphore.acquire()
+        try:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("リクエストの期限を超えました")
+            timeout = min(self.timeout, remaining)
+            future = self._loop.run_in_executor(self._executor, send, timeout)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        future.add_done_callback(self._finish)
+        return future, timeout
+
+    def _finish(self, future):
+        self._semaphore.release()
+        # 呼び出し元が待つのをやめた場合も、例外を取得済みにして未取得の警告を出さない
+        if not future.cancelled():
+            future.exception()
+
+    def submit(self, send, deadline=None):
+        """リクエストを登録し、concurrent.futures.Future を返す"""
+        return asyncio.run_coroutine_threadsafe(
+            self.dispatch(send, deadline, log.correlation_id.get()), self._loop
+        )
+
+    def call(self, send, deadline=None):
+        """リクエストを実行して結果を待つ（同期呼び出し用）"""
+        return self.submit(send, deadline).result()
+
+    def close(self):
+        """イベントループとスレッドを停止"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=False)
+
+
+def get_dispatcher():
+    """プロセス内で共有するディスパッチャーを取得（初回のみ作成）"""
+    global _dispatcher
+    with _dispatcher_lock:
+        # fork後の子プロセスではイベントループのスレッドが存在しないため作り直す
+        if _dispatcher is None or _dispatcher.pid != os.getpid():
+            _dispatcher = GeminiDispatcher()
+            _dispatcher.pid = os.getpid()
+        return _dispatcher
+
+
+def get_model(model_name=None):
+    """
+    プロセス内で共有するGenerativeModelを取得（初回のみ作成）
+    APIキーが設定されていない場合はNoneを返す
+
+    genai.configureは既定のクライアント（接続）を作り直すため、プロセスごとに1回だけ呼び出す。
+    以降の呼び出しでは同じクライアントの接続を再利用する。
+    """
+    global _configured_pid
+    model_name = model_name or GEMINI_MODEL_NAME
+
+    with _lock:
+        # fork後の子プロセスでは親の接続を引き継がずに作り直す
+        if _configured_pid != os.getpid():
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                return None
+            genai.configure(api_key=api_key, transport=GEMINI_TRANSPORT)
+            _models.clear()
+            _configured_pid = os.getpid()
+
+        model = _models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            _models[model_name] = model
+        return model
+
+
+def generate_content(contents, model_name=None, deadline=None):
+    """
+    共有モデルでコンテンツを生成（ディスパッチャー経由でレート制限・リトライを行う）
+
+    Parameters:
+    contents: プロンプトと画像のリスト
+    model_name: モデル名（省略時は設定値）
+    deadline: リトライを含めた期限（秒）。省略時は設定値
+    """
+    model = get_model(model_name)
+    if model is None:
+        raise RuntimeError("Gemini APIキーが設定されていません")
+
+    # 呼び出し元のスレッドで取得する（sendはディスパッチャーのスレッドで実行される）
+    count_call = metrics.gemini_call_counter()
+
+    def send(timeout):
+        try:
+            response = model.generate_content(contents, request_options={"timeout": timeout})
+        except Exception:
+            count_call("error")
+            raise
+        count_call("ok")
+        return response
+
+    return get_dispatcher().call(send, deadline)
+
+
+def _payload_cache_key(image, settings):
+    """画像の内容と変換設定からキャッシュキーを作成"""
+    if isinstance(image, str):
+        stat = os.stat(image)
+        source = f"{os.path.abspath(image)}:{stat.st_mtime_ns}:{stat.st_size}".encode("utf-8")
+    elif isinstance(image, np.ndarray):
+        source = np.ascontiguousarray(image).data
+    elif isinstance(image, Image.Image):
+        source = image.tobytes()
+    else:
+        source = bytes(image)
+    return hashlib.blake2b(source, digest_size=16).hexdigest() + repr(settings)
+
+
+def _decode(image):
+    """画像パス・バイト列・PIL画像・NumPy配列をNumPy配列（BGRまたはグレースケール）に変換"""
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, Image.Image):
+        return cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+    if isinstance(image, str):
+        return cv2.imread(image, cv2.IMREAD_COLOR)
+    return cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+
+
+def crop_to_receipt(image):
+    """
+    背景より明るい最大の領域（領収書）で画像を切り出す
+    領収書が画像の大部分を占める場合や検出できない場合はそのまま返す
+    """
+    gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # 検出は縮小画像で行う
+    scale = min(1.0, 800 / max(gray.shape))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    _, mask = cv2.threshold(cv2.GaussianBlur(small, (5, 5), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((15, 15), np.uint8))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return image
+
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    area_ratio = (w * h) / float(small.shape[0] * small.shape[1])
+    if area_ratio < 0.2 or area_ratio > 0.9:
+        return image
+
+    # 余白を付けて元の解像度の座標に戻す
+    margin = int(0.02 * max(small.shape))
+    x0 = max(0, int((x - margin) / scale))
+    y0 = max(0, int((y - margin) / scale))
+    x1 = min(image.shape[1], int((x + w + margin) / scale))
+    y1 = min(image.shape[0], int((y + h + margin) / scale))
+    return image[y0:y1, x0:x1]
+
+
+def prepare_image_payload(image, max_dim=None, quality=None, grayscale=None, crop=None):
+    """
+    Geminiへ送信する画像を縮小・グレースケール化・切り出しし、JPEGにエンコードする
+    エンコード結果はプロセス内でキャッシュし、同じ画像の繰り返し送信で再利用する
+
+    Parameters:
+    image: 画像パス、バイト列、PIL画像、NumPy配列、またはこの関数の戻り値（そのまま返す）
+    max_dim: 長辺の最大ピクセル数
+    quality: JPEGの品質
+    grayscale: グレースケールに変換するか
+    crop: 領収書部分を切り出すか
+
+    Returns:
+    {"mime_type": "image/jpeg", "data": バイト列}
+    """
+    if isinstance(image, dict):
+        return image
+
+    settings = (
+        max_dim or GEMINI_IMAGE_MAX_DIM,
+        quality or GEMINI_IMAGE_QUALITY,
+        GEMINI_IMAGE_GRAYSCALE if grayscale is None else grayscale,
+        GEMINI_IMAGE_CROP if crop is None else crop,
+    )
+    max_dim, quality, grayscale, crop = settings
+
+    key = _payload_cache_key(image, settings)
+    with _payload_lock:
+        payload = _payload_cache.get(key)
+        if payload is not None:
+            _payload_cache.move_to_end(key)
+            return payload
+
+    array = _decode(image)
+    if array is None:
+        raise ValueError("画像の読み込みに失敗しました")
+    if len(array.shape) == 3 and array.shape[2] == 4:
+        array = cv2.cvtColor(array, cv2.COLOR_BGRA2BGR)
+
+    if crop:
+        array = crop_to_receipt(array)
+    if grayscale and len(array.shape) == 3:
+        array = cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
+
+    scale = max_dim / float(max(array.shape[:2]))
+    if scale < 1:
+        array = cv2.resize(array, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    ok, encoded = cv2.imencode(".jpg", array, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("画像のエンコードに失敗しました")
+    payload = {"mime_type": "image/jpeg", "data": encoded.tobytes()}
+
+    with _payload_lock:
+        _payload_cache[key] = payload
+        while len(_payload_cache) > GEMINI_PAYLOAD_CACHE_SIZE:
+            _payload_cache.popitem(last=False)
+    return payload
@@ -0,0 +1,677 @@
+import os
+import json
+import contextlib
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from utils import log, metrics
+from config import (
+    JOB_DB_PATH,
+    JOB_WORKERS,
+    JOB_POLL_INTERVAL,
+    JOB_LEASE_SECONDS,
+    JOB_HEARTBEAT_INTERVAL,
+    JOB_MAX_PENDING_FILES,
+    JOB_MAX_BUFFERED_FILES,
+    JOB_BUFFER_TIMEOUT,
+    JOB_EVENT_RETENTION_SECONDS,
+)
+
+logger = log.get_logger(__name__)
+
+# ジョブ・ファイルの状態
+# receiving はジョブの段階（ファイルを登録中。ワーカーは登録済みのファイルから処理し、残りの登録を待つ）
+STATUS_RECEIVING = "receiving"
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    excel_file TEXT NOT NULL,
+    options TEXT NOT NULL DEFAULT '{}',
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    heartbeat REAL,
+    receiving INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    content BLOB,
+    source_hash TEXT,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS idx_job_files_status ON job_files (status);
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_job_events_job ON job_events (job_id, id);
+CREATE INDEX IF NOT EXISTS idx_job_events_created ON job_events (created_at);
+"""
+
+# ファイルを登録する際に1回のトランザクションで追加する件数と内容の合計サイズ（バイト）の上限
+_ENQUEUE_CHUNK = 50
+_ENQUEUE_CHUNK_BYTES = 32 * 1024 * 1024
+
+_workers_lock = threading.Lock()
+_workers_pid = None
+_workers = []
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _connect(db_path=None):
+    """SQLiteへの接続を作成（プロセス・スレッドごとに都度接続する）"""
+    conn = sqlite3.connect(db_path or JOB_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_db(db_path=None):
+    """ジョブキュー用のテーブルを作成"""
+    db_path = db_path or JOB_DB_PATH
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = _connect(db_path)
+    try:
+        conn.executescript(_SCHEMA)
+        # アップロードの内容を保持する列がない（以前に作成した）DBには列を追加する
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(job_files)")}
+        if "content" not in columns:
+            conn.execute("ALTER TABLE job_files ADD COLUMN content BLOB")
+        if "source_hash" not in columns:
+            conn.execute("ALTER TABLE job_files ADD COLUMN source_hash TEXT")
+        if "receiving" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN receiving INTEGER NOT NULL DEFAULT 0")
+    finally:
+        conn.close()
+
+
+def enqueue_job(excel_file, files, options=None):
+    """
+    ジョブをキューに登録し、ジョブIDを返す（ファイルが1件もない場合は登録せずNoneを返す）
+
+    Parameters:
+    excel_file: 出力先のExcelファイル名
+    files: (元のファイル名, 保存先パス, 内容のバイト列) のリストまたはイテレータ
+        内容を指定した場合はディスクのファイルを読まずに処理する（保存先パスはNoneでもよい）
+        内容を省略した (元のファイル名, 保存先パス) も指定できる
+        少しずつ（_ENQUEUE_CHUNK 件・_ENQUEUE_CHUNK_BYTES ごとに）登録するため、イテレータの場合は全ファイルの内容をメモリに保持しない
+    options: 処理オプション（辞書）
+
+    ジョブは登録中からワーカーに取得され、登録済みのファイルから処理される。
+    内容を保持した未処理のファイルが JOB_MAX_BUFFERED_FILES 件に達している間は、処理が進むまで登録を待つ
+    （JOB_BUFFER_TIMEOUT 秒の間処理が進まない場合は TimeoutError）。
+    """
+    from utils import cache
+
+    job_id = uuid.uuid4().hex
+    now = _now()
+    conn = _connect()
+    try:
+        # 登録中（receiving=1）のジョブもワーカーが取得し、登録済みのファイルから処理する
+        conn.execute(
+            "INSERT INTO jobs (id, status, excel_file, options, created_at, updated_at, receiving) "
+            "VALUES (?, ?, ?, ?, ?, ?, 1)",
+            (job_id, STATUS_QUEUED, excel_file, json.dumps(options or {}, ensure_ascii=False), now, now),
+        )
+        count = 0
+        rows = []
+        size = 0
+        try:
+            for file in files:
+                filename, filepath, content = (tuple(file) + (None,))[:3]
+                source_hash = cache.hash_bytes(content) if content is not None else None
+                rows.append((job_id, count, filename, filepath or "", content, source_hash, STATUS_QUEUED, now))
+                count += 1
+                size += len(content or b"")
+                if len(rows) >= min(_ENQUEUE_CHUNK, JOB_MAX_BUFFERED_FILES) or size >= _ENQUEUE_CHUNK_BYTES:
+                    _wait_for_buffer(conn, job_id, len(rows))
+                    _insert_files(conn, rows)
+                    rows = []
+                    size = 0
+            if rows:
+                _wait_for_buffer(conn, job_id, len(rows))
+            _insert_files(conn, rows)
+        except BaseException as e:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = COALESCE(error, ?), receiving = 0, updated_at = ? WHERE id = ?",
+                (STATUS_FAILED, f"ファイルの登録中にエラーが発生しました: {str(e)}", _now(), job_id),
+            )
+            conn.execute("UPDATE job_files SET content = NULL WHERE job_id = ?", (job_id,))
+            _add_event(conn, job_id, "job", {"status": STATUS_FAILED, "error": "ファイルの登録中にエラーが発生しました"})
+            raise
+
+        if count == 0:
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            return None
+        conn.execute("UPDATE jobs SET receiving = 0, updated_at = ? WHERE id = ?", (_now(), job_id))
+        status = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()["status"]
+        _add_event(conn, job_id, "job", {"status": status, "total": count})
+    finally:
+        conn.close()
+
+    logger.info(f"ジョブを登録しました: {job_id} ({count}件)", extra={"job_id": job_id})
+    return job_id
+
+
+def _buffered_count(conn, job_id):
+    """ジョブの内容を保持した未処理（待機中・実行中）のファイル数"""
+    return conn.execute(
+        "SELECT COUNT(*) FROM job_files WHERE job_id = ? AND content IS NOT NULL AND status IN (?, ?)",
+        (job_id, STATUS_QUEUED, STATUS_RUNNING),
+    ).fetchone()[0]
+
+
+def _wait_for_buffer(conn, job_id, adding):
+    """
+    内容を保持した未処理のファイルに adding 件を加えても JOB_MAX_BUFFERED_FILES 件以下になるまで待つ
+    JOB_BUFFER_TIMEOUT 秒の間ファイルの処理が進まない（未処理のファイルが減らない）場合は TimeoutError
+    """
+    lowest = None
+    progressed = time.monotonic()
+    while True:
+        row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row["status"] == STATUS_FAILED:
+            raise RuntimeError("ジョブの処理に失敗したため、ファイルの登録を中断しました")
+        buffered = _buffered_count(conn, job_id)
+        if buffered == 0 or buffered + adding <= JOB_MAX_BUFFERED_FILES:
+            return
+        if lowest is None or buffered < lowest:
+            lowest = buffered
+            progressed = time.monotonic()
+        elif time.monotonic() - progressed > JOB_BUFFER_TIMEOUT:
+            raise TimeoutError("処理待ちのファイルが減らないため、ファイルの登録を中断しました")
+        time.sleep(JOB_POLL_INTERVAL)
+
+
+def _add_event(conn, job_id, event_type, data):
+    conn.execute(
+        "INSERT INTO job_events (job_id, type, data, created_at) VALUES (?, ?, ?, ?)",
+        (job_id, event_type, json.dumps(data, ensure_ascii=False), time.time()),
+    )
+
+
+def add_event(job_id, event_type, data):
+    """
+    ジョブの進捗のイベントを記録する（/jobs/<job_id>/events で配信する）
+
+    Parameters:
+    event_type: "job"（ジョブの状態・段階）または "file"（ファイル・ページの段階）
+    data: イベントの内容（辞書）
+    """
+    conn = _connect()
+    try:
+        _add_event(conn, job_id, event_type, data)
+    finally:
+        conn.close()
+
+
+def get_events(job_id, after_id=0, limit=500):
+    """after_id より後に記録されたジョブのイベントを記録順に取得"""
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT id, type, data FROM job_events WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (job_id, after_id, limit),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [{"id": row["id"], "type": row["type"], "data": json.loads(row["data"])} for row in rows]
+
+
+def last_event_id(job_id):
+    """ジョブの最後に記録されたイベントのID（イベントがない場合は0）"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT MAX(id) FROM job_events WHERE job_id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] or 0
+
+
+class FileProgress:
+    """
+    ファイル単位の進捗をジョブのイベントとして記録する（progress.bind に渡す通知先）
+    プロセスプールのワーカーでも記録できるよう、pickle可能なクラスとする
+    """
+
+    def __init__(self, job_id, idx):
+        self.job_id = job_id
+        self.idx = idx
+
+    def __call__(self, stage, page=None, data=None):
+        event = {"index": self.idx, "stage": stage}
+        if page is not None:
+            event["page"] = page
+        event.update(data or {})
+        add_event(self.job_id, "file", event)
+
+
+def _insert_files(conn, rows):
+    if not rows:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO job_files (job_id, idx, filename, filepath, content, source_hash, status, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def pending_file_count():
+    """未処理（待機中・実行中のジョブの、待機中・実行中）のファイル数"""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            """
+            SELECT COUNT(*) FROM job_files f JOIN jobs j ON j.id = f.job_id
+            WHERE f.status IN (?, ?) AND j.status IN (?, ?)
+            """,
+            (STATUS_QUEUED, STATUS_RUNNING, STATUS_QUEUED, STATUS_RUNNING),
+        ).fetchone()
+        return row[0]
+    finally:
+        conn.close()
+
+
+def is_backlogged():
+    """未処理のファイルが上限（JOB_MAX_PENDING_FILES）に達しているか"""
+    return pending_file_count() >= JOB_MAX_PENDING_FILES
+
+
+def claim_next_job():
+    """
+    待機中のジョブを1件取得して実行中に変更する（ファイルを登録中のジョブも取得する）
+    ハートビートが途絶えた実行中ジョブ（ワーカー異常終了）も再取得の対象とする
+    """
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        stale_before = time.time() - JOB_LEASE_SECONDS
+        row = conn.execute(
+            """
+            SELECT * FROM jobs
+            WHERE status = ? OR (status = ? AND heartbeat < ?)
+            ORDER BY created_at LIMIT 1
+            """,
+            (STATUS_QUEUED, STATUS_RUNNING, stale_before),
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+
+        conn.execute(
+            "UPDATE jobs SET status = ?, heartbeat = ?, updated_at = ? WHERE id = ?",
+            (STATUS_RUNNING, time.time(), _now(), row["id"]),
+        )
+        _add_event(conn, row["id"], "job", {"status": STATUS_RUNNING})
+        conn.execute("COMMIT")
+        job = dict(row)
+        job["options"] = json.loads(job["options"] or "{}")
+        return job
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def get_job_files(job_id):
+    """
+    ジョブに含まれるファイルの一覧を取得
+    アップロードの内容（content）は読み込まず、有無を has_content に入れる（内容は load_content で取得する）
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT job_id, idx, filename, filepath, content IS NOT NULL AS has_content, source_hash, status, result, "
+            "error, updated_at FROM job_files WHERE job_id = ? ORDER BY idx",
+            (job_id,),
+        ).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def load_content(job_id, idx):
+    """ファイルの内容のバイト列を取得（保持していない場合はNone）"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT content FROM job_files WHERE job_id = ? AND idx = ?", (job_id, idx)).fetchone()
+    finally:
+        conn.close()
+    return bytes(row["content"]) if row is not None and row["content"] is not None else None
+
+
+def update_file(job_id, idx, status, result=None, error=None):
+    """
+    ファイル単位の状態を更新（ジョブのハートビートも更新する）
+    処理が完了したファイルは、保持していた内容を削除する
+    """
+    now = _now()
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE job_files SET status = ?, result = ?, error = ?, updated_at = ?"
+            + (", content = NULL" if status == STATUS_DONE else "")
+            + " WHERE job_id = ? AND idx = ?",
+            (
+                status,
+                json.dumps(result, ensure_ascii=False) if result is not None else None,
+                error,
+                now,
+                job_id,
+                idx,
+            ),
+        )
+        conn.execute("UPDATE jobs SET heartbeat = ?, updated_at = ? WHERE id = ?", (time.time(), now, job_id))
+        event = {"index": idx, "stage": status}
+        if error:
+            event["error"] = error
+        _add_event(conn, job_id, "file", event)
+    finally:
+        conn.close()
+
+
+def heartbeat(job_id):
+    """実行中のジョブのハートビートを更新（他のワーカーに再取得されないようリースを延長する）"""
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ?", (time.time(), job_id, STATUS_RUNNING)
+        )
+    finally:
+        conn.close()
+
+
+@contextlib.contextmanager
+def keep_alive(job_id, interval=None):
+    """
+    ブロック内の処理中、JOB_HEARTBEAT_INTERVAL ごとにジョブのハートビートを更新するスレッドを動かす
+    1ファイルの処理（ページ数の多いPDF・Geminiの再試行など）がリース期間より長くかかっても、
+    ジョブが他のワーカーに再取得されて二重に処理されないようにする
+    """
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval or JOB_HEARTBEAT_INTERVAL):
+            try:
+                heartbeat(job_id)
+            except Exception as e:
+                logger.warning(f"ハートビートの更新に失敗しました: {str(e)}", extra={"job_id": job_id})
+
+    thread = threading.Thread(target=run, name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def finish_job(job_id, status, error=None, summary=None):
+    """
+    ジョブを完了状態にする（成否にかかわらず、保持していたアップロードの内容を削除する）
+    summary は完了のイベントに含める内容（台帳に追加した行数など）
+    保持期間（JOB_EVENT_RETENTION_SECONDS）を過ぎた進捗のイベントも併せて削除する
+    """
+    metrics.inc(metrics.JOBS, status)
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+            (status, error, _now(), job_id),
+        )
+        conn.execute("UPDATE job_files SET content = NULL WHERE job_id = ?", (job_id,))
+        _add_event(conn, job_id, "job", dict(summary or {}, status=status, error=error))
+        conn.execute("DELETE FROM job_events WHERE created_at < ?", (time.time() - JOB_EVENT_RETENTION_SECONDS,))
+    finally:
+        conn.close()
+
+
+def get_job(job_id):
+    """ジョブの状態とファイルごとの結果を取得（存在しない場合はNone）"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        # 状態の確認ではアップロードの内容（content）を読み込まない
+        files = conn.execute(
+            "SELECT idx, filename, status, result, error FROM job_files WHERE job_id = ? ORDER BY idx", (job_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    # 状態ごとのファイル数（一括取り込みの進捗の確認用）
+    progress = {"total": len(files)}
+    for status in (STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED):
+        progress[status] = sum(1 for f in files if f["status"] == status)
+
+    return {
+        "id": row["id"],
+        "status": row["status"],
+        "receiving": bool(row["receiving"]),
+        "excel_file": row["excel_file"],
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "progress": progress,
+        "files": [
+            {
+                "index": f["idx"],
+                "filename": f["filename"],
+                "status": f["status"],
+                "result": json.loads(f["result"]) if f["result"] else None,
+                "error": f["error"],
+            }
+            for f in files
+        ],
+    }
+
+
+def _iter_sources(job_files):
+    """
+    ファイルの処理対象（内容のバイト列があれば (ファイル名, 内容)、なければ保存先パス）を順に返す
+    内容は iter_process_files が次のファイルを必要とした時点で読み込むため、処理中のファイルの分だけメモリに保持する
+    """
+    for job_file in job_files:
+        content = load_content(job_file["job_id"], job_file["idx"]) if job_file["has_content"] else None
+        yield job_file["filepath"] if content is None else (job_file["filename"], content)
+
+
+def _source_hash(job_file):
+    """元ファイルのハッシュ値（登録時に計算した値。内容・ファイルのいずれもない場合はNone）"""
+    from utils import cache
+
+    if job_file["source_hash"]:
+        return job_file["source_hash"]
+    if job_file["filepath"] and os.path.exists(job_file["filepath"]):
+        return cache.hash_file(job_file["filepath"])
+    return None
+
+
+def _receiving_state(job_id):
+    """ジョブの (状態, ファイルを登録中か)。ジョブが削除された場合はNone"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT status, receiving FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return (row["status"], bool(row["receiving"])) if row is not None else None
+
+
+def _process_files(job_id, pending, options, results):
+    """ファイルを並列に処理し、完了したものから状態を更新する（成功した結果は results に入れる）"""
+    from utils import ocr
+
+    for job_file in pending:
+        update_file(job_id, job_file["idx"], STATUS_RUNNING)
+
+    use_cache = False if options.get("bypass_cache") else None
+    debug = True if options.get("debug") else None
+
+    # ファイル・ページごとの段階（前処理・Tesseract・Gemini）をイベントとして記録する
+    def progress(i):
+        return FileProgress(job_id, pending[i]["idx"])
+
+    # アップロードの内容がある場合はファイルを読まずにバイト列のまま処理する
+    for i, result, error in ocr.iter_process_files(
+        _iter_sources(pending), use_cache=use_cache, debug=debug, progress_for=progress
+    ):
+        idx = pending[i]["idx"]
+        if not result:
+            update_file(job_id, idx, STATUS_FAILED, error=error or "データを抽出できませんでした")
+            continue
+        update_file(job_id, idx, STATUS_DONE, result=result)
+        results[idx] = result
+
+
+def process_job(job):
+    """
+    ジョブを実行する
+    1. 各ファイルのOCR処理とデータ抽出
+       ファイルを登録中のジョブは、登録済みのファイルを処理しながら残りの登録を待つ
+    2. 台帳への登録（Excelファイルはダウンロード時に台帳から生成する）
+    """
+    from utils import ledger
+
+    job_id = job["id"]
+    results = {}
+    handled = set()
+    waiting = False
+
+    while True:
+        # 登録中かどうかはファイルの一覧より先に確認する（登録の完了後に一覧を取得すれば全てのファイルが含まれる）
+        state = _receiving_state(job_id)
+        if state is None or state[0] == STATUS_FAILED:
+            # 登録に失敗した（登録されたファイルがなかった）ジョブ
+            return
+        job_files = get_job_files(job_id)
+        if not handled:
+            # 再取得したジョブの場合、処理済みのファイルは結果を再利用する
+            for job_file in job_files:
+                if job_file["status"] == STATUS_DONE:
+                    results[job_file["idx"]] = json.loads(job_file["result"]) if job_file["result"] else None
+                    handled.add(job_file["idx"])
+            pending = [job_file for job_file in job_files if job_file["status"] != STATUS_DONE]
+        else:
+            pending = [f for f in job_files if f["idx"] not in handled and f["status"] == STATUS_QUEUED]
+
+        if pending:
+            waiting = False
+            _process_files(job_id, pending, job["options"], results)
+            handled.update(job_file["idx"] for job_file in pending)
+            continue
+        if not state[1]:
+            break
+        if not waiting:
+            add_event(job_id, "job", {"status": STATUS_RUNNING, "stage": STATUS_RECEIVING})
+            waiting = True
+        time.sleep(JOB_POLL_INTERVAL)
+
+    # 入力順に結果を並べる（ExcelのIDはこの順に採番される）
+    files_by_idx = {job_file["idx"]: job_file for job_file in get_job_files(job_id)}
+    entries = []
+    for idx in sorted(results):
+        result = results[idx]
+        # PDFの場合は複数ページの結果
+        pages = result if isinstance(result, list) else [result] if result else []
+        job_file = files_by_idx[idx]
+        source_hash = _source_hash(job_file)
+        for n, page in enumerate(pages):
+            entries.append(
+                {
+                    # 再取得したジョブで同じ行を重複して登録しないためのキー
+                    "key": f"{job_id}:{idx}:{n}",
+                    "result": page,
+                    "job_id": job_id,
+                    "source_file": job_file["filename"],
+                    "source_hash": source_hash,
+                }
+            )
+
+    if not entries:
+        finish_job(job_id, STATUS_FAILED, "処理可能な結果がありませんでした")
+        return
+
+    # 台帳への登録（既に台帳にある領収書はDUPLICATE_POLICYに従って重複として記録・除外する）
+    add_event(job_id, "job", {"status": STATUS_RUNNING, "stage": "ledger", "rows": len(entries)})
+    with metrics.stage("ledger"):
+        added, duplicates = ledger.add_receipts(job["excel_file"], entries)
+    if duplicates:
+        logger.info(f"重複した領収書: {len(duplicates)}件（追加: {added}件）", extra={"duplicates": duplicates})
+    finish_job(job_id, STATUS_DONE, summary={"added": added, "duplicates": len(duplicates)})
+
+
+def _worker_loop():
+    """キューが空になるまでジョブを取得して処理し続ける"""
+    while True:
+        try:
+            job = claim_next_job()
+        except Exception as e:
+            logger.exception(f"ジョブの取得中にエラーが発生しました: {str(e)}")
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        # ジョブ内のログはジョブIDで結び付ける
+        with log.bind(job["id"]):
+            logger.info(f"ジョブを開始します: {job['id']}")
+            try:
+                with metrics.stage("job"), keep_alive(job["id"]):
+                    process_job(job)
+            except Exception as e:
+                logger.exception(f"ジョブの処理中にエラーが発生しました: {str(e)}")
+                finish_job(job["id"], STATUS_FAILED, str(e))
+            logger.info(f"ジョブが終了しました: {job['id']}")
+
+
+def start_workers(num_workers=None):
+    """
+    バックグラウンドワーカーを起動（プロセスごとに1回のみ）
+    app.start_background から呼び出される（gunicornでは gunicorn.conf.py のフックで各ワーカープロセスから）。
+    fork前に起動したスレッドは子プロセスに引き継がれないため、起動済みかどうかはPIDで判定する
+    """
+    global _workers_pid
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        init_db()
+        _workers.clear()
+        for i in range(num_workers or JOB_WORKERS):
+            thread = threading.Thread(target=_worker_loop, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            _workers.append(thread)
+        _workers_pid = os.getpid()
@@ -0,0 +1,389 @@
+import os
+import re
+import sqlite3
+import unicodedata
+from datetime import datetime
+
+from openpyxl import load_workbook
+
+from utils import extract, log, metrics
+from config import LEDGER_DB_PATH, DUPLICATE_POLICY
+
+logger = log.get_logger(__name__)
+
+# 抽出した領収書データの台帳（全ての行の保存先。Excelファイルはここから生成する）
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    workbook TEXT NOT NULL,
+    job_id TEXT,
+    source_file TEXT,
+    source_hash TEXT,
+    page INTEGER,
+    method TEXT,
+    issue_date TEXT,
+    vendor TEXT,
+    amount TEXT,
+    invoice_number TEXT,
+    issue_on TEXT,
+    entry_key TEXT NOT NULL UNIQUE,
+    created_at TEXT NOT NULL,
+    dup_key TEXT,
+    duplicate_of INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_receipts_workbook ON receipts (workbook, id);
+CREATE INDEX IF NOT EXISTS idx_receipts_issue_on ON receipts (issue_on);
+CREATE INDEX IF NOT EXISTS idx_receipts_vendor ON receipts (vendor);
+CREATE INDEX IF NOT EXISTS idx_receipts_source_hash ON receipts (source_hash);
+"""
+# 重複の判定用（重複キーごとに最初の行を索引から1回で引けるよう、IDも含める）
+_DUPLICATE_INDEX = "CREATE INDEX IF NOT EXISTS idx_receipts_dup_key ON receipts (dup_key, id)"
+
+# 台帳の列と抽出結果の項目の対応
+COLUMNS = {
+    "発行日": "issue_date",
+    "支払先名": "vendor",
+    "金額": "amount",
+    "インボイス番号": "invoice_number",
+}
+
+# 重複キーの作成時に支払先名から取り除く会社形態など
+_VENDOR_AFFIXES = re.compile(r"株式会社|有限会社|合同会社|\(株\)|\(有\)|㈱|㈲|事務所|御中|様")
+_VENDOR_IGNORED = re.compile(r"[\s\-ー・.,、。()（）]")
+_DATE_PARTS = re.compile(r"(\d{2,4})\D+(\d{1,2})\D+(\d{1,2})")
+
+_initialized_pid = None
+
+
+def _connect():
+    """台帳DBへ接続（初回のみテーブルを作成）"""
+    global _initialized_pid
+    if _initialized_pid == os.getpid():
+        return sqlite3.connect(LEDGER_DB_PATH, timeout=30, isolation_level=None)
+
+    os.makedirs(os.path.dirname(LEDGER_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(LEDGER_DB_PATH, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(receipts)")}
+    if "dup_key" not in columns:
+        # 重複の判定を追加する前に作成した台帳は、列を追加して既存の行から索引を作成する
+        conn.execute("ALTER TABLE receipts ADD COLUMN dup_key TEXT")
+        conn.execute("ALTER TABLE receipts ADD COLUMN duplicate_of INTEGER")
+        conn.execute(_DUPLICATE_INDEX)
+        _rebuild_duplicates(conn)
+    else:
+        conn.execute(_DUPLICATE_INDEX)
+    _initialized_pid = os.getpid()
+    return conn
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _iso_date(value):
+    """発行日（YYYY/MM/DD）を期間で検索するためのISO形式に変換（変換できない場合はNone）"""
+    try:
+        return datetime.strptime(str(value or "").strip(), "%Y/%m/%d").date().isoformat()
+    except ValueError:
+        return None
+
+
+def _text(value):
+    return "" if value is None else str(value)
+
+
+def duplicate_key(result):
+    """
+    重複の判定に使うキー（インボイス番号・発行日・金額・支払先名を正規化して連結）
+    全角・半角、空白、桁区切り、会社形態の表記の違いは同じとみなす
+    発行日・金額のいずれかがない場合は判定しない（Noneを返す）
+    """
+    def normalized(field):
+        return unicodedata.normalize("NFKC", _text(result.get(field))).strip()
+
+    date = _DATE_PARTS.search(normalized("発行日"))
+    amount = re.sub(r"\D", "", normalized("金額").split(".")[0])
+    if not date or not amount:
+        return None
+    year, month, day = (int(part) for part in date.groups())
+    if year < 100:
+        year += 2000
+    invoice = re.sub(r"[^0-9A-Z]", "", normalized("インボイス番号").upper())
+    if invoice and not invoice.startswith("T"):
+        invoice = "T" + invoice
+    vendor = _VENDOR_IGNORED.sub("", _VENDOR_AFFIXES.sub("", normalized("支払先名"))).lower()
+    return f"{invoice}|{year:04d}-{month:02d}-{day:02d}|{int(amount)}|{vendor}"
+
+
+def add_receipts(workbook, entries, policy=None):
+    """
+    領収書データを台帳に追加する（1トランザクションで追加し、既存の行は読み込まない）
+
+    各行の重複キーを索引で引き、同じ領収書が既に台帳にある場合は policy に従って
+    "flag": 追加して重複元の行のIDを記録する / "skip": 追加しない
+
+    Parameters:
+    workbook: 出力先のExcelファイル名
+    entries: 辞書のリスト。各辞書は
+        "key": 行を一意に識別する文字列（同じキーの行は追加しない。ジョブの再実行で重複させないため）
+        "result": 抽出結果（発行日・支払先名・金額・インボイス番号・抽出方法・ページ）
+        "job_id", "source_file", "source_hash": 任意
+    policy: 重複の扱い（省略時はDUPLICATE_POLICY）
+
+    Returns:
+    (追加した行数, 重複した行のリスト [{"key": 行のキー, "duplicate_of": 重複元の行のID, "skipped": bool}])
+    """
+    skip = (policy or DUPLICATE_POLICY) == "skip"
+    now = _now()
+    added = 0
+    duplicates = []
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for entry in entries:
+            if conn.execute("SELECT 1 FROM receipts WHERE entry_key = ?", (entry["key"],)).fetchone():
+                continue  # 登録済みの行
+            result = entry["result"]
+            dup_key = duplicate_key(result)
+            original = None
+            if dup_key is not None:
+                row = conn.execute(
+                    "SELECT id FROM receipts WHERE dup_key = ? ORDER BY id LIMIT 1", (dup_key,)
+                ).fetchone()
+                original = row[0] if row else None
+            if original is not None:
+                duplicates.append({"key": entry["key"], "duplicate_of": original, "skipped": skip})
+                if skip:
+                    continue
+            conn.execute(
+                """
+                INSERT INTO receipts (
+                    workbook, job_id, source_file, source_hash, page, method,
+                    issue_date, vendor, amount, invoice_number, issue_on, entry_key, created_at,
+                    dup_key, duplicate_of
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    workbook,
+                    entry.get("job_id"),
+                    entry.get("source_file"),
+                    entry.get("source_hash"),
+                    result.get(extract.PAGE_KEY),
+                    result.get(extract.METHOD_KEY),
+                    *(_text(result.get(field)) for field in COLUMNS),
+                    _iso_date(result.get("発行日")),
+                    entry["key"],
+                    now,
+                    dup_key,
+                    original,
+                ),
+            )
+            added += 1
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    if duplicates:
+        metrics.inc(metrics.DUPLICATES, "skipped" if skip else "flagged", amount=len(duplicates))
+        logger.warning(
+            f"重複した領収書が{len(duplicates)}件ありました（{'追加しません' if skip else '重複として記録しました'}）",
+            extra={"workbook": workbook},
+        )
+    return added, duplicates
+
+
+def _to_result(row):
+    """台帳の行 (issue_date, vendor, amount, invoice_number, ...) を抽出結果と同じ形式の辞書に変換"""
+    return {field: row[i] for i, field in enumerate(COLUMNS)}
+
+
+def list_workbooks():
+    """台帳に行があるExcelファイル名の一覧（新しい順）"""
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT workbook FROM receipts GROUP BY workbook ORDER BY MAX(id) DESC").fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+
+def fetch_rows(workbook, after_id=0):
+    """
+    Excelファイルの行のうち、台帳のIDがafter_idより大きいものを追加順に取得
+
+    Returns:
+    (抽出結果の辞書のリスト, 取得した最後の台帳のID（行がない場合はafter_id）)
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT issue_date, vendor, amount, invoice_number, id FROM receipts WHERE workbook = ? AND id > ? ORDER BY id",
+            (workbook, after_id),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [_to_result(row) for row in rows], (rows[-1][-1] if rows else after_id)
+
+
+def query(workbook=None, date_from=None, date_to=None, vendor=None):
+    """
+    条件に一致する行を追加順に取得（条件は省略可能）
+
+    Parameters:
+    workbook: Excelファイル名
+    date_from, date_to: 発行日の範囲（YYYY-MM-DD または YYYY/MM/DD。両端を含む）
+    vendor: 支払先名（部分一致）
+    """
+    conditions, params = [], []
+    if workbook:
+        conditions.append("workbook = ?")
+        params.append(workbook)
+    for value, operator in ((date_from, ">="), (date_to, "<=")):
+        if value:
+            iso = _iso_date(str(value).replace("-", "/"))
+            if iso is None:
+                raise ValueError(f"日付の形式が正しくありません: {value}")
+            conditions.append(f"issue_on {operator} ?")
+            params.append(iso)
+    if vendor:
+        conditions.append("vendor LIKE ? ESCAPE '\\'")
+        escaped = vendor.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        params.append(f"%{escaped}%")
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            f"SELECT issue_date, vendor, amount, invoice_number FROM receipts {where} ORDER BY id", params
+        ).fetchall()
+    finally:
+        conn.close()
+    return [_to_result(row) for row in rows]
+
+
+def import_workbooks(folder):
+    """
+    台帳の導入前に作成されたExcelファイルの行を台帳に取り込む（取り込み済みの行は追加しない）
+
+    Returns:
+    追加した行数
+    """
+    if not os.path.isdir(folder):
+        return 0
+
+    known = set(list_workbooks())
+    added = 0
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith(".xlsx") or name.startswith(".") or name in known:
+            continue
+        try:
+            wb = load_workbook(os.path.join(folder, name), read_only=True)
+        except Exception as e:
+            logger.warning(f"Excelファイルを台帳に取り込めませんでした: {name} ({str(e)})")
+            continue
+        try:
+            entries = []
+            rows = wb.active.iter_rows(min_row=2, max_col=len(COLUMNS) + 1, values_only=True)
+            for row_no, row in enumerate(rows, 2):
+                values = list(row[1:]) + [None] * (len(COLUMNS) + 1 - len(row))
+                if not any(value not in (None, "") for value in values):
+                    continue
+                result = {field: _text(value) for field, value in zip(COLUMNS, values)}
+                result[extract.METHOD_KEY] = "import"
+                entries.append({"key": f"import:{name}:{row_no}", "result": result, "source_file": name})
+        finally:
+            wb.close()
+        if entries:
+            added += add_receipts(name, entries)[0]
+            logger.info(f"Excelファイルを台帳に取り込みました: {name}（{len(entries)}行）")
+    return added
+
+
+def find_duplicates(workbook=None):
+    """重複として記録された行と重複元の行の一覧（workbookを指定した場合はそのExcelファイルの行のみ）"""
+    where = "WHERE r.duplicate_of IS NOT NULL" + (" AND r.workbook = ?" if workbook else "")
+    conn = _connect()
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            f"""
+            SELECT r.id, r.workbook, r.source_file, r.page, r.issue_date, r.vendor, r.amount, r.invoice_number,
+                   o.id AS original_id, o.workbook AS original_workbook,
+                   o.source_file AS original_source_file, o.page AS original_page
+            FROM receipts r JOIN receipts o ON o.id = r.duplicate_of
+            {where} ORDER BY r.id
+            """,
+            (workbook,) if workbook else (),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        {
+            "id": row["id"],
+            "workbook": row["workbook"],
+            "source_file": row["source_file"],
+            "page": row["page"],
+            **{field: row[column] for field, column in COLUMNS.items()},
+            "duplicate_of": {
+                "id": row["original_id"],
+                "workbook": row["original_workbook"],
+                "source_file": row["original_source_file"],
+                "page": row["original_page"],
+            },
+        }
+        for row in rows
+    ]
+
+
+def _rebuild_duplicates(conn, batch_size=10000):
+    """
+    全ての行の重複キーと重複元を作り直す
+    行を1度だけ走査してキーごとの最初の行をメモリ上で引き、値が変わる行だけを更新する
+    """
+    first = {}
+    updates = []
+    flagged = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.execute(
+            f"SELECT {', '.join(COLUMNS.values())}, id, dup_key, duplicate_of FROM receipts ORDER BY id"
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                receipt_id, current_key, current_original = row[len(COLUMNS) :]
+                dup_key = duplicate_key(_to_result(row))
+                original = first.setdefault(dup_key, receipt_id) if dup_key is not None else receipt_id
+                original = original if original != receipt_id else None
+                flagged += original is not None
+                if (dup_key, original) != (current_key, current_original):
+                    updates.append((dup_key, original, receipt_id))
+        conn.executemany("UPDATE receipts SET dup_key = ?, duplicate_of = ? WHERE id = ?", updates)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return flagged
+
+
+def rebuild_duplicates():
+    """
+    台帳全体から重複の索引を作り直す（正規化の方法を変更した場合や、取り込んだExcelファイルの行の判定に使う）
+    policyによらず重複した行は削除せず、重複として記録する
+
+    Returns:
+    重複として記録した行数
+    """
+    conn = _connect()
+    try:
+        return _rebuild_duplicates(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,86 @@
+import os
+import json
+import logging
+import threading
+import uuid
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import LOG_FORMAT, LOG_LEVEL
+
+# リクエスト・ジョブ単位の相関ID（同じ処理に関するログを結び付ける）
+correlation_id = contextvars.ContextVar("correlation_id", default="-")
+
+# LogRecordの標準属性（これ以外の属性は extra で渡された項目としてJSONに含める）
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "correlation_id"}
+
+_lock = threading.Lock()
+_configured_pid = None
+
+
+class CorrelationFilter(logging.Filter):
+    """ログレコードに相関IDを付与する"""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1件のJSON形式で出力する"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(log_format=None, level=None):
+    """ルートロガーの出力先と形式を設定（プロセスごとに1回のみ）"""
+    global _configured_pid
+    with _lock:
+        if _configured_pid == os.getpid():
+            return
+        handler = logging.StreamHandler()
+        handler.addFilter(CorrelationFilter())
+        if (log_format or LOG_FORMAT) == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(
+                logging.Formatter("%(asctime)s %(levelname)s [%(correlation_id)s] %(name)s: %(message)s")
+            )
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(level or LOG_LEVEL)
+        _configured_pid = os.getpid()
+
+
+def get_logger(name):
+    """ロガーを取得（未設定の場合は出力先を設定する。spawnで起動したワーカープロセスでも同じ形式になる）"""
+    setup_logging()
+    return logging.getLogger(name)
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:12]
+
+
+@contextmanager
+def bind(value=None):
+    """ブロック内のログに相関IDを付与する（省略時は新しいIDを発行）"""
+    token = correlation_id.set(value or new_correlation_id())
+    try:
+        yield correlation_id.get()
+    finally:
+        correlation_id.reset(token)
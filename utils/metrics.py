@@ -0,0 +1,216 @@
+import threading
+import time
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# 処理時間のヒストグラムのバケット（秒）
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 1件の領収書あたりのGemini API呼び出し回数のバケット
+CALL_BUCKETS = (0, 1, 2, 3, 5, 10)
+
+_lock = threading.Lock()
+_metrics = {}
+
+# collect() の中では計測値を記録せずにリストへ溜める（プロセスプールのワーカーから親プロセスへ渡すため）
+_collector = contextvars.ContextVar("metrics_collector", default=None)
+# 処理中の領収書のGemini API呼び出し回数
+_receipt_calls = contextvars.ContextVar("receipt_calls", default=None)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def apply(self, label_values, value):
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def apply(self, label_values, value):
+        counts, total = self.values.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect_left(self.buckets, value)] += 1
+        self.values[label_values] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + (le,))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def register(metric):
+    with _lock:
+        _metrics[metric.name] = metric
+    return metric
+
+
+STAGE_SECONDS = register(
+    Histogram("receipt_stage_seconds", "パイプラインの各段階の処理時間（秒）", ["stage"])
+)
+GEMINI_CALLS_PER_RECEIPT = register(
+    Histogram("receipt_gemini_calls", "領収書1件あたりのGemini API呼び出し回数（リトライを含む）", buckets=CALL_BUCKETS)
+)
+GEMINI_REQUESTS = register(
+    Counter("receipt_gemini_requests_total", "Gemini APIへのリクエスト数（リトライを含む）", ["outcome"])
+)
+RESOLUTIONS = register(
+    Counter(
+        "receipt_resolutions_total",
+        "領収書の抽出結果の確定方法（tesseract / text_layer / tesseract+gemini / gemini / tesseract_fallback / near_duplicate / failed など）",
+        ["source"],
+    )
+)
+FIELD_ASSESSMENTS = register(
+    Counter(
+        "receipt_field_assessments_total",
+        "Tesseractの抽出結果の項目ごとの判定（trusted / missing / low_confidence / invalid）",
+        ["field", "result"],
+    )
+)
+ESCALATIONS = register(
+    Counter(
+        "receipt_gemini_escalations_total",
+        "Geminiで再抽出した項目の範囲（none: 再抽出なし / partial: 一部の項目 / full: 全項目）",
+        ["scope"],
+    )
+)
+CACHE_LOOKUPS = register(Counter("receipt_cache_lookups_total", "抽出結果キャッシュの参照数", ["result"]))
+SIMILAR_LOOKUPS = register(
+    Counter(
+        "receipt_similar_image_lookups_total",
+        "知覚ハッシュによる近似画像の検索数（hit / miss / rejected: 金額・発行日が一致しない）",
+        ["result"],
+    )
+)
+DUPLICATES = register(
+    Counter("receipt_duplicates_total", "台帳への追加時に見つかった重複した領収書の数", ["action"])
+)
+BULK_FILES = register(
+    Counter("receipt_bulk_files_total", "一括取り込み（ZIPファイル・受信フォルダ）で受け付けた・読み飛ばしたファイル数", ["source", "result"])
+)
+JOBS = register(Counter("receipt_jobs_total", "終了したジョブ数", ["status"]))
+
+
+def _record(name, label_values, value):
+    observations = _collector.get()
+    if observations is not None:
+        observations.append((name, label_values, value))
+        return
+    metric = _metrics[name]
+    with _lock:
+        metric.apply(label_values, value)
+
+
+def inc(metric, *label_values, amount=1):
+    """カウンターを増やす"""
+    _record(metric.name, tuple(label_values), amount)
+
+
+def observe(metric, value, *label_values):
+    """ヒストグラムに値を記録する"""
+    _record(metric.name, tuple(label_values), value)
+
+
+@contextmanager
+def stage(name):
+    """ブロックの処理時間を段階名 name として記録する（例外で抜けた場合も記録する）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(STAGE_SECONDS, time.perf_counter() - started, name)
+
+
+@contextmanager
+def receipt():
+    """領収書1件分の処理。ブロック内のGemini API呼び出し回数を記録する"""
+    calls = [0]
+    token = _receipt_calls.set(calls)
+    try:
+        yield
+    finally:
+        _receipt_calls.reset(token)
+        observe(GEMINI_CALLS_PER_RECEIPT, calls[0])
+
+
+def gemini_call_counter():
+    """
+    処理中の領収書のGemini API呼び出し回数を数える関数を返す
+    （API呼び出しは別スレッドで実行されるため、呼び出し元のスレッドで取得しておく）
+    """
+    calls = _receipt_calls.get()
+
+    def count(outcome):
+        if calls is not None:
+            calls[0] += 1
+        inc(GEMINI_REQUESTS, outcome)
+
+    return count
+
+
+@contextmanager
+def collect():
+    """
+    ブロック内の計測値を記録せずにリストへ溜める
+    プロセスプールのワーカーで使用し、結果と一緒に返したリストを親プロセスで replay() する
+    """
+    observations = []
+    token = _collector.set(observations)
+    try:
+        yield observations
+    finally:
+        _collector.reset(token)
+
+
+def replay(observations):
+    """collect() で溜めた計測値を記録する"""
+    for name, label_values, value in observations or []:
+        _record(name, tuple(label_values), value)
+
+
+def render():
+    """Prometheusのテキスト形式で出力（計測値はプロセスごとに保持される）"""
+    with _lock:
+        lines = []
+        for metric in _metrics.values():
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
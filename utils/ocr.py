@@ -1,28 +1,163 @@
+import io
 import os
 from dotenv import load_dotenv
 import cv2
 import numpy as np
 import pytesseract
 from PIL import Image
-import google.generativeai as genai
 import re
 import sys
-import base64
+import math
 import json
 import pandas as pd
-from pathlib import Path
+import threading
+import contextvars
+import multiprocessing
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import cache, extract, gemini, log, metrics, phash, progress, tesseract, debug as debug_images
+from config import CACHE_ENABLED, PHASH_ENABLED, OCR_FIELD_CONFIDENCE, OCR_PARALLEL_MODE, OCR_MAX_WORKERS, GEMINI_MAX_CONCURRENCY, PDF_DPI, PDF_RENDER_WORKERS
+from config import PDF_TEXT_LAYER_ENABLED, PDF_TEXT_MIN_CHARS, PDF_TEXT_TIMEOUT
+from config import DESKEW_METHOD, DESKEW_MAX_DIM, DESKEW_MAX_ANGLE
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
+logger = log.get_logger(__name__)
+
+# 処理できるファイルの拡張子
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tiff", ".bmp")
+SUPPORTED_EXTENSIONS = IMAGE_EXTENSIONS + (".pdf",)
+
+# 値がない場合にGeminiで再抽出する項目（インボイス番号は記載のない領収書があるため、他の項目の再抽出に併せて取得する）
+REQUIRED_FIELDS = ["発行日", "支払先名", "金額"]
+# インボイス番号の見出し（見出しがあるのに番号を抽出できない場合は番号を誤認識している）
+INVOICE_LABEL_PATTERN = re.compile(r"登録[番得]号")
+# pdftotext -layout の出力で段組みを区切る空白（2文字以上）と、見出しと同じ行にまとめる値（金額・日付など）のセル
+_COLUMN_GAP = re.compile(r"\s{2,}")
+_VALUE_CELL = re.compile(r"[¥\\\d]")
+
+# 並列実行用のプール（プロセス内で共有）
+_pool_lock = threading.Lock()
+_process_pool = None
+_api_pool = None
+# CPU処理の並列数の既定値（OCR_MAX_WORKERS を指定しない場合はCPU数。share_cpus で変更する）
+_default_workers = OCR_MAX_WORKERS or os.cpu_count() or 1
+
+
+def load_image(image):
+    """画像パスまたはNumPy配列（BGR）から画像を取得"""
+    if isinstance(image, np.ndarray):
+        return image
+    return cv2.imread(image)
+
+
+# 処理対象のファイル（ソース）は、ファイルパスまたは (ファイル名, 内容のバイト列) のタプル
+# アップロードされたファイルはディスクに保存せず、バイト列のまま処理する
+def source_name(source):
+    """ソースのファイル名（パス）"""
+    return source[0] if isinstance(source, tuple) else str(source)
 
-def preprocess_image(image_path):
-    """画像の前処理を行う"""
+
+def _as_source(source):
+    return source if isinstance(source, tuple) else str(source)
+
+
+def source_dpi(source):
+    """画像のソースに記録された解像度（dpi。記録がない・読み込めない場合はNone）。画素は読み込まない"""
+    try:
+        with Image.open(io.BytesIO(source[1]) if isinstance(source, tuple) else source) as image:
+            dpi = image.info.get("dpi")
+    except Exception:
+        return None
+    return int(round(float(dpi[0]))) if dpi and dpi[0] else None
+
+
+def decode_source(source):
+    """画像のソースを1度だけ読み込んでNumPy配列（BGR）にする（読み込めない場合はNone）"""
+    if isinstance(source, tuple):
+        return cv2.imdecode(np.frombuffer(source[1], np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(source, cv2.IMREAD_COLOR)
+
+
+def estimate_skew_legacy(gray):
+    """傾き角度の推定（従来方式）：0より大きい全画素の座標からminAreaRectを求める"""
+    coords = np.column_stack(np.where(gray > 0))
+    angle = cv2.minAreaRect(coords)[-1]
+    if angle < -45:
+        angle = 90 + angle
+    return angle
+
+
+def _text_mask(gray, max_dim=None):
+    """縮小した画像を大津の二値化で反転し、文字（暗い画素）を255とするマスクを作成"""
+    max_dim = max_dim or DESKEW_MAX_DIM
+    scale = min(1.0, max_dim / float(max(gray.shape)))
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return mask
+
+
+def estimate_skew_fast(gray):
+    """
+    傾き角度の推定（高速方式）：縮小画像の文字画素のみからminAreaRectを求める
+    戻り値は cv2.getRotationMatrix2D にそのまま渡せる補正角度（-45〜45度）
+    """
+    points = cv2.findNonZero(_text_mask(gray))
+    if points is None or len(points) < 10:
+        return 0.0
+    # OpenCVのバージョンで角度の定義が異なるため、矩形の辺の向きから角度を求める
+    box = cv2.boxPoints(cv2.minAreaRect(points))
+    dx, dy = box[1] - box[0]
+    angle = ((math.degrees(math.atan2(dy, dx)) + 45) % 90) - 45
+    return angle if abs(angle) <= DESKEW_MAX_ANGLE else 0.0
+
+
+def estimate_skew_projection(gray):
+    """
+    傾き角度の推定（射影方式）：文字マスクを回転させ、行方向の射影の分散が最大になる角度を探す
+    粗い刻みで探索した後、最良の角度の周辺を細かく探索する
+    """
+    mask = _text_mask(gray)
+    height, width = mask.shape
+    center = (width / 2, height / 2)
+
+    def score(angle):
+        rot_mat = cv2.getRotationMatrix2D(center, angle, 1.0)
+        rotated = cv2.warpAffine(mask, rot_mat, (width, height), flags=cv2.INTER_NEAREST)
+        return float(np.var(rotated.sum(axis=1, dtype=np.float64)))
+
+    best = max(np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + 1e-6, 1.0), key=score)
+    best = max(np.arange(best - 1.0, best + 1.0 + 1e-6, 0.1), key=score)
+    return float(best)
+
+
+# 傾き補正の方式
+SKEW_ESTIMATORS = {
+    "legacy": estimate_skew_legacy,
+    "fast": estimate_skew_fast,
+    "projection": estimate_skew_projection,
+}
+
+
+def preprocess_image(image_path, deskew=None, debug=None, debug_name=None, stages=None):
+    """
+    画像の前処理を行う
+
+    Parameters:
+    image_path: 画像ファイルのパス、またはNumPy配列（BGR）
+    deskew: 傾き補正の方式（"fast" / "projection" / "legacy" / "none"）。省略時は設定値
+    debug: 各段階の画像をデバッグ用に保存するか。省略時は設定値
+    debug_name: デバッグ画像の保存先の名前（省略時はファイル名）
+    stages: 辞書を指定した場合、各段階の画像（"gray", "deskewed" など）を格納する
+    """
     try:
         # 画像を読み込む
-        image = cv2.imread(image_path)
+        image = load_image(image_path)
         if image is None:
-            print(f"画像の読み込みに失敗: {image_path}")
+            logger.warning(f"画像の読み込みに失敗: {image_path}")
             return None
 
         # チャンネル数を確認
@@ -38,15 +173,16 @@ def preprocess_image(image_path):
         denoised = cv2.medianBlur(gray, 3)
 
         # 傾き補正
-        coords = np.column_stack(np.where(denoised > 0))
-        angle = cv2.minAreaRect(coords)[-1]
-        if angle < -45:
-            angle = 90 + angle
-        center = tuple(np.array(denoised.shape[1::-1]) / 2)
-        rot_mat = cv2.getRotationMatrix2D(center, angle, 1.0)
-        rotated = cv2.warpAffine(
-            denoised, rot_mat, denoised.shape[1::-1], flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE
-        )
+        deskew = deskew or DESKEW_METHOD
+        angle = SKEW_ESTIMATORS[deskew](denoised) if deskew in SKEW_ESTIMATORS else 0.0
+        if angle:
+            center = tuple(np.array(denoised.shape[1::-1]) / 2)
+            rot_mat = cv2.getRotationMatrix2D(center, angle, 1.0)
+            rotated = cv2.warpAffine(
+                denoised, rot_mat, denoised.shape[1::-1], flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE
+            )
+        else:
+            rotated = denoised
 
         # コントラスト強調
         clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
@@ -61,109 +197,162 @@ def preprocess_image(image_path):
         kernel = np.ones((2, 2), np.uint8)
         cleaned = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
 
-        # デバッグ用に前処理後の画像を保存
-        debug_path = os.path.join(os.path.dirname(image_path), "debug_" + os.path.basename(image_path))
-        cv2.imwrite(debug_path, cleaned)
-        print(f"前処理後の画像を保存: {debug_path}")
+        intermediate = [
+            ("gray", gray),
+            ("denoised", denoised),
+            ("deskewed", rotated),
+            ("clahe", enhanced),
+            ("binary", binary),
+            ("cleaned", cleaned),
+        ]
+        if stages is not None:
+            stages.update(intermediate)
+
+        # デバッグ用に各段階の画像を保存（有効な場合のみ・書き込みはバックグラウンド）
+        if debug_images.is_enabled(debug):
+            if not debug_name:
+                debug_name = os.path.basename(image_path) if isinstance(image_path, str) else "image"
+            debug_images.save_stages(debug_name, intermediate)
 
         return cleaned
 
     except Exception as e:
-        print(f"画像前処理エラー: {str(e)}")
+        logger.error(f"画像前処理エラー: {str(e)}")
         return None
 
 
-def use_gemini_api(image_path, field_name=None):
+# フィールドごとのGemini用の抽出指示
+FIELD_PROMPTS = {
+    "発行日": """
+    この領収書から発行日を抽出してください。
+    - YYYY/MM/DD形式で返してください
+    - 日付のみを返してください（余計な文字は不要）
+    - 電話番号や注文番号などは無視してください
+    """,
+    "支払先名": """
+    この領収書から店舗・会社名を抽出してください。
+    - 正式名称を返してください
+    - 支店名や店舗名も含めてください
+    - 住所は含めないでください
+    - 電話番号は含めないでください
+    """,
+    "金額": """
+    この領収書から合計金額を抽出してください。
+    - 数値のみを返してください（カンマや円記号は不要）
+    - 税込の最終合計金額を返してください
+    - 小計や税額は無視してください
+    """,
+    "インボイス番号": """
+    この領収書からインボイス番号（登録番号）を抽出してください。
+    - 数値のみを返してください
+    - T+13桁の数字、または13桁以上の登録番号を探してください
+    - 通常「登録番号」という文字列の後に記載されています
+    """,
+}
+
+# 複数フィールドをまとめて抽出する際の各フィールドの形式
+FIELD_FORMATS = {
+    "発行日": "YYYY/MM/DD形式で。日付のみを抽出。電話番号は無視",
+    "支払先名": "店舗・会社の正式名称。支店名も含める。住所や電話番号は含めない",
+    "金額": "税込の最終合計金額。数値のみ（カンマや円記号は不要）",
+    "インボイス番号": "T+13桁の数字、または登録番号。数値のみ",
+}
+
+
+def build_fields_prompt(fields):
+    """指定したフィールドをJSON形式でまとめて抽出するプロンプトを作成"""
+    body = ",\n".join(f'    "{field}": "{FIELD_FORMATS.get(field, field)}"' for field in fields)
+    return f"""
+    この領収書から以下の情報を抽出し、正確にJSON形式で返してください。
+    必ず以下のフォーマットで返してください：
+
+    {{
+{body}
+    }}
+
+    - 各フィールドは必ず指定された形式で返してください
+    - 特定の情報が見つからない場合は、空文字列を設定してください
+    - 余計な説明は不要です。JSONのみを返してください
+    """
+
+
+def clean_field_value(field_name, value):
+    """Geminiから取得した単一フィールドの値を整形"""
+    value = str(value).strip()
+    if field_name == "金額":
+        value = re.sub(r"[^\d]", "", value)
+    elif field_name == "インボイス番号":
+        value = re.sub(r"[^\dT]", "", value)
+    elif field_name == "発行日":
+        # YYYY/MM/DD形式に標準化
+        date_match = re.search(r"\d{4}[-/年]\d{1,2}[-/月]\d{1,2}", value)
+        if date_match:
+            date_str = date_match.group()
+            date_str = date_str.replace("年", "/").replace("月", "/").replace("日", "")
+            value = date_str
+    return value
+
+
+def parse_json_response(text):
+    """レスポンスから{...}の部分を抽出してパース（見つからない場合はNone）"""
+    json_str = re.search(r"\{[^{}]*\}", text)
+    if not json_str:
+        logger.debug(f"JSONが見つかりませんでした。レスポンス全文:\n{text}")
+        return None
+    return json.loads(json_str.group())
+
+
+def use_gemini_api(image_path, field_name=None, fields=None):
     """
     Gemini APIを使用して特定のフィールドを抽出
+
+    Parameters:
+    image_path: 画像ファイルのパス、PNG等のバイト列、NumPy配列（BGR）、PIL画像、
+                またはgemini.prepare_image_payloadで変換済みのペイロード
+    field_name: 抽出するフィールド名（省略時は全フィールド）
+    fields: まとめて抽出するフィールド名のリスト（指定時は1回の呼び出しで辞書を返す）
     """
     try:
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            print("Gemini APIキーが設定されていません")
+        # プロセス内で共有するモデルを使用（呼び出しごとに設定・生成しない）
+        if gemini.get_model() is None:
+            logger.warning("Gemini APIキーが設定されていません")
             return None
 
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash")
+        # 縮小・JPEG化した画像を送信する（同じ画像のエンコード結果は再利用される）
+        image = gemini.prepare_image_payload(image_path)
 
-        image = Image.open(image_path)
-
-        if field_name:
+        if fields:
+            # 指定フィールドの一括抽出
+            prompt = build_fields_prompt(fields)
+        elif field_name:
             # 特定のフィールドの抽出
-            prompts = {
-                "発行日": """
-                この領収書から発行日を抽出してください。
-                - YYYY/MM/DD形式で返してください
-                - 日付のみを返してください（余計な文字は不要）
-                - 電話番号や注文番号などは無視してください
-                """,
-                "支払先名": """
-                この領収書から店舗・会社名を抽出してください。
-                - 正式名称を返してください
-                - 支店名や店舗名も含めてください
-                - 住所は含めないでください
-                - 電話番号は含めないでください
-                """,
-                "金額": """
-                この領収書から合計金額を抽出してください。
-                - 数値のみを返してください（カンマや円記号は不要）
-                - 税込の最終合計金額を返してください
-                - 小計や税額は無視してください
-                """,
-                "インボイス番号": """
-                この領収書からインボイス番号（登録番号）を抽出してください。
-                - 数値のみを返してください
-                - T+13桁の数字、または13桁以上の登録番号を探してください
-                - 通常「登録番号」という文字列の後に記載されています
-                """,
-            }
-            prompt = prompts.get(field_name, f"この領収書から「{field_name}」を抽出してください。")
+            prompt = FIELD_PROMPTS.get(field_name, f"この領収書から「{field_name}」を抽出してください。")
         else:
             # 全フィールドの抽出
-            prompt = """
-            この領収書から以下の情報を抽出し、正確にJSON形式で返してください。
-            必ず以下のフォーマットで返してください：
-
-            {
-                "発行日": "YYYY/MM/DD形式で。日付のみを抽出。電話番号は無視",
-                "支払先名": "店舗・会社の正式名称。支店名も含める。住所や電話番号は含めない",
-                "金額": "税込の最終合計金額。数値のみ（カンマや円記号は不要）",
-                "インボイス番号": "T+13桁の数字、または登録番号。数値のみ"
-            }
+            prompt = build_fields_prompt(["発行日", "支払先名", "金額", "インボイス番号"])
 
-            - 各フィールドは必ず指定された形式で返してください
-            - 特定の情報が見つからない場合は、空文字列を設定してください
-            - 余計な説明は不要です。JSONのみを返してください
-            """
+        response = gemini.generate_content([prompt, image])
+        logger.debug(f"Gemini API レスポンス: {response.text}")
 
-        response = model.generate_content([prompt, image])
-        print(f"Gemini API レスポンス: {response.text}")
-
-        if field_name:
+        if field_name and not fields:
             # 数値のクリーンアップ
-            value = response.text.strip()
-            if field_name in ["金額", "インボイス番号"]:
-                value = re.sub(r"[^\d]", "", value)
-            elif field_name == "発行日":
-                # YYYY/MM/DD形式に標準化
-                date_match = re.search(r"\d{4}[-/年]\d{1,2}[-/月]\d{1,2}", value)
-                if date_match:
-                    date_str = date_match.group()
-                    date_str = date_str.replace("年", "/").replace("月", "/").replace("日", "")
-                    value = date_str
-            return value
+            return clean_field_value(field_name, response.text)
+        elif fields:
+            try:
+                parsed = parse_json_response(response.text)
+                if parsed is None:
+                    return None
+                return {field: clean_field_value(field, parsed.get(field) or "") for field in fields}
+            except json.JSONDecodeError as e:
+                logger.warning(f"JSONパースエラー: {str(e)}\nレスポンス全文:\n{response.text}")
+                return None
         else:
             # JSON形式の応答をパース
             try:
-                # レスポンスから{...}の部分を抽出
-                json_str = re.search(r"\{[^{}]*\}", response.text)
-                if not json_str:
-                    print(f"JSONが見つかりませんでした。レスポンス全文:\n{response.text}")
+                result = parse_json_response(response.text)
+                if result is None:
                     return None
 
-                # JSONをパース
-                result = json.loads(json_str.group())
-
                 # 必須キーの存在確認と初期化
                 required_keys = ["発行日", "支払先名", "金額", "インボイス番号"]
                 for key in required_keys:
@@ -179,128 +368,792 @@ def use_gemini_api(image_path, field_name=None):
                 return result
 
             except json.JSONDecodeError as e:
-                print(f"JSONパースエラー: {str(e)}\nレスポンス全文:\n{response.text}")
+                logger.warning(f"JSONパースエラー: {str(e)}\nレスポンス全文:\n{response.text}")
                 return None
             except Exception as e:
-                print(f"Gemini API結果の処理中にエラー: {str(e)}")
+                logger.error(f"Gemini API結果の処理中にエラー: {str(e)}")
                 return None
 
+    except gemini.GeminiUnavailableError:
+        # リトライ上限に達した場合は呼び出し元で扱う（結果が黙って欠落しないようにする）
+        raise
     except Exception as e:
-        print(f"Gemini API error: {str(e)}")
+        logger.error(f"Gemini API error: {str(e)}")
         return None
 
 
 def process_image_with_gemini(image_path):
     """GeminiでOCR結果を解析"""
     try:
+        # 画像は一度だけ読み込み・エンコードし、以降の呼び出しで再利用する
+        image = gemini.prepare_image_payload(image_path)
+
         # まず全項目を一括で取得
-        api_result = use_gemini_api(image_path)
-        print("Gemini API 全項目抽出結果:")
-        print(api_result)
+        api_result = use_gemini_api(image)
+        logger.debug(f"Gemini API 全項目抽出結果: {api_result}")
 
         if api_result:
-            # 欠けている項目をGeminiの結果で補完
-            for field in api_result.keys():
-                if not api_result[field]:
-                    value = use_gemini_api(image_path, field)
+            # 欠けている項目を1回の呼び出しでまとめて補完
+            missing = [field for field in api_result.keys() if not api_result[field]]
+            if missing:
+                values = use_gemini_api(image, fields=missing) or {}
+                for field in missing:
+                    value = values.get(field)
                     if value:
                         api_result[field] = value
-                        print(f"{field}: GeminiAPIの結果で補完 -> {value}")
+                        logger.info(f"{field}: GeminiAPIの結果で補完 -> {value}")
 
         return api_result
 
+    except gemini.GeminiUnavailableError:
+        raise
     except Exception as e:
-        print(f"Gemini API処理エラー: {str(e)}")
+        logger.error(f"Gemini API処理エラー: {str(e)}")
         return None
 
 
-def process_image(image_path):
-    """画像ファイルに対してOCR処理を実施"""
+def _field_is_valid(field, value):
+    """項目の値の形式を検証（支払先名は検証しない）"""
+    if field == "金額":
+        return validate_amount(value)
+    if field == "発行日":
+        return validate_date(value)
+    if field == "インボイス番号":
+        return re.fullmatch(r"T\d{13}", value) is not None
+    return True
+
+
+def assess_fields(text, line_confidences, threshold=None):
+    """
+    OCRテキストから全項目を抽出し、項目ごとにTesseractの結果を信頼できるかを判定する
+    値を抽出した行の信頼度が threshold（省略時は OCR_FIELD_CONFIDENCE）以上で、
+    検証（validate_amount / validate_date）に通る項目を信頼する
+
+    Parameters:
+    text: tesseract.image_to_data のテキスト（空行を含まない）
+    line_confidences: 行ごとの信頼度のリスト
+
+    Returns:
+    (抽出結果（全項目を抽出できなかった場合はNone）, {信頼できない項目: 理由（"missing" / "low_confidence" / "invalid"）})
+    インボイス番号は値がない場合、見出し（登録番号）がある場合のみ信頼できない項目に含める
+    """
+    threshold = OCR_FIELD_CONFIDENCE if threshold is None else threshold
+    candidates = extract.extract_candidates(text)
+    result = {}
+    untrusted = {}
+    for field in extract.FIELDS:
+        if not candidates[field]:
+            result[field] = ""
+            metrics.inc(metrics.FIELD_ASSESSMENTS, field, "missing")
+            if field in REQUIRED_FIELDS or (field == "インボイス番号" and INVOICE_LABEL_PATTERN.search(text)):
+                untrusted[field] = "missing"
+            continue
+        best = candidates[field][0]
+        result[field] = best["value"]
+        line = best["line"]
+        confidence = line_confidences[line] if line < len(line_confidences) else 0
+        if confidence < threshold:
+            untrusted[field] = "low_confidence"
+        elif not _field_is_valid(field, best["value"]):
+            untrusted[field] = "invalid"
+        metrics.inc(metrics.FIELD_ASSESSMENTS, field, untrusted.get(field, "trusted"))
+
+    if not any(result.values()):
+        logger.warning("全ての項目の抽出に失敗しました")
+        return None, untrusted
+    if untrusted:
+        logger.info(f"Tesseract OCRの結果を信頼できない項目: {untrusted}")
+    return result, untrusted
+
+
+def escalation_fields(result, untrusted):
+    """
+    Geminiで再抽出する項目のリスト（再抽出が不要な場合は空）
+    再抽出する場合は、Tesseractで値を取得できなかった任意の項目（インボイス番号）も同じ呼び出しで取得する
+    """
+    if not untrusted:
+        return []
+    result = result or {}
+    return [field for field in extract.FIELDS if field in untrusted or not result.get(field)]
+
+
+def run_ocr_stage(image_path, debug=None, debug_name=None, use_similar=False, page=None, dpi=None):
+    """
+    前処理とTesseractによるテキスト抽出（CPU処理）
+    pageはPDFのページ番号（進捗の通知に使う）、dpiは画像の解像度（省略時はPDFを変換する解像度とみなす）
+
+    use_similar=Trueの場合は前処理した画像の知覚ハッシュで近似した画像を探し、
+    見つかった画像の抽出結果の金額・発行日がTesseractで読み取った値と一致する場合はその抽出結果を返す
+    （同じ書式の別の領収書もハッシュの距離は近くなるため、距離だけでは再利用しない）
+
+    Returns:
+    (前処理の成否, OCR結果, 近似画像の検索結果 {"hash": ハッシュ, "reused": 再利用したか}（use_similar=False の場合はNone）,
+     Geminiで再抽出する項目のリスト（Tesseractの結果を全て信頼できる場合・近似画像の結果を再利用した場合は空）)
+    """
+    # 画像の前処理
+    stages = {}
+    progress.emit("preprocess", page)
+    with metrics.stage("preprocess"):
+        processed_image = preprocess_image(image_path, debug=debug, debug_name=debug_name, stages=stages)
+    if processed_image is None:
+        logger.warning("画像の前処理に失敗しました")
+        metrics.inc(metrics.RESOLUTIONS, "failed")
+        return False, None, None, []
+
+    similar = None
+    candidate = None
+    if use_similar:
+        with metrics.stage("similar_lookup"):
+            image_hash = phash.compute(stages["deskewed"])
+            candidate, distance = cache.find_similar(image_hash)
+        similar = {"hash": image_hash, "reused": False}
+
+    # Tesseractでテキスト抽出
+    progress.emit("tesseract", page)
+    with metrics.stage("tesseract"):
+        ocr_text, line_confidences = tesseract.image_to_data(processed_image, lang="jpn", dpi=dpi)
+    with metrics.stage("extract"):
+        result, untrusted = assess_fields(ocr_text, line_confidences)
+
+    if use_similar:
+        if candidate is None:
+            outcome = "miss"
+        elif is_same_receipt(candidate, result):
+            outcome = "hit"
+        else:
+            outcome = "rejected"
+        metrics.inc(metrics.SIMILAR_LOOKUPS, outcome)
+        cache.record_similar(outcome)
+        if outcome == "hit":
+            logger.info(f"近似した画像の抽出結果を再利用します（ハッシュの距離: {distance}）")
+            progress.emit("near_duplicate", page)
+            similar["reused"] = True
+            return True, candidate, similar, []
+        if outcome == "rejected":
+            logger.info(f"近似した画像の金額・発行日が一致しないため再利用しません（ハッシュの距離: {distance}）")
+    return True, result, similar, _escalation(result, untrusted)
+
+
+def _normalized_date(value):
+    """発行日を (年, 月, 日) に変換（変換できない場合はNone）"""
+    parts = re.findall(r"\d+", value or "")
+    return tuple(int(part) for part in parts) if len(parts) == 3 else None
+
+
+def is_same_receipt(candidate, result):
+    """
+    近似した画像の抽出結果（candidate）が、Tesseractで読み取った結果（result）と同じ領収書のものか
+    金額と発行日の両方を読み取れていて、いずれも一致する場合のみ同じ領収書とみなす
+    """
+    if not candidate or not result:
+        return False
+    amount = re.sub(r"[^\d]", "", result.get("金額") or "")
+    date = _normalized_date(result.get("発行日"))
+    if not amount or date is None:
+        return False
+    return amount == re.sub(r"[^\d]", "", candidate.get("金額") or "") and date == _normalized_date(
+        candidate.get("発行日")
+    )
+
+
+def _escalation(result, untrusted):
+    """Geminiで再抽出する項目のリストを求め、再抽出の範囲を記録する"""
+    fields = escalation_fields(result, untrusted)
+    if not fields:
+        scope = "none"
+    else:
+        scope = "full" if len(fields) == len(extract.FIELDS) else "partial"
+    metrics.inc(metrics.ESCALATIONS, scope)
+    return fields
+
+
+def read_text_layer(pdf_path):
+    """
+    PDFのテキストレイヤーをpdftotext（poppler）でページごとに取得
+
+    Parameters:
+    pdf_path: PDFファイルのパス、またはPDFの内容のバイト列（標準入力で渡す）
+
+    Returns:
+    ページごとのテキストのリスト（pdftotextがない場合・PDFを読み込めない場合はNone）
+    """
+    if isinstance(pdf_path, (bytes, bytearray)):
+        target, stdin = "-", {"input": bytes(pdf_path)}
+    else:
+        target, stdin = pdf_path, {"stdin": subprocess.DEVNULL}
     try:
-        print("=== OCR処理開始 ===")
+        with metrics.stage("pdf_text"):
+            completed = subprocess.run(
+                ["pdftotext", "-layout", "-enc", "UTF-8", target, "-"],
+                **stdin,
+                capture_output=True,
+                timeout=PDF_TEXT_TIMEOUT,
+                check=True,
+            )
+    except FileNotFoundError:
+        logger.warning("pdftotextが見つかりません。全てのページを画像に変換して処理します")
+        return None
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"PDFのテキストを取得できませんでした。全てのページを画像に変換して処理します: {str(e)}")
+        return None
 
-        # 画像の前処理
-        processed_image = preprocess_image(image_path)
-        if processed_image is None:
-            print("画像の前処理に失敗しました")
-            return None
+    # 各ページのテキストの後に改ページ（\f）が出力される
+    output = completed.stdout.decode("utf-8", errors="replace")
+    pages = output.split("\f")
+    if output.endswith("\f"):
+        pages.pop()
+    return pages
 
-        # Tesseractでテキスト抽出
-        ocr_text = pytesseract.image_to_string(processed_image, lang="jpn")
-        result = process_ocr_result(ocr_text)
 
-        # OCRの結果が不十分な場合、Geminiを使用
-        if not result or not all([result.get("発行日"), result.get("支払先名"), result.get("金額")]):
-            print("Tesseract OCRの結果が不十分です。Geminiを使用して再試行します。")
-            gemini_result = use_gemini_api(image_path)
-            if gemini_result:
-                return gemini_result
+def _text_layer_lines(text):
+    """
+    pdftotext -layout のテキストを項目の抽出用の行に分ける
+    横に並んだ段組み（支払先名と登録番号など）は別の行にし、見出しと値（「合計」と「¥1,280」など）は同じ行にまとめる
+    """
+    lines = []
+    for line in text.split("\n"):
+        cells = []
+        for cell in _COLUMN_GAP.split(line.strip()):
+            if not cell:
+                continue
+            previous = cells[-1] if cells else None
+            if (
+                previous
+                and _VALUE_CELL.match(cell)
+                and not re.search(r"\d", previous)
+                and not extract.COMPANY_KEYWORD.search(previous)
+            ):
+                cells[-1] = f"{previous} {cell}"
+            else:
+                cells.append(cell)
+        lines.extend(cells)
+    return lines
+
+
+def has_text_layer(text):
+    """ページにテキストレイヤーがあるか（空白を除いた文字数が PDF_TEXT_MIN_CHARS 以上か）"""
+    return len("".join(text.split())) >= PDF_TEXT_MIN_CHARS
+
+
+def run_text_stage(text, page=None):
+    """
+    PDFのテキストレイヤーから全項目を抽出（前処理・Tesseractを行わない）
+    テキストは誤認識がないため信頼度は100とし、項目の検証に通らない・値がない項目だけをGeminiで再抽出する
+
+    Returns:
+    (抽出結果, Geminiで再抽出する項目のリスト)
+    """
+    progress.emit("text_layer", page)
+    lines = _text_layer_lines(text)
+    with metrics.stage("extract"):
+        result, untrusted = assess_fields("\n".join(lines), [100.0] * len(lines))
+    return result, _escalation(result, untrusted)
+
 
+def merge_gemini_fields(result, gemini_result, fields):
+    """
+    Geminiで再抽出した項目（fields）をTesseractの結果に統合する（combine_resultsで形式を揃える）
+    再抽出した項目はGeminiの値を優先し、Geminiで取得できなかった場合はTesseractの値を使う
+    """
+    result = result or {}
+    ocr_side, gemini_side = {}, {}
+    for field in extract.FIELDS:
+        gemini_side[field] = (gemini_result.get(field) or "") if field in fields else ""
+        # 信頼できない値がcombine_resultsで優先されないよう、Geminiの値がある項目はTesseractの値を渡さない
+        ocr_side[field] = "" if gemini_side[field] else (result.get(field) or "")
+    merged = combine_results(ocr_side, gemini_side)
+    for field in extract.FIELDS:
+        # combine_resultsは金額が両方とも空の場合に"0"を返す
+        if not ocr_side[field] and not gemini_side[field]:
+            merged[field] = ""
+    return merged
+
+
+def gemini_fallback(image, result, fields=None, source="tesseract"):
+    """
+    Tesseractの結果を信頼できない項目（fields。省略時は全項目）をGeminiで再抽出
+    Geminiが利用できない（リトライ上限・期限切れ）場合はTesseractの結果を返し、
+    Tesseractの結果もない場合は例外を送出する
+    sourceは result の抽出方法（"tesseract" / "text_layer"）で、確定した結果の抽出方法は
+    "gemini"（全項目を再抽出）/ "<source>+gemini"（一部の項目を再抽出）/ "<source>_fallback"（Geminiを利用できない）になる
+    """
+    fields = list(fields or extract.FIELDS)
+    logger.warning(f"抽出結果（{source}）が不十分です。Geminiを使用して再抽出します: {', '.join(fields)}")
+    try:
+        with metrics.stage("gemini"):
+            gemini_result = use_gemini_api(image, fields=fields)
+    except gemini.GeminiUnavailableError as e:
+        if result:
+            logger.warning(f"{str(e)}。抽出結果（{source}）を使用します。")
+            return _resolved(result, f"{source}_fallback")
+        metrics.inc(metrics.RESOLUTIONS, "failed")
+        raise
+
+    if not gemini_result:
+        return _resolved(result, f"{source}_fallback")
+    method = "gemini" if len(fields) == len(extract.FIELDS) else f"{source}+gemini"
+    return _resolved(merge_gemini_fields(result, gemini_result, fields), method)
+
+
+def _resolved(result, method, page=None):
+    """確定した結果に抽出方法（・PDFのページ番号）を付与し、件数を記録する"""
+    metrics.inc(metrics.RESOLUTIONS, method if result else "failed")
+    if not result:
         return result
+    result = dict(result, **{extract.METHOD_KEY: method})
+    if page is not None:
+        result[extract.PAGE_KEY] = page
+    return result
+
 
+def resolve_result(result, image=None, page=None, similar=None, fields=None, source="tesseract"):
+    """
+    領収書1件分の抽出結果を確定する
+    imageが指定された場合（Tesseractの結果が不十分な場合）は fields の項目（省略時は全項目）をGeminiで再抽出する
+    pageはPDFのページ番号（結果に付与する）
+    sourceは result の抽出方法（"tesseract" / PDFのテキストレイヤーから抽出した場合は "text_layer"）
+    similarは run_ocr_stage の近似画像の検索結果。近似画像の結果を再利用した場合はそのまま確定し、
+    それ以外の場合は確定した結果を知覚ハッシュとともに保存する
+    （Geminiを利用できずに不十分な結果で確定した場合は、次回Geminiで再抽出できるよう保存しない）
+    """
+    with metrics.receipt():
+        if similar and similar["reused"]:
+            return _resolved(result, "near_duplicate", page)
+        if image is None:
+            resolved = _resolved(result, source, page)
+        else:
+            progress.emit("gemini", page, fields=list(fields or extract.FIELDS))
+            resolved = gemini_fallback(image, result, fields, source)
+            if resolved and page is not None:
+                resolved[extract.PAGE_KEY] = page
+    if similar and resolved and not resolved[extract.METHOD_KEY].endswith("_fallback"):
+        cache.put_similar(similar["hash"], {k: v for k, v in resolved.items() if k != extract.PAGE_KEY})
+    return resolved
+
+
+def process_image(image_path, debug=None, debug_name=None, use_similar=False, page=None, dpi=None):
+    """
+    画像ファイルに対してOCR処理を実施（use_similar=Trueの場合は近似した画像の抽出結果を再利用する）
+    pageはPDFのページ番号（指定した場合は結果に付与する）
+    dpiは画像の解像度。省略時はファイルのパスを指定した画像はファイルに記録された解像度、
+    それ以外（PDFのページ・NumPy配列）はPDFを変換する解像度とみなす
+    """
+    try:
+        logger.info("=== OCR処理開始 ===")
+
+        if dpi is None and page is None and isinstance(image_path, (str, tuple)):
+            dpi = source_dpi(image_path)
+        processed, result, similar, fields = run_ocr_stage(image_path, debug, debug_name, use_similar, page, dpi)
+        if not processed:
+            return None
+
+        # Tesseractの結果を信頼できない項目がある場合、その項目だけGeminiで再抽出
+        gemini_image = image_path if fields else None
+        return resolve_result(result, gemini_image, page, similar, fields)
+
+    except gemini.GeminiUnavailableError:
+        raise
     except Exception as e:
-        print(f"OCR処理エラー: {str(e)}")
+        logger.error(f"OCR処理エラー: {str(e)}")
         return None
 
 
-def process_pdf(pdf_path):
-    """PDFファイルに対してOCR処理を実施"""
-    try:
-        from pdf2image import convert_from_path
+def iter_pdf_pages(pdf_path, dpi=None, workers=None, pages=None):
+    """
+    PDFを1ページずつ画像（NumPy配列, BGR）に変換して返すジェネレータ
+    先読みするページ数をworkersに制限し、全ページを同時にメモリへ展開しない
 
-        # PDFを画像に変換
-        print("=== PDF変換開始 ===")
-        pages = convert_from_path(pdf_path)
+    Parameters:
+    pdf_path: PDFファイルのパス、またはPDFの内容のバイト列
+    pages: 変換するページ番号のリスト（省略時は全ページ）
 
-        results = []
-        for i, page in enumerate(pages):
-            print(f"\nページ {i+1} の処理を開始")
+    Returns:
+    (ページ番号, 画像) のイテレータ
+    """
+    from pdf2image import convert_from_path, convert_from_bytes, pdfinfo_from_path, pdfinfo_from_bytes
 
-            # 一時的に画像を保存
-            temp_image_path = os.path.join(os.path.dirname(pdf_path), f"temp_page_{i+1}.png")
-            page.save(temp_image_path, "PNG")
+    dpi = dpi or PDF_DPI
+    workers = workers or PDF_RENDER_WORKERS
+    if isinstance(pdf_path, (bytes, bytearray)):
+        pdfinfo = pdfinfo_from_bytes
+        convert = convert_from_bytes
+    else:
+        pdfinfo = pdfinfo_from_path
+        convert = convert_from_path
+    if pages is None:
+        pages = range(1, int(pdfinfo(pdf_path)["Pages"]) + 1)
+    pages = list(pages)
+
+    def render(page_no):
+        # output_folderを指定しない場合、pdftoppmの出力はメモリ上で読み込まれる
+        with metrics.stage("pdf_render"):
+            pages = convert(pdf_path, dpi=dpi, first_page=page_no, last_page=page_no)
+            if not pages:
+                return None
+            return cv2.cvtColor(np.asarray(pages[0].convert("RGB")), cv2.COLOR_RGB2BGR)
+
+    if workers <= 1:
+        for page_no in pages:
+            yield page_no, render(page_no)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-render") as executor:
+        pending = []
+        remaining = iter(pages)
+        next_page = next(remaining, None)
+        while pending or next_page is not None:
+            while next_page is not None and len(pending) < workers:
+                # 相関ID・計測値の収集先を変換用のスレッドへ引き継ぐ
+                pending.append((next_page, executor.submit(contextvars.copy_context().run, render, next_page)))
+                next_page = next(remaining, None)
+            page_no, future = pending.pop(0)
+            yield page_no, future.result()
+
+
+def iter_pdf_stages(pdf_path, name, debug=None, use_similar=False):
+    """
+    PDFのページごとのCPU処理（テキストレイヤーからの抽出、または画像への変換・前処理・Tesseract）をページ番号の順に実行する
+    テキストレイヤーのあるページは画像に変換せず、Geminiでの再抽出が必要な場合のみ変換する
 
-            # 画像に対してOCR処理を実行
-            result = process_image(temp_image_path)
-            if result:
-                results.append(result)
+    Parameters:
+    pdf_path: PDFファイルのパス、またはPDFの内容のバイト列
+    name: ファイル名（前処理の途中画像の保存に使う）
+
+    Returns:
+    {"page": ページ番号, "result": 抽出結果, "similar": 近似画像の検索結果, "fields": Geminiで再抽出する項目,
+     "image": ページの画像（再抽出が不要な場合はNone）, "source": 抽出方法（"tesseract" / "text_layer"）} のイテレータ
+    """
+    texts = read_text_layer(pdf_path) if PDF_TEXT_LAYER_ENABLED else None
+    text_stages = {}
+    if texts is not None:
+        for page_no, text in enumerate(texts, 1):
+            if has_text_layer(text):
+                text_stages[page_no] = run_text_stage(text, page_no)
+        logger.info(f"テキストレイヤーのあるページ: {len(text_stages)} / {len(texts)}")
+        render = [page_no for page_no in range(1, len(texts) + 1) if page_no not in text_stages or text_stages[page_no][1]]
+        rendered = iter_pdf_pages(pdf_path, pages=render) if render else iter(())
+    else:
+        # ページ数はpdfinfoで取得する
+        rendered = iter_pdf_pages(pdf_path)
+
+    for page_no, image in rendered:
+        # 変換しないページ（テキストレイヤーから抽出を確定できるページ）は、変換するページより前のものを先に返す
+        for text_page in sorted(p for p in text_stages if p < page_no):
+            result, _ = text_stages.pop(text_page)
+            yield {"page": text_page, "result": result, "similar": None, "fields": [], "image": None, "source": "text_layer"}
+
+        if page_no in text_stages:
+            # テキストレイヤーで抽出できなかった項目だけをGeminiで再抽出する（Tesseractは実行しない）
+            result, fields = text_stages.pop(page_no)
+            if image is None:
+                fields = []
+            yield {"page": page_no, "result": result, "similar": None, "fields": fields, "image": image, "source": "text_layer"}
+            continue
+
+        logger.info(f"ページ {page_no} の処理を開始")
+        if image is None:
+            continue
+        processed, result, similar, fields = run_ocr_stage(
+            image, debug, f"{name}_p{page_no}", use_similar, page_no, dpi=PDF_DPI
+        )
+        if processed:
+            yield {
+                "page": page_no,
+                "result": result,
+                "similar": similar,
+                "fields": fields,
+                "image": image if fields else None,
+                "source": "tesseract",
+            }
+
+    for text_page in sorted(text_stages):
+        result, _ = text_stages[text_page]
+        yield {"page": text_page, "result": result, "similar": None, "fields": [], "image": None, "source": "text_layer"}
+
+
+def process_pdf(pdf_path, debug=None, use_similar=False):
+    """
+    PDFファイル（パスまたはソース）に対してOCR処理を実施（1ページずつ変換・処理する）
+    テキストレイヤーのあるページは画像に変換せずにテキストから抽出する
+    """
+    try:
+        logger.info("=== PDF変換開始 ===")
 
-            # 一時ファイルを削除
+        name = os.path.basename(source_name(pdf_path))
+        results = []
+        for stage in iter_pdf_stages(pdf_path[1] if isinstance(pdf_path, tuple) else pdf_path, name, debug, use_similar):
             try:
-                os.remove(temp_image_path)
-            except:
-                pass
+                result = resolve_result(
+                    stage["result"], stage["image"], stage["page"], stage["similar"], stage["fields"], stage["source"]
+                )
+            except gemini.GeminiUnavailableError:
+                raise
+            except Exception as e:
+                logger.error(f"OCR処理エラー: {str(e)}")
+                continue
+            if result:
+                results.append(result)
 
-        print("\n=== 全ページの処理が完了しました ===")
+        logger.info("=== 全ページの処理が完了しました ===")
 
         if not results:
-            print("データを抽出できませんでした")
+            logger.warning("データを抽出できませんでした")
             return None
 
         # PDFの場合は全ての結果をリストとして返す
         return results
 
+    except gemini.GeminiUnavailableError:
+        raise
     except Exception as e:
-        print(f"PDF処理エラー: {str(e)}")
+        logger.error(f"PDF処理エラー: {str(e)}")
         return None
 
 
-def process_multiple_files(file_paths):
+def _cpu_stage(source, debug=None, correlation_id=None, use_similar=False, reporter=None):
+    """
+    1ファイル分のCPU処理（前処理・Tesseract）をプロセスプールのワーカーで実行
+    Geminiでの再抽出が必要なページは、送信する画像（パスまたはJPEGのペイロード）と再抽出する項目を併せて返す
+    ワーカーでの計測値は記録せずに結果の "metrics" に入れて返す（メインプロセスで記録する）
+    進捗はワーカーから reporter へ直接通知する（ページごとの段階を処理中に配信するため）
+    """
+    with log.bind(correlation_id), progress.bind(reporter), metrics.collect() as observations:
+        stage = _ocr_file(source, debug, use_similar)
+    stage["metrics"] = observations
+    return stage
+
+
+def _ocr_file(source, debug=None, use_similar=False):
+    """
+    1ファイル分の前処理・Tesseractを実行し、ページごとの結果を返す
+    ファイルは1度だけ読み込み、同じ画像を前処理・知覚ハッシュ・Geminiへ送る画像の作成に使う
+    """
+    name = os.path.basename(source_name(source))
+    file_ext = os.path.splitext(name)[1].lower()
+
+    if file_ext == ".pdf":
+        pages = []
+        for stage in iter_pdf_stages(source[1] if isinstance(source, tuple) else source, name, debug, use_similar):
+            gemini_image = None
+            if stage["image"] is not None:
+                # Geminiへ送る画像はワーカー側で縮小・JPEG化してメインプロセスへ渡す
+                with metrics.stage("gemini_payload"):
+                    gemini_image = gemini.prepare_image_payload(stage["image"])
+            pages.append(
+                {
+                    "result": stage["result"],
+                    "gemini_image": gemini_image,
+                    "gemini_fields": stage["fields"],
+                    "page": stage["page"],
+                    "similar": stage["similar"],
+                    "source": stage["source"],
+                }
+            )
+        return {"pdf": True, "pages": pages}
+
+    elif file_ext in IMAGE_EXTENSIONS:
+        with metrics.stage("decode"):
+            image = decode_source(source)
+        if image is None:
+            logger.warning(f"画像の読み込みに失敗: {name}")
+            metrics.inc(metrics.RESOLUTIONS, "failed")
+            return {"pdf": False, "pages": []}
+        processed, result, similar, fields = run_ocr_stage(image, debug, name, use_similar, dpi=source_dpi(source))
+        if not processed:
+            return {"pdf": False, "pages": []}
+        gemini_image = None
+        if fields:
+            with metrics.stage("gemini_payload"):
+                gemini_image = gemini.prepare_image_payload(image)
+        page = {"result": result, "gemini_image": gemini_image, "gemini_fields": fields, "similar": similar}
+        return {"pdf": False, "pages": [page]}
+
+    else:
+        raise ValueError(f"サポートされていないファイル形式です: {file_ext}")
+
+
+def _api_stage(stage, reporter=None):
+    """Geminiでの再試行が必要なページに対してAPIを呼び出し、ファイル単位の結果を返す"""
+    results = []
+    with progress.bind(reporter):
+        for page in stage["pages"]:
+            result = resolve_result(
+                page["result"],
+                page["gemini_image"],
+                page.get("page"),
+                page.get("similar"),
+                page.get("gemini_fields"),
+                page.get("source", "tesseract"),
+            )
+            if result:
+                results.append(result)
+
+    if not results:
+        return None
+    # PDFの場合は全ての結果をリストとして返す
+    return results if stage["pdf"] else results[0]
+
+
+def share_cpus(processes):
+    """
+    CPU処理の並列数の既定値を、同じホストでOCRを実行する processes 個のプロセスでCPUを分け合う数にする
+    （OCR_MAX_WORKERS を指定した場合は変更しない。プロセスプールを作成する前に呼び出す）
+    """
+    global _default_workers
+    if not OCR_MAX_WORKERS:
+        _default_workers = max(1, (os.cpu_count() or 1) // max(1, processes))
+
+
+def _get_pools(max_workers=None):
+    """CPU処理用のプロセスプールとAPI呼び出し用のスレッドプールを取得（初回のみ作成）"""
+    global _process_pool, _api_pool
+    with _pool_lock:
+        if _process_pool is None:
+            # スレッドを持つプロセスからのforkを避けるためspawnで起動する
+            _process_pool = ProcessPoolExecutor(
+                max_workers=max_workers or _default_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        if _api_pool is None:
+            _api_pool = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY, thread_name_prefix="gemini")
+        return _process_pool, _api_pool
+
+
+def shutdown_pools(cancel=False):
+    """プロセスプール・スレッドプールを終了する（cancel=Trueの場合は未着手の処理を取り消して待たずに終了する）"""
+    global _process_pool, _api_pool
+    with _pool_lock:
+        for pool in (_process_pool, _api_pool):
+            if pool is not None:
+                pool.shutdown(wait=not cancel, cancel_futures=cancel)
+        _process_pool = None
+        _api_pool = None
+
+
+def iter_process_files(file_paths, mode=None, max_workers=None, use_cache=None, debug=None, progress_for=None):
+    """
+    複数ファイルを処理し、完了した順に (入力順のインデックス, 結果, エラーメッセージ) を返す
+    結果を取得できなかった場合、Gemini APIの呼び出し失敗などの理由がエラーメッセージに入る
+
+    Parameters:
+    file_paths: ファイルパスまたは (ファイル名, 内容のバイト列) のタプルのリスト（イテレータも可）
+    mode: "process"（並列実行）または "sequential"（逐次実行）。省略時は設定値
+    max_workers: CPU処理の並列数。省略時は設定値
+    use_cache: 抽出結果キャッシュを使用するか。省略時は設定値
+    debug: 前処理の途中画像を保存するか。省略時は設定値
+    progress_for: 入力順のインデックスを受け取り、そのファイルの進捗の通知先を返す関数（省略時は通知しない）
+        通知先はプロセスプールのワーカーへ渡すため、pickle可能であること（jobs.FileProgress など）
+    """
+    mode = mode or OCR_PARALLEL_MODE
+    progress_for = progress_for or (lambda i: None)
+    # 途中画像の保存を指定された場合は、キャッシュを使わずに前処理を実行する
+    use_cache = (CACHE_ENABLED if use_cache is None else use_cache) and not debug
+    # 近似画像の結果の再利用もキャッシュの一種として扱う
+    use_similar = use_cache and PHASH_ENABLED
+    if mode != "process":
+        for i, file_path in enumerate(file_paths):
+            try:
+                with progress.bind(progress_for(i)):
+                    result = main(_as_source(file_path), use_cache, debug)
+                yield i, result, None
+            except Exception as e:
+                logger.error(f"処理エラー: {str(e)}")
+                yield i, None, str(e)
+        return
+
+    process_pool, api_pool = _get_pools(max_workers)
+    # 処理中のファイル数を制限し、未処理のファイルは必要になった時点で投入する
+    max_in_flight = (max_workers or _default_workers) * 2
+    sources = enumerate(file_paths)
+    cpu_pending = {}
+    api_pending = {}
+    cached_results = []
+    digests = {}
+    reporters = {}
+
+    def fill():
+        while len(cpu_pending) + len(api_pending) < max_in_flight:
+            try:
+                i, file_path = next(sources)
+            except StopIteration:
+                return
+            source = _as_source(file_path)
+            reporter = progress_for(i)
+            try:
+                with progress.bind(reporter):
+                    digest, cached = _lookup_cache(source, use_cache)
+            except Exception as e:
+                logger.error(f"処理エラー: {str(e)}")
+                cached_results.append((i, None, str(e)))
+                continue
+            if cached:
+                # キャッシュに存在する場合は前処理・OCRを行わない
+                cached_results.append((i, cached, None))
+                continue
+            digests[i] = digest
+            reporters[i] = reporter
+            cpu_pending[
+                process_pool.submit(_cpu_stage, source, debug, log.correlation_id.get(), use_similar, reporter)
+            ] = i
+
+    fill()
+    while cached_results or cpu_pending or api_pending:
+        while cached_results:
+            yield cached_results.pop(0)
+        if not cpu_pending and not api_pending:
+            fill()
+            continue
+        done, _ = wait(list(cpu_pending) + list(api_pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in cpu_pending:
+                i = cpu_pending.pop(future)
+                try:
+                    stage = future.result()
+                except Exception as e:
+                    logger.error(f"処理エラー: {str(e)}")
+                    digests.pop(i, None)
+                    reporters.pop(i, None)
+                    yield i, None, str(e)
+                    continue
+                metrics.replay(stage.pop("metrics", None))
+                # 相関IDをAPI呼び出し用のスレッドへ引き継ぐ
+                api_pending[
+                    api_pool.submit(contextvars.copy_context().run, _api_stage, stage, reporters.pop(i, None))
+                ] = i
+            else:
+                i = api_pending.pop(future)
+                digest = digests.pop(i, None)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Gemini API処理エラー: {str(e)}")
+                    yield i, None, str(e)
+                    continue
+                if digest and result:
+                    cache.put(digest, result)
+                yield i, result, None
+        fill()
+
+
+def process_files(file_paths, mode=None, max_workers=None, use_cache=None, debug=None):
+    """複数ファイルを処理し、入力順に並べた結果のリストを返す"""
+    file_paths = list(file_paths)
+    results = [None] * len(file_paths)
+    for i, result, _ in iter_process_files(file_paths, mode, max_workers, use_cache, debug):
+        results[i] = result
+    return results
+
+
+def process_multiple_files(file_paths, mode=None):
     """複数のファイルを処理してExcelに出力"""
     results = []
 
-    for file_path in file_paths:
-        path = Path(file_path)
-        if path.suffix.lower() == ".pdf":
+    for result in process_files(file_paths, mode):
+        if isinstance(result, list):
             # PDFの場合
-            pdf_results = process_pdf(str(path))
-            if pdf_results:
-                results.extend(pdf_results)
-        else:
+            results.extend(result)
+        elif result:
             # 画像ファイルの場合
-            result = process_image(str(path))
-            if result:
-                results.append(result)
+            results.append(result)
 
     if results:
         # 結果をDataFrameに変換
@@ -309,32 +1162,71 @@ def process_multiple_files(file_paths):
         # Excelファイルとして保存
         output_path = "receipt_results.xlsx"
         df.to_excel(output_path, index=False)
-        print(f"結果を{output_path}に保存しました。")
+        logger.info(f"結果を{output_path}に保存しました。")
         return output_path
 
     return None
 
 
-def main(image_path):
+def _lookup_cache(source, use_cache):
     """
-    画像ファイルに対してOCR処理を実施します。
+    キャッシュを参照する
+
+    Returns:
+    (ファイルのハッシュ値（キャッシュ無効時はNone）, キャッシュされた結果)
+    """
+    if not use_cache:
+        return None, None
+    with metrics.stage("cache_lookup"):
+        digest = cache.hash_bytes(source[1]) if isinstance(source, tuple) else cache.hash_file(source)
+        cached = cache.get(digest)
+    metrics.inc(metrics.CACHE_LOOKUPS, "hit" if cached else "miss")
+    if cached:
+        logger.info(f"キャッシュから結果を取得しました: {source_name(source)}")
+        progress.emit("cached")
+    return digest, cached
+
+
+def main(image_path, use_cache=None, debug=None):
+    """
+    画像ファイル（パスまたは (ファイル名, 内容のバイト列) のタプル）に対してOCR処理を実施します。
     PDFの場合はpdf2imageを用いて画像に変換後、各ページに対してOCR処理を行います。
+    同じ内容のファイルを処理済みの場合はキャッシュされた結果を返します（use_cache=Falseで無効）。
+    debug=Trueの場合は前処理の途中画像を保存します。
     """
     try:
-        # ファイルの拡張子を取得
-        file_ext = os.path.splitext(image_path)[1].lower()
+        # 途中画像の保存を指定された場合は、キャッシュを使わずに前処理を実行する
+        use_cache = (CACHE_ENABLED if use_cache is None else use_cache) and not debug
 
-        # PDFファイルの場合
+        # ファイルの拡張子を取得（image_pathはファイルパスまたは (ファイル名, 内容のバイト列) のタプル）
+        name = source_name(image_path)
+        file_ext = os.path.splitext(name)[1].lower()
+        if file_ext not in SUPPORTED_EXTENSIONS:
+            raise ValueError(f"サポートされていないファイル形式です: {file_ext}")
+
+        digest, cached = _lookup_cache(image_path, use_cache)
+        if cached:
+            return cached
+
+        # PDFファイルの場合（キャッシュを使用する場合は近似した画像の結果も再利用する）
+        use_similar = use_cache and PHASH_ENABLED
         if file_ext == ".pdf":
-            return process_pdf(image_path)
+            result = process_pdf(image_path, debug, use_similar)
         # 画像ファイルの場合
-        elif file_ext in [".jpg", ".jpeg", ".png", ".tiff", ".bmp"]:
-            return process_image(image_path)
         else:
-            raise ValueError(f"サポートされていないファイル形式です: {file_ext}")
+            image = decode_source(image_path)
+            if image is None:
+                raise ValueError(f"画像の読み込みに失敗しました: {name}")
+            result = process_image(image, debug, os.path.basename(name), use_similar, dpi=source_dpi(image_path))
+
+        if digest and result:
+            cache.put(digest, result)
+        return result
 
+    except gemini.GeminiUnavailableError:
+        raise
     except Exception as e:
-        print(f"処理エラー: {str(e)}")
+        logger.error(f"処理エラー: {str(e)}")
         return None
 
 
@@ -419,37 +1311,21 @@ def extract_text_from_image(image):
         text = " ".join(text_lines)
 
         # デバッグ出力
-        print("\n=== OCR抽出テキスト（信頼度60%以上） ===")
-        print(text)
-        print("=====================================\n")
+        logger.debug(f"OCR抽出テキスト（信頼度60%以上）:\n{text}")
 
         return text
 
     except Exception as e:
-        print(f"OCR処理エラー: {str(e)}")
+        logger.error(f"OCR処理エラー: {str(e)}")
         return None
 
 
 def validate_amount(amount_str):
-    """金額の妥当性を検証"""
+    """金額の妥当性を検証（範囲は抽出の候補と同じ extract.is_valid_amount で検証する）"""
     try:
         # 数値以外の文字を除去
-        amount = int(re.sub(r"[^\d]", "", amount_str))
-
-        # 基本的な検証ルール
-        if amount <= 0:
-            return False
-        if amount > 10000000:  # 1000万円以上は不正解の可能性が高い
-            return False
-        if len(str(amount)) > 8:  # 8桁以上は不正解の可能性が高い
-            return False
-
-        # 金額の一般的なパターン
-        if amount % 10 != 0:  # 1の位が0でない場合は不正解の可能性が高い
-            return False
-
-        return True
-    except:
+        return extract.is_valid_amount(int(re.sub(r"[^\d]", "", amount_str)))
+    except ValueError:
         return False
 
 
@@ -481,210 +1357,34 @@ def validate_date(date_str):
 
 
 def extract_info_from_text(text):
-    """テキストから情報を抽出（信頼度評価付き）"""
-    result = {"発行日": "", "支払先名": "", "金額": "", "インボイス番号": ""}
-
-    lines = text.split("\n")
-
-    # 金額の候補を収集
-    amount_candidates = []
-    amount_patterns = [
-        (
-            r"(?:領収金額|お支払金額|ご利用金額|合計金額|利用金額|お会計|小計)[\s:：]*[¥\\]?[\s]*([0-9,\.]+)",
-            3,
-        ),  # 重み付け
-        (r"(?:金額)[\s:：]*[¥\\]?[\s]*([0-9,\.]+)", 2),
-        (r"[¥\\][\s]*([0-9,\.]+)", 1),
-        (r"([0-9]+[\s\.]+[0-9]+)", 1),
-        (r"(?:税込|税込み|税込金額)[\s:：]*[¥\\]?[\s]*([0-9,\.]+)", 2),
-    ]
-
-    for line in lines:
-        for pattern, weight in amount_patterns:
-            matches = re.finditer(pattern, line)
-            for match in matches:
-                amount_str = match.group(1).strip()
-                amount = normalize_amount(amount_str)
-                if amount > 0 and validate_amount(str(amount)):
-                    amount_candidates.append(
-                        {"amount": amount, "weight": weight, "line": line, "pattern": pattern}
-                    )
-                    print(f"金額候補を検出: {amount} (パターン: {pattern}, 重み: {weight})")
-
-    # 重み付けと出現頻度を考慮して最適な金額を選択
-    if amount_candidates:
-        amount_scores = {}
-        for candidate in amount_candidates:
-            amount = candidate["amount"]
-            weight = candidate["weight"]
-            amount_scores[amount] = amount_scores.get(amount, 0) + weight
-
-        # 最も高いスコアの金額を採用
-        best_amount = max(amount_scores.items(), key=lambda x: x[1])[0]
-        result["金額"] = str(best_amount)
-        print(f"最終的な金額を決定: {best_amount} (スコア: {amount_scores[best_amount]})")
-
-    # 日付の検出（信頼度評価付き）
-    date_patterns = [
-        (r"(\d{4}[-/年]\d{1,2}[-/月]\d{1,2})", 3),  # YYYY/MM/DD形式
-        (r"(?:令和|R)(\d{1,2})年\d{1,2}月\d{1,2}日", 2),  # 令和表記
-        (r"(\d{2,4}[-/年]\d{1,2}[-/月]\d{1,2})", 1),  # その他の日付形式
-    ]
-
-    date_candidates = []
-    for line in lines:
-        for pattern, weight in date_patterns:
-            match = re.search(pattern, line)
-            if match:
-                date_str = match.group(1)
-                if "令和" in line or "R" in line:
-                    reiwa_year = int(re.search(r"(?:令和|R)(\d{1,2})", line).group(1))
-                    date_str = f"{2018 + reiwa_year}{date_str[2:]}"
-                elif len(date_str.split("/")[0]) == 2:
-                    year = int(date_str.split("/")[0])
-                    if year < 50:
-                        date_str = f"20{date_str}"
-                    else:
-                        date_str = f"19{date_str}"
-
-                date_str = date_str.replace("年", "/").replace("月", "/").replace("日", "")
-                if validate_date(date_str):
-                    date_candidates.append({"date": date_str, "weight": weight, "line": line})
-                    print(f"日付候補を検出: {date_str} (重み: {weight})")
-
-    # 最も信頼度の高い日付を選択
-    if date_candidates:
-        best_date = max(date_candidates, key=lambda x: x["weight"])
-        result["発行日"] = best_date["date"]
-        print(f"最終的な日付を決定: {best_date['date']} (重み: {best_date['weight']})")
-
-    # 支払先名の検出（優先度付き）
-    company_candidates = []
-    for line in lines:
-        if "様" in line or "御中" in line:
-            company = re.sub(r"[\s　]+", " ", line).strip()
-            weight = 3 if "様" in line and "御中" in line else 2
-            company_candidates.append({"name": company, "weight": weight, "line": line})
-            print(f"支払先候補を検出: {company} (重み: {weight})")
-
-    if company_candidates:
-        best_company = max(company_candidates, key=lambda x: x["weight"])
-        result["支払先名"] = best_company["name"]
-        print(f"最終的な支払先を決定: {best_company['name']} (重み: {best_company['weight']})")
-
-    # インボイス番号の検出（検証付き）
-    invoice_patterns = [
-        (r"(?:登録番号|登録得号)[\s:：]*T?([0-9]{13})", 3),
-        (r"T([0-9]{13})", 2),
-    ]
-
-    invoice_candidates = []
-    for line in lines:
-        for pattern, weight in invoice_patterns:
-            match = re.search(pattern, line)
-            if match:
-                invoice_num = match.group(1)
-                if len(invoice_num) == 13:  # 13桁であることを確認
-                    invoice_candidates.append(
-                        {
-                            "number": "T" + invoice_num if not invoice_num.startswith("T") else invoice_num,
-                            "weight": weight,
-                            "line": line,
-                        }
-                    )
-                    print(f"インボイス番号候補を検出: {invoice_num} (重み: {weight})")
-
-    if invoice_candidates:
-        best_invoice = max(invoice_candidates, key=lambda x: x["weight"])
-        result["インボイス番号"] = best_invoice["number"]
-        print(f"最終的なインボイス番号を決定: {best_invoice['number']} (重み: {best_invoice['weight']})")
-
-    return result
-
-
-def normalize_amount(amount_str):
-    """金額文字列を正規化して数値に変換"""
-    try:
-        # 空白とカンマを除去
-        amount_str = amount_str.replace(" ", "").replace(",", "")
-
-        # ドット区切りの処理
-        if "." in amount_str:
-            parts = amount_str.split(".")
-            if len(parts) == 2:
-                # 8.800 -> 8800のように変換
-                amount_str = parts[0] + parts[1].ljust(3, "0")
-
-        # 数値以外の文字を除去
-        amount_str = re.sub(r"[^\d]", "", amount_str)
-
-        if amount_str:
-            amount = int(amount_str)
-            # 異常に小さい値や大きい値は除外
-            if amount < 10 or amount > 10000000:  # 1000万円を超える金額は誤認識の可能性が高い
-                return 0
-            return amount
-    except (ValueError, TypeError):
-        return 0
-    return 0
+    """テキストから情報を抽出（金額は重み付けと出現頻度による投票で選ぶ。全項目を1回の走査で抽出する）"""
+    return extract.extract_scored(text)
 
 
 def extract_date(text):
     """テキストから日付を抽出する"""
     try:
-        # 和暦と西暦の両方に対応
-        date_patterns = [
-            r"(令和|R|㎶|H)\s*(\d{1,2}|\元)年\s*(\d{1,2})月\s*(\d{1,2})日",
-            r"(\d{4}|\d{2})年\s*(\d{1,2})月\s*(\d{1,2})日",
-            r"(\d{4}|\d{2})/(\d{1,2})/(\d{1,2})",
-            r"(\d{4}|\d{2})-(\d{1,2})-(\d{1,2})",
-        ]
-
-        for pattern in date_patterns:
-            match = re.search(pattern, text)
-            if match:
-                return format_date(match)
-        return ""
+        return extract.extract_fields(text)["発行日"]
     except Exception as e:
-        print(f"日付抽出エラー: {str(e)}")
+        logger.error(f"日付抽出エラー: {str(e)}")
         return ""
 
 
 def extract_amount(text):
     """テキストから金額を抽出する"""
     try:
-        # 金額のパターンを定義
-        amount_patterns = [
-            (r"¥\s*(\d[\d,]*)", 2),  # ¥マークで始まる金額
-            (r"\\s*(\d[\d,]*)", 2),  # \マークで始まる金額
-            (r"合計\s*[:：]?\s*(\d[\d,]*)", 2),  # 合計の後の金額
-            (r"金額\s*[:：]?\s*(\d[\d,]*)", 2),  # 金額の後の数字
-            (r"([0-9]+[\s\.]+[0-9]+)", 1),  # 数字のみの場合（最も優先度低）
-            (r"([0-9]+)円", 1),  # 円で終わる金額
-        ]
-
-        candidates = []
-        for pattern, weight in amount_patterns:
-            matches = re.finditer(pattern, text)
-            for match in matches:
-                amount_str = match.group(1).replace(",", "").replace(" ", "")
-                if amount_str:
-                    try:
-                        amount = int(amount_str)
-                        if 100 <= amount <= 10000000:  # 妥当な金額範囲
-                            print(f"金額候補を検出: {amount} (パターン: {pattern}, 重み: {weight})")
-                            candidates.append((amount, weight))
-                    except ValueError:
-                        continue
-
-        if candidates:
-            # 重みが最も高い金額を選択
-            amount, score = max(candidates, key=lambda x: x[1])
-            print(f"最終的な金額を決定: {amount} (スコア: {score})")
-            return str(amount)
+        return extract.extract_fields(text)["金額"]
+    except Exception as e:
+        logger.error(f"金額抽出エラー: {str(e)}")
         return ""
+
+
+def extract_invoice_number(text):
+    """テキストからインボイス番号を抽出する"""
+    try:
+        return extract.extract_fields(text)["インボイス番号"]
     except Exception as e:
-        print(f"金額抽出エラー: {str(e)}")
+        logger.error(f"インボイス番号抽出エラー: {str(e)}")
         return ""
 
 
@@ -700,57 +1400,38 @@ def process_ocr_result(ocr_text, confidence_threshold=60):
             ]
         )
 
-        # 各項目を抽出
-        extracted_data = {
-            "発行日": extract_date(filtered_text),
-            "支払先名": extract_company_name(filtered_text),
-            "金額": extract_amount(filtered_text),
-            "インボイス番号": extract_invoice_number(filtered_text),
-        }
+        # 各項目を抽出（全項目を1回の走査で抽出する）
+        extracted_data = extract.extract_fields(filtered_text)
 
         # 結果の検証
         if not any(extracted_data.values()):
-            print("警告: 全ての項目の抽出に失敗しました")
+            logger.warning("全ての項目の抽出に失敗しました")
             return None
 
         return extracted_data
     except Exception as e:
-        print(f"OCR結果の処理中にエラーが発生しました: {str(e)}")
+        logger.error(f"OCR結果の処理中にエラーが発生しました: {str(e)}")
         return None
 
 
 def extract_company_name(text):
     """テキストから会社名を抽出する"""
     try:
-        # 会社名のパターン
-        company_patterns = [
-            r"(.+)(?:株式会社|有限会社|合同会社|事務所)",  # 会社形態が後ろにある場合
-            r"(?:株式会社|有限会社|合同会社)(.+)",  # 会社形態が前にある場合
-            r"(.+)(?:様|御中)",  # 様や御中で終わる場合
-        ]
-
-        for pattern in company_patterns:
-            match = re.search(pattern, text)
-            if match:
-                company_name = match.group(1).strip()
-                if company_name:
-                    return company_name
-
-        return ""
+        return extract.extract_fields(text)["支払先名"]
     except Exception as e:
-        print(f"会社名抽出エラー: {str(e)}")
+        logger.error(f"会社名抽出エラー: {str(e)}")
         return ""
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        files = sys.argv[1:]
-        if len(files) > 1:
-            # 複数ファイルの処理
-            result = process_multiple_files(files)
-        else:
-            # 単一ファイルの処理
-            result = main(files[0])
-        print(result)
+    # 複数ファイル・ディレクトリの一括処理は utils.batch を使用する
+    if len(sys.argv) == 2 and os.path.isfile(sys.argv[1]):
+        # 単一ファイルの処理
+        print(main(sys.argv[1]))
+    elif len(sys.argv) > 1:
+        from utils import batch
+
+        sys.exit(batch.main(sys.argv[1:]))
     else:
-        print("使用方法: python ocr.py <画像ファイルまたはPDFファイルのパス>")
+        print("使用方法: python -m utils.ocr <画像ファイルまたはPDFファイルのパス>")
+        print("         python -m utils.batch <ディレクトリ・globパターン・ファイル ...> --output results.jsonl --jobs 8")
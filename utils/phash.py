@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+
+# 知覚ハッシュ（pHash）: 画像を縮小して離散コサイン変換し、低周波成分が中央値より大きいかをビットにする
+# 同じ領収書の撮り直し・JPEGの再圧縮では少数のビットしか変わらない
+HASH_SIZE = 16  # 低周波成分の縦横の数（16×16 = 256ビット）
+DCT_SIZE = 64  # 離散コサイン変換する画像の大きさ
+# 索引の分割数（256ビットを16ビットずつに分ける）。ハミング距離が BANDS - 1 以下のハッシュは
+# 少なくとも1つの区間が完全に一致するため、区間ごとの完全一致の検索で候補を漏れなく取得できる
+BANDS = 16
+BAND_BITS = HASH_SIZE * HASH_SIZE // BANDS
+# 余白を除く際に、文字がある行・列とみなす暗い画素の割合
+_CONTENT_RATIO = 0.01
+
+
+def _crop_content(gray):
+    """文字のある範囲を切り出す（撮影時の余白・位置のずれの影響を抑える）"""
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    rows = np.flatnonzero(ink.mean(axis=1) > _CONTENT_RATIO)
+    cols = np.flatnonzero(ink.mean(axis=0) > _CONTENT_RATIO)
+    if len(rows) < 2 or len(cols) < 2:
+        return gray
+    return gray[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+
+
+def compute(gray):
+    """
+    グレースケール画像（傾き補正後）の知覚ハッシュを16進数の文字列で返す
+    二値化後の画像はノイズの影響が大きいため、二値化前の画像から計算する
+    """
+    small = cv2.resize(_crop_content(gray), (DCT_SIZE, DCT_SIZE), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small.astype(np.float32))[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = low > np.median(low[1:])
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+def distance(a, b):
+    """2つのハッシュのハミング距離"""
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def bands(value):
+    """ハッシュを BANDS 個の区間（整数）に分割する"""
+    number = int(value, 16)
+    mask = (1 << BAND_BITS) - 1
+    return [(number >> (BAND_BITS * i)) & mask for i in range(BANDS)]
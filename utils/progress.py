@@ -0,0 +1,34 @@
+import contextvars
+from contextlib import contextmanager
+
+from utils import log
+
+logger = log.get_logger(__name__)
+
+# 処理中のファイルの進捗の通知先（stage, page, data を受け取る呼び出し可能なオブジェクト）
+# プロセスプールのワーカーへ渡すため、通知先はpickle可能であること（jobs.FileProgress など）
+_reporter = contextvars.ContextVar("progress_reporter", default=None)
+
+
+@contextmanager
+def bind(reporter):
+    """ブロック内の進捗を reporter に通知する（Noneの場合は通知しない）"""
+    token = _reporter.set(reporter)
+    try:
+        yield
+    finally:
+        _reporter.reset(token)
+
+
+def emit(stage, page=None, **data):
+    """
+    処理中のファイルが段階 stage（preprocess / tesseract / gemini など）に進んだことを通知する
+    通知に失敗しても処理は続ける
+    """
+    reporter = _reporter.get()
+    if reporter is None:
+        return
+    try:
+        reporter(stage, page, data)
+    except Exception as e:
+        logger.warning(f"進捗を通知できませんでした: {str(e)}")
@@ -0,0 +1,186 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pytesseract
+
+from utils import log
+
+from config import TESSERACT_ENGINE, TESSERACT_POOL_SIZE, PDF_DPI
+
+logger = log.get_logger(__name__)
+
+# tesserocr（TesseractのC APIのバインディング）は任意の依存パッケージ
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# 言語ごとの初期化済みエンジンのプール（プロセスごと）
+_lock = threading.Lock()
+_pools = {}
+_created = {}
+_pool_pid = None
+_disabled = False
+
+
+class EngineInitError(RuntimeError):
+    """tesserocrのエンジンを作成できない（学習データが見つからない等）"""
+
+
+def is_pooled():
+    """初期化済みエンジンのプールを使用するか"""
+    return tesserocr is not None and TESSERACT_ENGINE != "pytesseract" and not _disabled
+
+
+def _create_api(lang):
+    path = os.getenv("TESSDATA_PREFIX")
+    if path:
+        return tesserocr.PyTessBaseAPI(path=path, lang=lang)
+    return tesserocr.PyTessBaseAPI(lang=lang)
+
+
+@contextmanager
+def _acquire(lang):
+    """
+    プールからエンジンを取得（空きがなければ上限まで新規作成し、上限に達していれば返却を待つ）
+    エンジンは初期化（学習データの読み込み）済みのまま使い回す
+    """
+    global _pool_pid
+    with _lock:
+        # fork後の子プロセスでは親のエンジンを使わない
+        if _pool_pid != os.getpid():
+            _pools.clear()
+            _created.clear()
+            _pool_pid = os.getpid()
+        pool = _pools.setdefault(lang, queue.Queue())
+        create = pool.empty() and _created.get(lang, 0) < TESSERACT_POOL_SIZE
+        if create:
+            _created[lang] = _created.get(lang, 0) + 1
+
+    if create:
+        try:
+            api = _create_api(lang)
+        except Exception as e:
+            with _lock:
+                _created[lang] -= 1
+            raise EngineInitError(str(e)) from e
+    else:
+        api = pool.get()
+
+    try:
+        yield api
+    finally:
+        api.Clear()
+        pool.put(api)
+
+
+def image_dpi(image, dpi=None):
+    """
+    画像の解像度（dpi）。指定がなければPIL画像の解像度の情報を使い、
+    解像度が分からない画像（NumPy配列・解像度の情報がない写真）はPDFを変換する解像度（PDF_DPI）とみなす
+    （指定しない場合、Tesseractは解像度を70dpiと推定して文字の大きさを誤る）
+    """
+    if dpi:
+        return int(dpi)
+    info = getattr(image, "info", None) or {}
+    if info.get("dpi"):
+        return int(round(float(info["dpi"][0]))) or PDF_DPI
+    return PDF_DPI
+
+
+def _set_image(api, image, dpi=None):
+    """NumPy配列（グレースケール/BGR）またはPIL画像をエンジンに渡す（一時ファイルを経由しない）"""
+    if not isinstance(image, np.ndarray):
+        api.SetImage(image)
+    else:
+        if len(image.shape) == 3:
+            # OpenCVのBGRをRGBの順に並べ替える
+            image = image[:, :, 2::-1]
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        bytes_per_pixel = 1 if len(image.shape) == 2 else image.shape[2]
+        api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+    api.SetSourceResolution(image_dpi(image, dpi))
+
+
+def _disable(e):
+    """エンジンを作成できない場合は以降pytesseractを使う"""
+    global _disabled
+    logger.warning(f"tesserocrの初期化に失敗しました。pytesseractを使用します: {str(e)}")
+    _disabled = True
+
+
+def image_to_string(image, lang="jpn", dpi=None):
+    """
+    画像からテキストを抽出（dpiは画像の解像度。省略時は image_dpi で決める）
+    tesserocrが利用できる場合は初期化済みのエンジンを使い回し、利用できない場合はpytesseractで実行する
+    認識に失敗した場合はその画像だけpytesseractで実行する
+    """
+    if is_pooled():
+        try:
+            with _acquire(lang) as api:
+                _set_image(api, image, dpi)
+                return api.GetUTF8Text()
+        except EngineInitError as e:
+            _disable(e)
+        except RuntimeError as e:
+            logger.warning(f"tesserocrでの認識に失敗しました。pytesseractで再実行します: {str(e)}")
+
+    return pytesseract.image_to_string(image, lang=lang, config=f"--dpi {image_dpi(image, dpi)}")
+
+
+def _pytesseract_lines(image, lang, dpi=None):
+    """pytesseractの単語ごとの結果を行ごとのテキスト・信頼度にまとめる"""
+    data = pytesseract.image_to_data(
+        image, lang=lang, config=f"--dpi {image_dpi(image, dpi)}", output_type=pytesseract.Output.DICT
+    )
+    lines = {}
+    for i, word in enumerate(data["text"]):
+        confidence = float(data["conf"][i])
+        if confidence < 0 or not word.strip():
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        words, confidences = lines.setdefault(key, ([], []))
+        words.append(word)
+        confidences.append(confidence)
+    return [(" ".join(words), sum(confidences) / len(confidences)) for words, confidences in lines.values()]
+
+
+def image_to_data(image, lang="jpn", dpi=None):
+    """
+    画像からテキストと行ごとの信頼度を抽出（dpiは画像の解像度。省略時は image_dpi で決める）
+
+    Returns:
+    (テキスト, 行ごとの信頼度（0〜100）のリスト)
+    テキストの空行は除き、n行目の信頼度がリストのn番目になるように揃える
+    """
+    lines = None
+    if is_pooled():
+        try:
+            with _acquire(lang) as api:
+                _set_image(api, image, dpi)
+                api.Recognize()
+                level = tesserocr.RIL.TEXTLINE
+                iterator = api.GetIterator()
+                # 文字が見つからない場合はイテレータがNoneになる
+                lines = [
+                    (line.GetUTF8Text(level), line.Confidence(level))
+                    for line in (tesserocr.iterate_level(iterator, level) if iterator else ())
+                ]
+        except EngineInitError as e:
+            _disable(e)
+        except RuntimeError as e:
+            logger.warning(f"tesserocrでの認識に失敗しました。pytesseractで再実行します: {str(e)}")
+
+    if lines is None:
+        lines = _pytesseract_lines(image, lang, dpi)
+
+    texts, confidences = [], []
+    for text, confidence in lines:
+        text = (text or "").strip()
+        if text:
+            texts.append(text)
+            confidences.append(confidence)
+    return "\n".join(texts), confidences